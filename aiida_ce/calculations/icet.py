@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Calculations running the icet tasks of `aiida_ce.tasks` as local jobs, so
+that they do not block the daemon worker running the workflow.
+
+The `code` is a python interpreter of an environment with `aiida-ce` installed.
+The cluster spaces are passed by their parameters and built by the tasks.
+"""
+import abc
+import io
+import json
+import shutil
+
+from aiida import orm
+from aiida.common import CalcInfo, CodeInfo
+from aiida.engine import CalcJob
+from aiida.plugins import DataFactory
+
+from aiida_ce import tasks
+
+ClusterSpaceData = DataFactory('cluster_space')
+ClusterExpansionData = DataFactory('cluster_expansion')
+StructureDbData = DataFactory('structure_db')
+
+
+class IcetTaskCalculation(CalcJob):
+    """
+    Base calculation job of a task of `aiida_ce.tasks`
+    """
+    _task = None
+
+    @classmethod
+    def define(cls, spec):
+        #yapf: disable
+        super().define(spec)
+        spec.input('parameters', valid_type=orm.Dict, required=False,
+                   help='keyword arguments of the task.')
+        spec.input('metadata.options.resources', valid_type=dict, default={'num_machines': 1})
+        spec.input('metadata.options.max_wallclock_seconds', valid_type=int, default=86400, required=True)
+        spec.input('metadata.options.max_concurrent_tasks', valid_type=int, default=1,
+                   help='number of icet tasks running at the same time on the machine, the others wait. '
+                        'This is a machine-global lock shared by all jobs, the waiting jobs are already running '
+                        'for the scheduler.')
+        spec.exit_code(300, 'ERROR_MISSING_OUTPUT_FILES',
+                       message='The task did not write all of its output files.')
+
+    @abc.abstractmethod
+    def _write_inputs(self, folder):
+        """write the input files of the task other than the parameters"""
+
+    @staticmethod
+    def _write_cluster_space(folder, cluster_space):
+        """write the parameters of `cluster_space`, built by the task"""
+        with folder.open(tasks.CLUSTER_SPACE_FILENAME, 'w', encoding='utf8') as handle:
+            json.dump(cluster_space.get_build_parameters(), handle)
+
+    def _get_parameters(self):
+        """return the json serializable keyword arguments of the task"""
+        return self.inputs.parameters.get_dict() if 'parameters' in self.inputs else {}
+
+    def _get_retrieve_list(self):
+        """return the output files of the task"""
+        return [tasks.RESULTS_FILENAME]
+
+    def _get_retrieve_temporary_list(self):
+        """return the output files of the task passed to the parser only"""
+        return []
+
+    def prepare_for_submission(self, folder):
+        """
+        Write the input files and run `python -m aiida_ce.tasks <task>` in the
+        working directory.
+        """
+        self._write_inputs(folder)
+        with folder.open(tasks.PARAMETERS_FILENAME, 'w', encoding='utf8') as handle:
+            json.dump(self._get_parameters(), handle)
+
+        codeinfo = CodeInfo()
+        codeinfo.code_uuid = self.inputs.code.uuid
+        codeinfo.cmdline_params = [
+            '-m', 'aiida_ce.tasks', self._task,
+            '--max-concurrent-tasks', str(self.options.max_concurrent_tasks),
+        ]
+        codeinfo.withmpi = False
+
+        calcinfo = CalcInfo()
+        calcinfo.codes_info = [codeinfo]
+        calcinfo.retrieve_list = self._get_retrieve_list()
+        calcinfo.retrieve_temporary_list = self._get_retrieve_temporary_list()
+
+        return calcinfo
+
+
+class IcetFitDataCalculation(IcetTaskCalculation):
+    """
+    Calculation job computing the fit matrix and target vector of structures
+    of a `StructureDbData` with `aiida_ce.tasks.write_fit_matrix`
+    """
+    _task = 'fit_data'
+
+    @classmethod
+    def define(cls, spec):
+        #yapf: disable
+        super().define(spec)
+        spec.input('cluster_space', valid_type=ClusterSpaceData,
+                   help='The cluster space of the cluster vectors.')
+        spec.input('structure_db', valid_type=StructureDbData,
+                   help='The reference data containing the structures and their properties.')
+        spec.input('selection', valid_type=orm.Str,
+                   help='ase db selection of the structures, all of them if empty.')
+        spec.input('fit_data_key', valid_type=orm.Str,
+                   help='The key of the property of the structures to fit.')
+        spec.input('metadata.options.parser_name', valid_type=str, default='icet.fit_data')
+
+        spec.output('fit_data', valid_type=orm.ArrayData,
+                    help='The fit matrix (cluster vectors) and the target vector of the structures.')
+
+    def _write_inputs(self, folder):
+        """write the cluster space and copy the db file, merged along the chain of shards"""
+        self._write_cluster_space(folder, self.inputs.cluster_space)
+
+        with self.inputs.structure_db.pin_db_file() as entry:
+            with open(entry.path, 'rb') as source:
+                with folder.open(tasks.STRUCTURES_FILENAME, 'wb') as handle:
+                    shutil.copyfileobj(source, handle)
+
+    def _get_parameters(self):
+        parameters = super()._get_parameters()
+        parameters.update({'selection': self.inputs.selection.value, 'fit_data_key': self.inputs.fit_data_key.value})
+
+        return parameters
+
+    def _get_retrieve_temporary_list(self):
+        """the fit matrix is stored once, in the output fit data"""
+        return [tasks.FIT_MATRIX_FILENAME, tasks.TARGET_FILENAME]
+
+
+class IcetTrainCalculation(IcetTaskCalculation):
+    """
+    Calculation job training a cluster expansion on fit data with
+    `aiida_ce.tasks.train_cluster_expansion`
+    """
+    _task = 'train'
+
+    @classmethod
+    def define(cls, spec):
+        #yapf: disable
+        super().define(spec)
+        spec.input('cluster_space', valid_type=ClusterSpaceData,
+                   help='The cluster space of the fit data, in which the `cutoffs_candidates` are nested.')
+        spec.input('fit_data', valid_type=orm.ArrayData,
+                   help='The fit matrix and target vector to train on.')
+        spec.input('metadata.options.parser_name', valid_type=str, default='icet.train')
+
+        spec.output('results', valid_type=orm.ArrayData,
+                    help='The arrays of the training: parameters, validation and selection scores.')
+        spec.output('info', valid_type=orm.Dict,
+                    help='The selected fit, columns and cutoffs, the column sets of the cutoffs candidates, '
+                         'and the metadata of the cluster expansion.')
+        spec.output('cluster_expansion', valid_type=ClusterExpansionData, required=False,
+                    help='The trained cluster expansion, if a fit could be selected.')
+
+    def _write_inputs(self, folder):
+        """write the cluster space and copy the .npy files of the fit matrix and target vector, without loading them"""
+        self._write_cluster_space(folder, self.inputs.cluster_space)
+        for name, filename in (('fit_matrix', tasks.FIT_MATRIX_FILENAME), ('target', tasks.TARGET_FILENAME)):
+            with self.inputs.fit_data.open(f'{name}.npy', mode='rb') as source:
+                with folder.open(filename, 'wb') as handle:
+                    shutil.copyfileobj(source, handle)
+
+    def _get_retrieve_list(self):
+        return [tasks.RESULTS_FILENAME, tasks.RESULTS_ARRAYS_FILENAME]
+
+    def _get_retrieve_temporary_list(self):
+        """the cluster expansion is stored once, in the output cluster expansion"""
+        return [tasks.CLUSTER_EXPANSION_FILENAME]
+
+
+class IcetSqsCalculation(IcetTaskCalculation):
+    """
+    Calculation job generating a SQS with `aiida_ce.tasks.sqs`
+    """
+    _task = 'sqs'
+
+    @classmethod
+    def define(cls, spec):
+        #yapf: disable
+        super().define(spec)
+        spec.input('cluster_space', valid_type=ClusterSpaceData,
+                   help='The cluster space of the SQS.')
+        spec.input_namespace('supercells', valid_type=orm.StructureData, dynamic=True,
+                             help='The supercells annealed independently, in the order of their labels.')
+        spec.input('metadata.options.parser_name', valid_type=str, default='icet.sqs')
+
+        spec.output('output_structure', valid_type=orm.StructureData,
+                    help='The output special quasirandom structure (SQS), the best of all supercells.')
+        spec.output('output_cluster_vector', valid_type=orm.List,
+                    help='The output cluster vector of the output SQS.')
+        spec.output('objectives', valid_type=orm.ArrayData,
+                    help='The objective of the SQS of each supercell.')
+        spec.exit_code(301, 'ERROR_NO_VALID_SUPERCELL',
+                       message='The annealing failed in every supercell.')
+
+    def _write_inputs(self, folder):
+        """write the cluster space and the supercells"""
+        from ase.io import write
+
+        self._write_cluster_space(folder, self.inputs.cluster_space)
+
+        stream = io.StringIO()
+        supercells = self.inputs.supercells
+        write(stream, [supercells[label].get_ase() for label in sorted(supercells)], format='extxyz')
+        with folder.open(tasks.SUPERCELLS_FILENAME, 'w', encoding='utf8') as handle:
+            handle.write(stream.getvalue())
+
+    def _get_retrieve_list(self):
+        return [tasks.RESULTS_FILENAME, tasks.SQS_FILENAME]
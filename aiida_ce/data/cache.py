@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""in-process and on-disk caches shared by the data types of the plugin"""
+from collections import OrderedDict, namedtuple
+import contextlib
+import fcntl
+import os
+import tempfile
+import threading
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LRUCache:
+    """
+    A bounded, thread-safe mapping which evicts the least recently used
+    entry once `maxsize` entries are held, and counts hits and misses.
+    """
+    def __init__(self, maxsize=16):
+        if maxsize < 1:
+            raise ValueError(f'maxsize `{maxsize}` must be a positive integer')
+
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """return the cached value of `key` and mark it as recently used"""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self._misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def put(self, key, value):
+        """cache `value` under `key`, evicting the oldest entries if full"""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """remove `key` from the cache and return its value"""
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        """drop all entries and reset the counters"""
+        with self._lock:
+            self._data.clear()
+            self._hits = 0
+            self._misses = 0
+
+    def resize(self, maxsize):
+        """change the bound of the cache, evicting entries if needed"""
+        if maxsize < 1:
+            raise ValueError(f'maxsize `{maxsize}` must be a positive integer')
+
+        with self._lock:
+            self._maxsize = maxsize
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def info(self):
+        """return a `CacheInfo` with the hit and miss counters"""
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._maxsize, len(self._data))
+
+
+class CacheEntry:
+    """
+    A file of a `FileCache`, pinned by a shared `flock` on the lock file of
+    its key: it is not evicted until `release` is called or the entry is
+    garbage collected. Can be used as a context manager.
+    """
+    def __init__(self, path, lock_file):
+        self._path = path
+        self._lock_file = lock_file
+
+    @property
+    def path(self):
+        """absolute path of the cached file"""
+        return self._path
+
+    @property
+    def is_pinned(self):
+        """whether the entry still holds its lock"""
+        return self._lock_file is not None
+
+    def release(self):
+        """release the lock, the file may then be evicted"""
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def __del__(self):
+        self.release()
+
+
+class FileCache:
+    """
+    A directory of files materialized from the repository, named by a
+    content key and bounded to `maxsize` bytes by evicting the least
+    recently used files.
+
+    The directory can be shared by several processes (e.g. daemon workers).
+    Every key has a lock file: readers hold a shared `flock` on it as long as
+    they use the file (see `CacheEntry`), the file is written under an
+    exclusive one, and eviction skips the files whose lock it can not take
+    and removes the lock file with the file otherwise.
+    The lock of the directory is only held to list and evict files, not while
+    a file is written. Files are written to a temporary file, made read-only
+    and moved in place, so an existing file is always complete. The hit and
+    miss counters are those of the current process.
+    """
+    _lock_filename = '.lock'
+    _key_lock_prefix = '.lock-'
+    _tmp_prefix = '.tmp-'
+
+    def __init__(self, directory, maxsize):
+        if maxsize < 1:
+            raise ValueError(f'maxsize `{maxsize}` must be a positive integer')
+
+        self._directory = os.path.abspath(directory)
+        self._maxsize = maxsize
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def directory(self):
+        """absolute path of the cache directory"""
+        return self._directory
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """hold the lock of the cache directory"""
+        os.makedirs(self._directory, exist_ok=True)
+        with open(os.path.join(self._directory, self._lock_filename), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _get_key_lock_path(self, key):
+        """return the path of the lock file of `key`"""
+        return os.path.join(self._directory, f'{self._key_lock_prefix}{key}')
+
+    def _open_key_lock(self, key):
+        """open the lock file of `key`"""
+        return open(self._get_key_lock_path(key), 'a')  # pylint: disable=consider-using-with
+
+    def _is_key_lock(self, lock_file, key):
+        """whether `lock_file` is still the lock file of `key`, not one removed by an eviction"""
+        try:
+            stat = os.stat(self._get_key_lock_path(key))
+        except FileNotFoundError:
+            return False
+
+        locked = os.fstat(lock_file.fileno())
+        return (locked.st_dev, locked.st_ino) == (stat.st_dev, stat.st_ino)
+
+    def _lock_key(self, key, operation):
+        """
+        open the lock file of `key` and take the `flock` `operation` on it,
+        again if the lock file was removed by an eviction while waiting for it
+        """
+        while True:
+            lock_file = self._open_key_lock(key)
+            try:
+                fcntl.flock(lock_file, operation)
+            except BaseException:
+                lock_file.close()
+                raise
+            if self._is_key_lock(lock_file, key):
+                return lock_file
+            lock_file.close()
+
+    def _entries(self):
+        """list the `(mtime, size, path)` of the cached files"""
+        entries = []
+        for name in os.listdir(self._directory):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self._directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        return entries
+
+    def pin(self, key, write):
+        """
+        Return the pinned `CacheEntry` of the file cached under `key`,
+        materialized first by `write(path)` into a temporary file if not cached yet.
+        """
+        os.makedirs(self._directory, exist_ok=True)
+        path = os.path.join(self._directory, key)
+        lock_file = self._lock_key(key, fcntl.LOCK_SH)
+        try:
+            if os.path.isfile(path):
+                os.utime(path)
+                self._hits += 1
+                return CacheEntry(path, lock_file)
+
+            # only this key is locked while its file is written, the shared
+            # lock is released for a moment and the lock file may be evicted
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not self._is_key_lock(lock_file, key):
+                lock_file.close()
+                return self.pin(key, write)
+            if os.path.isfile(path):
+                self._hits += 1
+            else:
+                self._misses += 1
+                self._write(path, write)
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+        except BaseException:
+            lock_file.close()
+            raise
+
+        # the exclusive lock was released for a moment, check the file and its lock are still there
+        if not os.path.isfile(path) or not self._is_key_lock(lock_file, key):
+            lock_file.close()
+            return self.pin(key, write)
+
+        with self._locked():
+            self._evict()
+
+        return CacheEntry(path, lock_file)
+
+    def _write(self, path, write):
+        """materialize the file `path` by `write` through a read-only temporary file"""
+        fd, tmp_path = tempfile.mkstemp(dir=self._directory, prefix=self._tmp_prefix)
+        os.close(fd)
+        try:
+            write(tmp_path)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _evict(self, maxsize=None):
+        """
+        remove the least recently used files which are not pinned, and their
+        lock files, until the cache fits in `maxsize`
+        """
+        maxsize = self._maxsize if maxsize is None else maxsize
+        entries = sorted(self._entries())
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in entries:
+            if size <= maxsize:
+                break
+            key = os.path.basename(path)
+            with self._open_key_lock(key) as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                os.remove(path)
+                # a process waiting on the removed lock file opens a new one, see `_lock_key`
+                os.remove(self._get_key_lock_path(key))
+            size -= entry_size
+
+    def clear(self):
+        """remove all cached files which are not pinned and reset the counters"""
+        if os.path.isdir(self._directory):
+            with self._locked():
+                self._evict(maxsize=0)
+        self._hits = 0
+        self._misses = 0
+
+    def resize(self, maxsize):
+        """change the bound of the cache, evicting files if needed"""
+        if maxsize < 1:
+            raise ValueError(f'maxsize `{maxsize}` must be a positive integer')
+
+        self._maxsize = maxsize
+        if os.path.isdir(self._directory):
+            with self._locked():
+                self._evict()
+
+    def info(self):
+        """return a `CacheInfo` with the hit and miss counters and the size in bytes"""
+        currsize = 0
+        if os.path.isdir(self._directory):
+            with self._locked():
+                currsize = sum(size for _, size, _ in self._entries())
+
+        return CacheInfo(self._hits, self._misses, self._maxsize, currsize)
@@ -1,22 +1,273 @@
 # -*- coding: utf-8 -*-
 """cluster related date types"""
 from typing import List, Union
+import contextlib
+import io
+import itertools
 import tempfile
 
+import numpy as np
 from ase import Atoms
 from icet import ClusterSpace, ClusterExpansion
 
 from aiida import orm
+from aiida.common.hashing import make_hash
+
+from .cache import LRUCache
+from .structure_db import StructureDbData
+
+
+def _cluster_space_to_bytes(cluster_space: ClusterSpace) -> bytes:
+    """serialize a icet cluster space with `ClusterSpace.write`"""
+    with tempfile.NamedTemporaryFile() as tmp_file:
+        cluster_space.write(tmp_file.name)
+        with open(tmp_file.name, 'rb') as handle:
+            return handle.read()
+
+
+def _cluster_space_from_bytes(content: bytes) -> ClusterSpace:
+    """deserialize a icet cluster space written by `ClusterSpace.write`"""
+    return ClusterSpace.read(io.BytesIO(content))
+
+
+def get_cluster_space_hash(structure: Atoms,
+                           cutoffs: List[float],
+                           chemical_symbols: Union[List[str], List[List[str]]],
+                           symprec: float = 1e-5,
+                           position_tolerance: float = None) -> str:
+    """
+    Return a canonical hash of the parameters of a cluster space.
+
+    The hash does not depend on the order of the atoms in the primitive
+    structure, and the cell, positions and cutoffs are rounded on a grid of
+    `symprec` so that numerical noise below the tolerance is ignored.
+    """
+    if all(isinstance(symbols, str) for symbols in chemical_symbols):
+        chemical_symbols = [chemical_symbols] * len(structure)
+
+    def _round(values):
+        return np.rint(np.asarray(values, dtype=float) / symprec).astype(int).tolist()
+
+    n_grid = int(round(1. / symprec))
+    scaled_positions = np.rint(structure.get_scaled_positions(wrap=True) / symprec).astype(int) % n_grid
+
+    sites = sorted(
+        (tuple(position), symbol, tuple(sorted(symbols)))
+        for position, symbol, symbols in zip(scaled_positions.tolist(), structure.get_chemical_symbols(),
+                                             chemical_symbols))
+
+    return make_hash({
+        'cell': _round(structure.cell[:]),
+        'pbc': [bool(pbc) for pbc in structure.pbc],
+        'sites': [list(site[0]) + [site[1]] + list(site[2]) for site in sites],
+        'cutoffs': _round(cutoffs),
+        'symprec': symprec,
+        'position_tolerance': position_tolerance,
+    })
+
+
+def new_cluster_expansion(cluster_space: ClusterSpace,
+                          parameters: np.ndarray,
+                          metadata: dict = None) -> ClusterExpansion:
+    """
+    Return the icet cluster expansion of `cluster_space` and `parameters`,
+    like `ClusterExpansion(cluster_space, parameters, metadata)` but on
+    `cluster_space` itself instead of a copy, which would redo its symmetry
+    analysis. `cluster_space` must not be modified in place afterwards.
+    """
+    if len(cluster_space) != len(parameters):
+        raise ValueError(f'cluster_space ({len(cluster_space)}) and parameters ({len(parameters)}) '
+                         'must have the same length')
+
+    ce = ClusterExpansion.__new__(ClusterExpansion)
+    ce._cluster_space = cluster_space  # pylint: disable=protected-access
+    ce._parameters = np.asarray(parameters)  # pylint: disable=protected-access
+    ce._metadata = dict(metadata or {})  # pylint: disable=protected-access
+    ce._add_default_metadata()  # pylint: disable=protected-access
+
+    return ce
+
+
+def _cluster_expansion_to_bytes(cluster_expansion: ClusterExpansion) -> bytes:
+    """serialize a icet cluster expansion with `ClusterExpansion.write`"""
+    with tempfile.NamedTemporaryFile() as tmp_file:
+        cluster_expansion.write(tmp_file.name)
+        with open(tmp_file.name, 'rb') as handle:
+            return handle.read()
+
+
+def _cluster_expansion_from_bytes(content: bytes) -> ClusterExpansion:
+    """deserialize a icet cluster expansion written by `ClusterExpansion.write`"""
+    with tempfile.NamedTemporaryFile() as tmp_file:
+        tmp_file.write(content)
+        tmp_file.flush()
+        return ClusterExpansion.read(tmp_file.name)
+
+
+def _iter_ase_structures(structures, selection=None):
+    """yield ase `Atoms` from a list of `StructureData` or `Atoms`, or from
+    the rows of a `StructureDbData` matching the ase db `selection`"""
+    if isinstance(structures, StructureDbData):
+        for batch in structures.iter_structures(selection, columns=[]):
+            for structure, _ in batch:
+                yield structure
+        return
+
+    for structure in structures:
+        if isinstance(structure, orm.StructureData):
+            yield structure.get_ase()
+        elif isinstance(structure, Atoms):
+            yield structure
+        else:
+            raise TypeError(f'structure of type `{type(structure)}` is neither a StructureData nor a ase Atoms')
+
+
+def _get_orbits_beyond_cutoffs(cluster_space: ClusterSpace, cutoffs: List[float]) -> List[int]:
+    """
+    return the indices of the orbits of `cluster_space` which are not part of
+    a cluster space with the smaller `cutoffs`, i.e. orbits of an order with
+    no cutoff or whose largest interatomic distance exceeds the cutoff.
+    """
+    for order, (cutoff, cutoff_max) in enumerate(itertools.zip_longest(cutoffs, cluster_space.cutoffs), start=2):
+        if cutoff_max is None or (cutoff is not None and cutoff > cutoff_max):
+            raise ValueError(f'cutoffs `{cutoffs}` are not nested in the cutoffs `{cluster_space.cutoffs}` '
+                             f'of the cluster space (order {order})')
+
+    tolerance = cluster_space.position_tolerance
+    orbits = []
+    for orbit_index in range(len(cluster_space.orbit_list)):
+        positions = np.array(cluster_space.get_coordinates_of_representative_cluster(orbit_index))
+        order = len(positions)
+        if order < 2:
+            continue
+
+        if order - 2 >= len(cutoffs):
+            orbits.append(orbit_index)
+            continue
+
+        max_distance = max(np.linalg.norm(pos_a - pos_b) for pos_a, pos_b in itertools.combinations(positions, 2))
+        if max_distance > cutoffs[order - 2] + tolerance:
+            orbits.append(orbit_index)
+
+    return orbits
+
+
+def get_cutoffs_columns(cluster_space: ClusterSpace, cutoffs: List[float]) -> np.ndarray:
+    """
+    Return the indices of the cluster vector elements of `cluster_space`
+    which make up the cluster vector of the nested cluster space with the
+    smaller `cutoffs`, read from the orbits of `cluster_space` without any
+    symmetry analysis of the nested cluster space.
+    """
+    orbits = set(_get_orbits_beyond_cutoffs(cluster_space, cutoffs))
+
+    return np.array([row['index'] for row in cluster_space.orbit_data if row['orbit_index'] not in orbits], dtype=int)
+
+
+def build_nested_cluster_space(cluster_space: ClusterSpace, cutoffs: List[float]) -> ClusterSpace:
+    """
+    Build the icet cluster space with the smaller `cutoffs` nested in
+    `cluster_space`, or return `cluster_space` itself for the same cutoffs.
+
+    The nested cluster space needs its own symmetry analysis, build it once
+    for the selected cutoffs only. Its cluster vector elements are checked to
+    be `get_cutoffs_columns(cluster_space, cutoffs)`, in the same order.
+    """
+    if list(cutoffs) == list(cluster_space.cutoffs):
+        return cluster_space
+
+    columns = get_cutoffs_columns(cluster_space, cutoffs)
+    nested = ClusterSpace(cluster_space._input_structure,  # pylint: disable=protected-access
+                          list(cutoffs),
+                          cluster_space._input_chemical_symbols,  # pylint: disable=protected-access
+                          cluster_space.symprec,
+                          cluster_space.position_tolerance)
+
+    def _orbit_keys(rows):
+        return [(row['order'], row['multiplicity'], round(float(row['radius']), 6)) for row in rows]
+
+    rows = {row['index']: row for row in cluster_space.orbit_data}
+    if _orbit_keys(nested.orbit_data) != _orbit_keys(rows[column] for column in columns):
+        raise ValueError(f'the cluster space with cutoffs `{cutoffs}` does not match the columns '
+                         f'of the cluster space with cutoffs `{cluster_space.cutoffs}`')
+
+    return nested
 
 
 class ClusterSpaceData(orm.StructureData):
-    """Data type of ClusterSpace"""
+    """Data type of ClusterSpace
+
+    The icet cluster space is built lazily and kept in a bounded in-process
+    cache shared by all instances, keyed by the node UUID once stored or by
+    the hash of the attributes for unstored nodes. Only its parameters are
+    stored: icet can not persist the orbit list, reading a serialized cluster
+    space redoes the symmetry analysis as building it does. Identical cluster
+    spaces are reused through their content hash instead.
+    """
+    _cluster_space_cache = LRUCache(maxsize=16)
+    _content_hash_extra = 'cluster_space_hash'
+
     def __init__(self, **kwargs):
         """
         init
         """
         super().__init__(**kwargs)
 
+    @classmethod
+    def cache_info(cls):
+        """return the hits, misses and size of the cluster space cache"""
+        return cls._cluster_space_cache.info()
+
+    @classmethod
+    def cache_clear(cls):
+        """drop all cached cluster spaces and reset the counters"""
+        cls._cluster_space_cache.clear()
+
+    @property
+    def _cache_key(self):
+        """key of this node in the cluster space cache"""
+        if self.is_stored:
+            return self.uuid
+
+        return make_hash(self.attributes)
+
+    def _invalidate_cluster_space(self):
+        """remove the cached cluster space of this node"""
+        self._cluster_space_cache.pop(self._cache_key)
+
+    def store(self, with_transaction=True, **kwargs):  # pylint: disable=arguments-differ
+        """store the node and move its cached cluster space under the UUID"""
+        key = self._cache_key
+        super().store(with_transaction=with_transaction, **kwargs)
+
+        cs = self._cluster_space_cache.pop(key)
+        if cs is not None:
+            self._cluster_space_cache.put(self._cache_key, cs)
+
+        if self.get_extra(self._content_hash_extra, None) is None:
+            self.set_extra(self._content_hash_extra, self.get_content_hash())
+
+        return self
+
+    def get_content_hash(self):
+        """return the canonical hash of the cluster space parameters,
+        see `get_cluster_space_hash`"""
+        return get_cluster_space_hash(self.get_ase(),
+                                      cutoffs=self.get_attribute('cutoffs'),
+                                      chemical_symbols=self.get_attribute('chemical_symbols'),
+                                      symprec=self.get_attribute('symprec'),
+                                      position_tolerance=self.get_attribute('position_tolerance'))
+
+    @classmethod
+    def find_by_content_hash(cls, content_hash):
+        """return a stored cluster space with the given content hash, or None"""
+        query = orm.QueryBuilder()
+        query.append(cls, tag='cluster_space', filters={f'extras.{cls._content_hash_extra}': content_hash})
+        query.order_by({'cluster_space': {'ctime': 'asc'}})
+        result = query.first()
+
+        return result[0] if result else None
+
     def set(self,
             cutoffs: List[float],
             chemical_symbols: Union[List[str], List[List[str]]],
@@ -24,6 +275,8 @@ class ClusterSpaceData(orm.StructureData):
             symprec: float = 1e-5,
             position_tolerance: float = None):
         """set the parameters of the cluster space"""
+        self._invalidate_cluster_space()
+
         if ase:
             # set or reset ase
             self.set_ase(ase)
@@ -35,7 +288,17 @@ class ClusterSpaceData(orm.StructureData):
 
     @property
     def _cluster_space(self):
-        """this give cluster space of icet type"""
+        """this give cluster space of icet type, built once and then cached"""
+        key = self._cache_key
+        cs = self._cluster_space_cache.get(key)
+        if cs is None:
+            cs = self._build_cluster_space()
+        self._cluster_space_cache.put(key, cs)
+
+        return cs
+
+    def _build_cluster_space(self):
+        """run the symmetry analysis and return a new icet cluster space"""
         ase = self.get_ase()
         cutoffs = self.get_attribute('cutoffs')
         chemical_symbols = self.get_attribute('chemical_symbols')
@@ -52,9 +315,87 @@ class ClusterSpaceData(orm.StructureData):
         self._cluster_space.print_overview()
 
     def get_noumenon(self):
-        """return the icet type cluster space"""
+        """return the icet type cluster space
+
+        The object is shared through the in-process cache, use its `copy()`
+        before modifying it in place (e.g. pruning).
+        """
         return self._cluster_space
 
+    def get_content(self):
+        """return the cluster space serialized by `ClusterSpace.write`"""
+        return _cluster_space_to_bytes(self._cluster_space)
+
+    def get_build_parameters(self):
+        """return the json serializable parameters of the cluster space, built
+        from them by `aiida_ce.tasks.build_cluster_space` in another process"""
+        ase = self.get_ase()
+
+        return {
+            'structure': {
+                'numbers': ase.numbers.tolist(),
+                'positions': ase.positions.tolist(),
+                'cell': ase.cell[:].tolist(),
+                'pbc': ase.pbc.tolist(),
+            },
+            'cutoffs': self.get_attribute('cutoffs'),
+            'chemical_symbols': self.get_attribute('chemical_symbols'),
+            'symprec': self.get_attribute('symprec'),
+            'position_tolerance': self.get_attribute('position_tolerance'),
+        }
+
+    def get_cluster_vectors(self, structures, n_workers=None, chunk_size=100, selection=None):
+        """
+        Compute the cluster vectors of many structures in a process pool.
+
+        :param structures: list of `StructureData` or ase `Atoms`, or a `StructureDbData`
+        :param selection: ase db selection of the rows if `structures` is a `StructureDbData`
+        :param n_workers: number of worker processes, all cores by default, 1 to run in this process.
+            No more workers than chunks are started, a single chunk is computed in this process.
+        :param chunk_size: number of structures sent to a worker at once
+        :return: an unstored `ArrayData` with the 2-D array `cluster_vectors`,
+            one row per structure in the input order
+        """
+        from aiida_ce.parallel import compute_cluster_vectors
+
+        cluster_vectors = compute_cluster_vectors(self._cluster_space,
+                                                  _iter_ase_structures(structures, selection),
+                                                  n_workers=n_workers,
+                                                  chunk_size=chunk_size)
+
+        array = orm.ArrayData()
+        array.set_array('cluster_vectors', cluster_vectors)
+
+        return array
+
+    def get_cutoffs_columns(self, cutoffs):
+        """
+        Return the indices of the cluster vector elements which make up the
+        cluster vector of the nested cluster space with the smaller `cutoffs`.
+
+        Cluster vectors of the nested cluster space are therefore the columns
+        subset `cluster_vectors[:, columns]` of those of this cluster space,
+        see `get_cutoffs_columns`.
+        """
+        return get_cutoffs_columns(self._cluster_space, cutoffs)
+
+    def get_nested_cluster_space(self, cutoffs):
+        """
+        Return an unstored `ClusterSpaceData` with the smaller `cutoffs` and
+        the other parameters of this one.
+
+        Like any `ClusterSpaceData` it is built on first use only, by its own
+        symmetry analysis, see `build_nested_cluster_space`.
+        """
+        nested = ClusterSpaceData()
+        nested.set(ase=self.get_ase(),
+                   cutoffs=list(cutoffs),
+                   chemical_symbols=self.get_attribute('chemical_symbols'),
+                   symprec=self.get_attribute('symprec'),
+                   position_tolerance=self.get_attribute('position_tolerance'))
+
+        return nested
+
     def set_from_cluster_space(self, cluster_space):
         """set from a icet type cluster space"""
         ase = cluster_space.primitive_structure
@@ -69,19 +410,84 @@ class ClusterSpaceData(orm.StructureData):
                  symprec=symprec,
                  position_tolerance=position_tolerance)
 
+        # no need to redo the symmetry analysis for the given cluster space
+        self.set_cached_cluster_space(cluster_space)
+
+    def set_cached_cluster_space(self, cluster_space):
+        """cache the icet `cluster_space` built from the parameters of this node, e.g. by another node"""
+        self._cluster_space_cache.put(self._cache_key, cluster_space)
+
+
+class ClusterExpansionData(orm.ArrayData):
+    """Data type of ClusterExpansion
+
+    The deserialized icet cluster expansion is kept in a bounded in-process
+    cache shared by all instances and keyed by the node UUID.
+    The non-zero parameters are also stored as the arrays `eci_indices` and
+    `eci_values`, with their count in the `n_nonzero_parameters` attribute.
+    """
+    _cluster_expansion_cache = LRUCache(maxsize=8)
+
+    @classmethod
+    def cache_info(cls):
+        """return the hits, misses and size of the cluster expansion cache"""
+        return cls._cluster_expansion_cache.info()
+
+    @classmethod
+    def cache_clear(cls):
+        """drop all cached cluster expansions and reset the counters"""
+        cls._cluster_expansion_cache.clear()
+
+    _filename = 'stored.ce'
 
-class ClusterExpansionData(orm.Data):
-    """Data type of ClusterExpansion"""
     def set(self, cluster_space, parameters, metadata=None):
-        """set cluster expansion after initial create it"""
-        ce = ClusterExpansion(cluster_space, parameters, metadata)
+        """set the cluster expansion of `cluster_space`, which is not copied, see `new_cluster_expansion`"""
+        self.set_from_cluster_expansion(new_cluster_expansion(cluster_space, parameters, metadata))
+
+    def set_from_cluster_expansion(self, cluster_expansion):
+        """set from a icet type cluster expansion, which is kept in the cache"""
+        stream = io.BytesIO(_cluster_expansion_to_bytes(cluster_expansion))
+        self._put_content(stream, cluster_expansion.parameters)
+        self._cluster_expansion_cache.put((self.uuid, False), cluster_expansion)
+
+    def set_file(self, path, parameters):
+        """
+        set from the file `path` written by `ClusterExpansion.write` and its
+        `parameters`, without reading it, which would redo the symmetry
+        analysis of its cluster space
+        """
+        with open(path, 'rb') as handle:
+            self._put_content(handle, parameters)
+
+    def _put_content(self, handle, parameters):
+        """put the serialized cluster expansion of `handle` in the repository"""
+        self.set_attribute('filename', self._filename)
+        self.put_object_from_filelike(handle, self._filename, mode='wb', encoding=None)
+        self._set_parameters(parameters)
+
+        self._cluster_expansion_cache.pop((self.uuid, True))
+        self._cluster_expansion_cache.pop((self.uuid, False))
 
-        filename = 'stored.ce'
-        self.set_attribute('filename', filename)
+    def _set_parameters(self, parameters):
+        """store the non-zero parameters in sparse form"""
+        parameters = np.asarray(parameters, dtype=float)
+        indices = np.flatnonzero(parameters)
 
-        tmp_file = tempfile.NamedTemporaryFile()
-        ce.write(tmp_file.name)
-        self.put_object_from_file(tmp_file.name, filename)
+        self.set_array('eci_indices', indices)
+        self.set_array('eci_values', parameters[indices])
+        self.set_attribute('n_parameters', len(parameters))
+        self.set_attribute('n_nonzero_parameters', len(indices))
+
+    def get_parameters(self):
+        """return the full parameter vector from its sparse form, or from the
+        cluster expansion file for nodes stored without it"""
+        if self.get_attribute('n_parameters', None) is None:
+            return np.array(self.get_noumenon().parameters, dtype=float)
+
+        parameters = np.zeros(self.get_attribute('n_parameters'))
+        parameters[self.get_array('eci_indices')] = self.get_array('eci_values')
+
+        return parameters
 
     @property
     def filename(self):
@@ -91,18 +497,158 @@ class ClusterExpansionData(orm.Data):
         """
         return self.get_attribute('filename')
 
+    def _get_cluster_expansion(self, pruned=False):
+        """
+        get the cluster expansion from store file, read once and then cached.
+
+        If `pruned`, the orbits with zero parameters are removed from the
+        cluster expansion, so they are not computed when evaluating it.
+        """
+        ce = getattr(self, '_loaded_cluster_expansions', {}).get(pruned)
+        if ce is not None:
+            return ce
+
+        key = (self.uuid, pruned)
+        ce = self._cluster_expansion_cache.get(key)
+        if ce is None:
+            ce = _cluster_expansion_from_bytes(self._get_content())
+            if pruned:
+                ce.prune()
+            self._cluster_expansion_cache.put(key, ce)
+
+        return ce
+
     @property
     def _cluster_expansion(self):
         """get the cluster expansion from store file"""
+        return self._get_cluster_expansion()
+
+    @contextlib.contextmanager
+    def loaded(self, pruned=False):
+        """
+        Context in which the cluster expansion of this node is kept on the
+        instance, independently of evictions from the shared cache::
+
+            with ce_data.loaded() as ce:
+                energies = [ce.predict(structure) for structure in structures]
+        """
+        if not hasattr(self, '_loaded_cluster_expansions'):
+            self._loaded_cluster_expansions = {}
+
+        previous = self._loaded_cluster_expansions.get(pruned)
+        self._loaded_cluster_expansions[pruned] = self._get_cluster_expansion(pruned)
+        try:
+            yield self._loaded_cluster_expansions[pruned]
+        finally:
+            self._loaded_cluster_expansions[pruned] = previous
+
+    def _get_content(self):
+        """return the stored cluster expansion file as bytes"""
         with self.open(self.filename, mode='rb') as handle:
-            file_abs_path = handle.name  # pylint: disable=no-member
+            return handle.read()
+
+    def _get_cluster_space_content(self):
+        """return the cluster space of the (unpruned) cluster expansion serialized by `ClusterSpace.write`"""
+        return _cluster_space_to_bytes(self._get_cluster_expansion()._cluster_space)  # pylint: disable=protected-access
+
+    def get_cluster_space(self):
+        """return a copy of the icet cluster space of the (unpruned) cluster expansion"""
+        return _cluster_space_from_bytes(self._get_cluster_space_content())
+
+    def get_cluster_space_data(self):
+        """
+        Return a stored `ClusterSpaceData` of the cluster space of the
+        (unpruned) cluster expansion, an identical one if already stored.
+
+        The cluster space of the cached cluster expansion is put in its cache,
+        it is not analysed again nor copied.
+        """
+        cluster_space = self._get_cluster_expansion()._cluster_space  # pylint: disable=protected-access
+
+        cs_data = ClusterSpaceData()
+        cs_data.set_from_cluster_space(cluster_space)
+        stored = ClusterSpaceData.find_by_content_hash(cs_data.get_content_hash())
+        if stored is None:
+            return cs_data.store()
+
+        stored.set_cached_cluster_space(cluster_space)
+        return stored
+
+    @property
+    def predecessor(self):
+        """the cluster expansion this one was retrained from, None if trained from scratch"""
+        predecessor_uuid = self.get_attribute('predecessor_uuid', None)
+        if predecessor_uuid is None:
+            return None
 
-        return ClusterExpansion.read(file_abs_path)
+        return orm.load_node(predecessor_uuid)
+
+    def predict_many(self,
+                     structures,
+                     n_workers=None,
+                     chunk_size=100,
+                     selection=None,
+                     as_array_data=False,
+                     pruned=False):
+        """
+        Predict the property of many structures, with the cluster vectors
+        computed in a process pool and contracted with the parameters chunk by chunk.
+        The cluster expansion is loaded once for the whole prediction, its cluster
+        space is inherited by forked workers and otherwise serialized once.
+
+        :param structures: list of `StructureData` or ase `Atoms`, or a `StructureDbData`
+        :param n_workers: number of worker processes, all cores by default, 1 to run in this process.
+            No more workers than chunks are started, a single chunk is computed in this process.
+        :param chunk_size: number of structures sent to a worker at once
+        :param selection: ase db selection of the rows if `structures` is a `StructureDbData`
+        :param as_array_data: return an unstored `ArrayData` with the array `predictions` instead
+        :param pruned: only compute the orbits with non-zero parameters
+        :return: 1-D array of the predictions in the input order
+        """
+        from aiida_ce.parallel import iter_cluster_vectors
+
+        with self.loaded(pruned) as ce:
+            blocks = [
+                cluster_vectors @ ce.parameters for cluster_vectors in iter_cluster_vectors(
+                    ce._cluster_space,  # pylint: disable=protected-access
+                    _iter_ase_structures(structures, selection),
+                    n_workers=n_workers,
+                    chunk_size=chunk_size)
+            ]
+        predictions = np.concatenate(blocks) if blocks else np.empty(0)
+
+        if as_array_data:
+            array = orm.ArrayData()
+            array.set_array('predictions', predictions)
+            return array
+
+        return predictions
+
+    def get_local_evaluator(self, supercell, scaling=None):
+        """
+        Return a `LocalEnergyEvaluator` for the flips and swaps of the sites
+        of `supercell`, based on the pruned cluster expansion.
+
+        :param supercell: `StructureData` or ase `Atoms` with the initial occupations
+        :param scaling: factor applied to the per-site value, the number of sites by default
+        """
+        from aiida_ce.evaluator import LocalEnergyEvaluator
+
+        if isinstance(supercell, orm.StructureData):
+            supercell = supercell.get_ase()
+
+        return LocalEnergyEvaluator(self.get_noumenon(pruned=True), supercell, scaling=scaling)
 
     def print_overview(self):
         """print overview of cluster expansion"""
         return self._cluster_expansion.print_overview()
 
-    def get_noumenon(self):
-        """get icet type cluster expansion"""
-        return self._cluster_expansion
+    def get_noumenon(self, pruned=False):
+        """get icet type cluster expansion
+
+        With `pruned` the orbits with zero parameters are removed, which
+        makes the evaluation faster for sparse (e.g. lasso) expansions.
+        The object is shared through the in-process cache and should not be
+        modified in place.
+        """
+        return self._get_cluster_expansion(pruned)
@@ -3,30 +3,666 @@
 AiiDA class in plugin aiida-ce store the collection of
 structures.
 """
+import hashlib
+import itertools
+import numbers
+import operator
 import os
+import pathlib
+import shutil
+import sqlite3
+import tempfile
+
+import numpy as np
+from ase.db.sqlite import SQLite3Database
 
 from aiida import orm
 
+from .cache import FileCache
+
+# environment variables to configure the cache of materialized db files
+CACHE_DIR_ENV = 'AIIDA_CE_CACHE_DIR'
+CACHE_MAXSIZE_ENV = 'AIIDA_CE_CACHE_MAXSIZE'
+DEFAULT_CACHE_MAXSIZE = 2 * 1024**3
+
+# columns of the ase db rows needed to create the `Atoms`
+_STRUCTURE_COLUMNS = ['id', 'numbers', 'positions', 'cell', 'pbc']
+
+# comparison operators of ase db selections
+_OPS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '=': operator.eq,
+    '>=': operator.ge,
+    '>': operator.gt,
+    '!=': operator.ne,
+}
+
+
+def _get_file_hash(file):
+    """return the sha256 hexdigest of the content of `file`"""
+    sha256 = hashlib.sha256()
+    with open(file, 'rb') as handle:
+        for block in iter(lambda: handle.read(1024**2), b''):
+            sha256.update(block)
+
+    return sha256.hexdigest()
+
+
+def _normalize_row(row):
+    """
+    return `(atoms, key_value_pairs, data)` of a row given as ase `Atoms`,
+    `AtomsRow` or tuple `(atoms, key_value_pairs[, data])`, the key-value
+    pairs and data of an `AtomsRow` are kept unless given.
+    """
+    from ase.db.row import AtomsRow
+
+    atoms, key_value_pairs, data = (tuple(row) + (None, None))[:3] if isinstance(row, tuple) else (row, None, None)
+    if isinstance(atoms, AtomsRow):
+        key_value_pairs = atoms.key_value_pairs if key_value_pairs is None else key_value_pairs
+        data = getattr(atoms, 'data', {}) if data is None else data
+
+    return atoms, key_value_pairs or {}, data or {}
+
+
+def _write_rows(db, rows):
+    """write `rows` (see `_normalize_row`) to the ase `db` in one transaction"""
+    with db:
+        for row in rows:
+            atoms, key_value_pairs, data = _normalize_row(row)
+            db.write(atoms, key_value_pairs=key_value_pairs, data=data)
+
+
+def _get_fingerprint(cluster_vector, decimals=8):
+    """return the fingerprint of a configuration, a hash of its rounded cluster vector"""
+    # adding 0. turns -0. into 0.
+    rounded = np.round(np.asarray(cluster_vector, dtype=float), decimals) + 0.
+    return hashlib.sha256(rounded.tobytes()).hexdigest()[:32]
+
+
+def _write_db_file(db_file, rows, batch_size=10000):
+    """write `rows` to the new ase db file `db_file`, one transaction per batch of `batch_size` rows"""
+    from ase.db import connect
+    from aiida_ce.parallel import chunked
+
+    db = connect(db_file, type='db')
+    for batch in chunked(rows, batch_size):
+        _write_rows(db, batch)
+
+
+def _get_key_value_pairs(info, keys=None):
+    """
+    return the entries of `atoms.info` which can be stored as ase db key-value
+    pairs, or the entries `keys` (raising if one of them can not be stored).
+    """
+    from ase.db.core import reserved_keys
+
+    key_value_pairs = {}
+    for key in info if keys is None else keys:
+        value = info.get(key)
+        if isinstance(value, (bool, np.bool_)):
+            value = bool(value)
+        elif isinstance(value, numbers.Real):
+            value = value.item() if isinstance(value, np.generic) else value
+        elif not isinstance(value, str):
+            value = None
+
+        if value is None or not key.isidentifier() or key in reserved_keys:
+            if keys is not None:
+                raise ValueError(f'`{key}` of the structure info can not be stored as a key-value pair')
+            continue
+        key_value_pairs[key] = value
+
+    return key_value_pairs
+
+
+def _merge_indices(first, second):
+    """concatenate two columnar indices, filling the keys missing in one of them"""
+    species = first['species'] + [symbol for symbol in second['species'] if symbol not in first['species']]
+
+    def get_composition(index):
+        composition = np.zeros((len(index['ids']), len(species)), dtype=int)
+        for column, symbol in enumerate(index['species']):
+            composition[:, species.index(symbol)] = index['composition'][:, column]
+        return composition
+
+    def merge_columns(name, fill):
+        return {
+            key: np.concatenate([
+                index[name].get(key, np.full(len(index['ids']), fill, dtype=float if name == 'properties' else str))
+                for index in (first, second)
+            ]) for key in sorted(set(first[name]) | set(second[name]))
+        }
+
+    return {
+        'ids': np.concatenate([first['ids'], second['ids']]),
+        'natoms': np.concatenate([first['natoms'], second['natoms']]),
+        'species': species,
+        'composition': np.vstack([get_composition(first), get_composition(second)]),
+        'properties': merge_columns('properties', np.nan),
+        'text': merge_columns('text', ''),
+    }
+
+
+class _ReadOnlyDatabase(SQLite3Database):
+    """
+    ase sqlite db of a cached db file, connected with `mode=ro` and whose
+    writing methods raise, which keeps the cache entry of the file pinned
+    as long as it is referenced.
+    """
+    def __init__(self, entry):
+        super().__init__(entry.path, create_indices=False)
+        self._cache_entry = entry
+
+    def _connect(self):
+        return sqlite3.connect(f'{pathlib.Path(self.filename).as_uri()}?mode=ro', uri=True, timeout=20)
+
+    def _read_only(self, *args, **kwargs):
+        """reject any modification of the db"""
+        raise PermissionError(f'the db `{self.filename}` is a read-only copy of a repository file')
+
+    write = reserve = update = delete = _read_only
+
 
 class StructureDbData(orm.ArrayData):
     """
     StructureSet stores a collection of structures and stores
     the energy labeling as an ase db file stored in repository.
+
+    The db file is materialized once into a local cache directory shared by
+    all processes, keyed by its content hash, and opened read-only from there.
+
+    When the node is stored, a columnar index of the rows is extracted into
+    arrays: `index_ids`, `index_natoms`, the `index_composition` counts of the
+    `index_species` attribute, `property_<key>` for the numeric key-value
+    pairs (NaN where missing) and `text_<key>` for the others (empty where
+    missing). Counting, selecting and reading properties use the index
+    without opening the db file.
+
+    A node created by `extend` only stores the appended rows (a shard) and
+    references its parent by the `parent_uuid` attribute, the reads merge
+    the rows of the whole chain of shards. Row ids of a shard are shifted by
+    the largest id of its parent (`id_offset`), and `compact` folds a chain
+    into a single db file.
     """
+    _file_cache = None
+
     def __init__(self, db_file=None, **kwargs):
         super().__init__(**kwargs)
         if db_file is not None:
             self.set_from_db_file(db_file)
 
-    def get_db(self):
-        """get the ase sqlsqlit db"""
+    @classmethod
+    def get_file_cache(cls):
+        """
+        return the cache of materialized db files, in the directory
+        `$AIIDA_CE_CACHE_DIR` (by default `cache/aiida-ce` of the AiiDA
+        configuration folder) and bounded to `$AIIDA_CE_CACHE_MAXSIZE` bytes.
+        """
+        if cls._file_cache is None:
+            directory = os.environ.get(CACHE_DIR_ENV)
+            if directory is None:
+                from aiida.manage.configuration.settings import AIIDA_CONFIG_FOLDER
+                directory = os.path.join(AIIDA_CONFIG_FOLDER, 'cache', 'aiida-ce')
+            maxsize = int(os.environ.get(CACHE_MAXSIZE_ENV, DEFAULT_CACHE_MAXSIZE))
+            StructureDbData._file_cache = FileCache(directory, maxsize)
+
+        return cls._file_cache
+
+    @classmethod
+    def set_file_cache(cls, directory, maxsize=DEFAULT_CACHE_MAXSIZE):
+        """use the cache directory `directory` for the materialized db files"""
+        StructureDbData._file_cache = FileCache(directory, maxsize)
+
+    def _get_cache_key(self):
+        """name of the db file in the cache, its content hash"""
+        # nodes created before the hash was recorded are immutable once stored
+        content_hash = self.get_attribute('db_hash', None) or self.uuid
+        return f'{content_hash}.db'
+
+    def _copy_db_file(self, path):
+        """copy the db file of this node (its shard) to `path`"""
+        with self.open(self.get_attribute('filename'), mode='rb') as source:
+            with open(path, 'wb') as handle:
+                shutil.copyfileobj(source, handle)
+
+    def _get_shard_db(self):
+        """the read-only ase db of the rows stored in this node only"""
+        return _ReadOnlyDatabase(self.get_file_cache().pin(self._get_cache_key(), self._copy_db_file))
+
+    @property
+    def parent(self):
+        """the `StructureDbData` extended by this node, None for the root of a chain"""
+        parent_uuid = self.get_attribute('parent_uuid', None)
+        if parent_uuid is None:
+            return None
+
+        return orm.load_node(parent_uuid)
+
+    def get_shards(self):
+        """return the nodes of the chain of shards, from the root to this node"""
+        shards = [self]
+        while shards[-1].parent is not None:
+            shards.append(shards[-1].parent)
+
+        return shards[::-1]
+
+    def _write_merged_db_file(self, path):
+        """write the rows of the whole chain of shards to the db file `path`"""
         from ase.db import connect
 
-        filename = self.get_attribute('filename')
-        with self.open(filename, mode='rb') as handle:
-            abs_path = handle.name  # pylint: disable=no-member
+        root, *shards = self.get_shards()
+        root._copy_db_file(path)  # pylint: disable=protected-access
+
+        db = connect(path, type='db')
+        for shard in shards:
+            _write_rows(db, shard._get_shard_db().select())  # pylint: disable=protected-access
+
+    def pin_db_file(self):
+        """
+        return the pinned `CacheEntry` of the local read-only copy of the db
+        file, merged along the chain of shards. The file is not evicted from
+        the cache until the entry is released::
+
+            with structure_db.pin_db_file() as entry:
+                shutil.copy(entry.path, destination)
+        """
+        if self.parent is None:
+            return self.get_file_cache().pin(self._get_cache_key(), self._copy_db_file)
+
+        keys = [shard._get_cache_key() for shard in self.get_shards()]  # pylint: disable=protected-access
+        content_hash = hashlib.sha256(''.join(keys).encode()).hexdigest()
+        return self.get_file_cache().pin(f'merged-{content_hash}.db', self._write_merged_db_file)
+
+    def get_db(self):
+        """get the ase sqlite db, a read-only connection to the cached copy of the
+        db file which stays in the cache as long as the db object is referenced"""
+        return _ReadOnlyDatabase(self.pin_db_file())
+
+    def extend(self, rows, cluster_space=None):
+        """
+        Return a new `StructureDbData` with `rows` appended to the rows of
+        this stored node, which only stores the new rows.
+
+        With `cluster_space`, rows whose fingerprint (see `deduplicate`) is
+        already in the db or earlier in `rows` are skipped, their number is
+        kept in the `n_duplicates` attribute of the new node. The fingerprints
+        of the new rows are stored with them, in their `fingerprint` key.
+
+        :param rows: iterable of ase `Atoms`, `AtomsRow` or `(Atoms, key_value_pairs)` tuples
+        :param cluster_space: `ClusterSpaceData` defining the fingerprints
+        """
+        from ase.db.row import AtomsRow
+
+        if not self.is_stored:
+            raise ValueError('only a stored StructureDbData can be extended')
+
+        n_duplicates = 0
+        if cluster_space is not None:
+            known = set(self.get_fingerprints(cluster_space))
+            cs = cluster_space.get_noumenon()
+
+            def iter_unique_rows(rows):
+                nonlocal n_duplicates
+                for atoms, key_value_pairs, data in map(_normalize_row, rows):
+                    structure = atoms.toatoms() if isinstance(atoms, AtomsRow) else atoms
+                    fingerprint = _get_fingerprint(cs.get_cluster_vector(structure))
+                    if fingerprint in known:
+                        n_duplicates += 1
+                        continue
+                    known.add(fingerprint)
+                    yield atoms, dict(key_value_pairs, fingerprint=fingerprint), data
+
+            rows = iter_unique_rows(rows)
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            shard_file = os.path.join(dirpath, 'shard.db')
+            _write_db_file(shard_file, rows)
+            extended = StructureDbData(shard_file)
+
+        extended.set_attribute('parent_uuid', self.uuid)
+        extended.set_attribute('id_offset', int(self.get_index()['ids'].max(initial=0)))
+        if cluster_space is not None:
+            extended.set_attribute('fingerprint_cluster_space', cluster_space.get_content_hash())
+            extended.set_attribute('n_duplicates', n_duplicates)
+
+        return extended
+
+    def get_fingerprints(self, cluster_space, n_workers=None, chunk_size=100):
+        """
+        Return the fingerprints of all the rows (in the order of the index),
+        hashes of their cluster vectors in `cluster_space`, which are the same
+        for symmetry equivalent configurations.
 
-        return connect(abs_path, type='db')
+        The fingerprints are read shard by shard, see `_get_shard_fingerprints`,
+        so extending a chain only computes those of the new rows.
+
+        :param cluster_space: `ClusterSpaceData` defining the fingerprints
+        """
+        # pylint: disable=protected-access
+        return np.concatenate([
+            shard._get_shard_fingerprints(cluster_space, n_workers=n_workers, chunk_size=chunk_size)
+            for shard in self.get_shards()
+        ])
+
+    def _get_shard_fingerprints(self, cluster_space, n_workers=None, chunk_size=100):
+        """
+        return the fingerprints of the rows stored in this node only: those
+        stored in their `fingerprint` key (by `extend` or `deduplicate`) if
+        from the same cluster space, otherwise the cluster vectors are computed
+        in a process pool, once, and the fingerprints kept in the file cache
+        """
+        from aiida_ce.parallel import iter_cluster_vectors
+
+        content_hash = cluster_space.get_content_hash()
+        # extended nodes stored before the index was kept per shard hold the merged index
+        if self.parent is None or self.get_attribute('index_of_shard', False):
+            stored = self._get_shard_index()['text'].get('fingerprint')
+            if (stored is not None and np.all(stored != '') and
+                    self.get_attribute('fingerprint_cluster_space', None) == content_hash):
+                return stored
+
+        def write(path):
+            rows = self._get_shard_db().select(include_data=False, columns=_STRUCTURE_COLUMNS)
+            fingerprints = [
+                _get_fingerprint(cluster_vector) for cluster_vectors in iter_cluster_vectors(
+                    cluster_space.get_noumenon(), (row.toatoms() for row in rows),
+                    n_workers=n_workers, chunk_size=chunk_size)
+                for cluster_vector in cluster_vectors
+            ]
+            with open(path, 'wb') as handle:
+                np.save(handle, np.array(fingerprints, dtype=str))
+
+        db_key = os.path.splitext(self._get_cache_key())[0]
+        with self.get_file_cache().pin(f'fingerprints-{db_key}-{content_hash}.npy', write) as entry:
+            return np.load(entry.path)
+
+    def deduplicate(self, cluster_space, n_workers=None):
+        """
+        Return a new `StructureDbData` with one row per fingerprint (see
+        `get_fingerprints`), the first of every group of duplicates, and the
+        fingerprint stored in its `fingerprint` key.
+
+        :param cluster_space: `ClusterSpaceData` defining the fingerprints
+        :return: tuple of the new node and an `ArrayData` mapping the `ids` of
+            all the rows to the id of the row kept for their group, in this
+            node (`group_ids`) and in the new node (`deduplicated_ids`)
+        """
+        fingerprints = self.get_fingerprints(cluster_space, n_workers=n_workers)
+
+        # position of the first row of every fingerprint, a dict lookup per row
+        first = {}
+        groups = [first.setdefault(fingerprint, index) for index, fingerprint in enumerate(fingerprints)]
+        groups = np.array(groups, dtype=int)
+        is_kept = groups == np.arange(len(groups))
+
+        def iter_unique_rows():
+            # pylint: disable=protected-access
+            rows = itertools.chain.from_iterable(shard._get_shard_db().select() for shard in self.get_shards())
+            for position, row in enumerate(rows):
+                if is_kept[position]:
+                    yield row, dict(row.key_value_pairs, fingerprint=fingerprints[position])
+
+        deduplicated = StructureDbData()
+        deduplicated._set_from_rows(iter_unique_rows())  # pylint: disable=protected-access
+        deduplicated.set_attribute('fingerprint_cluster_space', cluster_space.get_content_hash())
+
+        ids = self.get_index()['ids']
+        mapping = orm.ArrayData()
+        mapping.set_array('ids', ids)
+        mapping.set_array('group_ids', ids[groups])
+        mapping.set_array('deduplicated_ids', np.cumsum(is_kept)[groups])
+
+        return deduplicated, mapping
+
+    def compact(self):
+        """return a new `StructureDbData` storing the rows of the whole chain of shards in one db file"""
+        with tempfile.TemporaryDirectory() as dirpath:
+            db_file = os.path.join(dirpath, 'structures.db')
+            self._write_merged_db_file(db_file)
+            compacted = StructureDbData(db_file)
+
+        if self.is_stored:
+            compacted.set_attribute('compacted_from', self.uuid)
+
+        return compacted
+
+    def store(self, with_transaction=True, **kwargs):  # pylint: disable=arguments-differ
+        """extract the columnar index of the rows of the db file and store the node"""
+        if not self.is_stored and self.get_attribute('filename', None) is not None and not self.has_index:
+            self._set_index(self._build_shard_index())
+            self.set_attribute('n_structures', len(self.get_index()['ids']))
+
+        return super().store(with_transaction=with_transaction, **kwargs)
+
+    @property
+    def has_index(self):
+        """whether the columnar index is stored on the node"""
+        return self.get_attribute('index_species', None) is not None
+
+    def _build_shard_index(self):
+        """read the columnar index of the rows stored in this node"""
+        id_offset = self.get_attribute('id_offset', 0)
+        ids, natoms, compositions, key_value_pairs = [], [], [], []
+        for row in self._get_shard_db().select(include_data=False):
+            ids.append(row.id + id_offset)
+            natoms.append(row.natoms)
+            compositions.append(dict(zip(*np.unique(row.numbers, return_counts=True))))
+            key_value_pairs.append(row.key_value_pairs)
+
+        species_numbers = sorted({number for composition in compositions for number in composition})
+        composition = np.array([[composition.get(number, 0) for number in species_numbers]
+                                for composition in compositions],
+                               dtype=int).reshape(len(ids), len(species_numbers))
+
+        properties, text = {}, {}
+        for key in sorted({key for pairs in key_value_pairs for key in pairs}):
+            values = [pairs.get(key) for pairs in key_value_pairs]
+            if all(value is None or isinstance(value, numbers.Real) for value in values):
+                properties[key] = np.array([np.nan if value is None else value for value in values], dtype=float)
+            else:
+                text[key] = np.array(['' if value is None else str(value) for value in values], dtype=str)
+
+        from ase.data import chemical_symbols
+
+        return {
+            'ids': np.array(ids, dtype=int),
+            'natoms': np.array(natoms, dtype=int),
+            'species': [chemical_symbols[number] for number in species_numbers],
+            'composition': composition,
+            'properties': properties,
+            'text': text,
+        }
+
+    def _set_index(self, index):
+        """store the columnar index of the rows of this shard in arrays and attributes of the node"""
+        self.set_array('index_ids', index['ids'])
+        self.set_array('index_natoms', index['natoms'])
+        self.set_array('index_composition', index['composition'])
+        for key, values in index['properties'].items():
+            self.set_array(f'property_{key}', values)
+        for key, values in index['text'].items():
+            self.set_array(f'text_{key}', values)
+
+        self.set_attribute('index_species', index['species'])
+        self.set_attribute('index_properties', sorted(index['properties']))
+        self.set_attribute('index_text_keys', sorted(index['text']))
+        self.set_attribute('index_of_shard', True)
+        self._index = None
+
+    def _delete_index(self):
+        """remove the columnar index of a previous db file"""
+        self._index = None
+        if not self.has_index:
+            return
+
+        for name in self.get_arraynames():
+            if name.startswith(('index_', 'property_', 'text_')):
+                self.delete_array(name)
+        for key in ('index_species', 'index_properties', 'index_text_keys', 'index_of_shard', 'n_structures'):
+            if key in self.attributes:
+                self.delete_attribute(key)
+
+    def _get_shard_index(self):
+        """return the columnar index of the rows of this shard, from the node or the db file"""
+        if not self.has_index:
+            return self._build_shard_index()
+
+        return {
+            'ids': self.get_array('index_ids'),
+            'natoms': self.get_array('index_natoms'),
+            'species': self.get_attribute('index_species'),
+            'composition': self.get_array('index_composition'),
+            'properties': {key: self.get_array(f'property_{key}') for key in self.get_attribute('index_properties')},
+            'text': {key: self.get_array(f'text_{key}') for key in self.get_attribute('index_text_keys')},
+        }
+
+    def get_index(self):
+        """
+        return the columnar index as a dict of `ids`, `natoms`, `species`,
+        `composition` and the dicts `properties` and `text` of arrays, merged
+        along the chain of shards and read once from the nodes (or from the db
+        file of a node which has no index).
+        """
+        index = getattr(self, '_index', None)
+        if index is not None:
+            return index
+
+        index = self._get_shard_index()
+        # extended nodes stored before the index was kept per shard hold the merged index
+        is_merged = self.has_index and not self.get_attribute('index_of_shard', False)
+        if self.parent is not None and not is_merged:
+            index = _merge_indices(self.parent.get_index(), index)
+        self._index = index
+
+        return index
+
+    @staticmethod
+    def _get_index_column(index, key):
+        """return the values of `key` in the index and whether rows have it, None if not indexed"""
+        from ase.data import chemical_symbols
+
+        if key in ('id', 'natoms'):
+            values = index[f'{key}s' if key == 'id' else key]
+            return values, np.ones(len(values), dtype=bool)
+
+        if isinstance(key, int):
+            symbol = chemical_symbols[key]
+            if symbol in index['species']:
+                values = index['composition'][:, index['species'].index(symbol)]
+            else:
+                values = np.zeros(len(index['ids']), dtype=int)
+            return values, np.ones(len(values), dtype=bool)
+
+        if key in index['properties']:
+            values = index['properties'][key]
+            return values, ~np.isnan(values)
+
+        if key in index['text']:
+            values = index['text'][key]
+            return values, values != ''
+
+        return None
+
+    def _get_index_mask(self, selection=None):
+        """boolean mask of the rows matching the ase db `selection`, evaluated on the index if possible"""
+        from ase.db.core import parse_selection
+
+        index = self.get_index()
+        mask = np.ones(len(index['ids']), dtype=bool)
+        if selection is None:
+            return mask
+
+        keys, cmps = parse_selection(selection)
+        for key, op, value in [(key, None, None) for key in keys] + list(cmps):
+            column = self._get_index_column(index, key)
+            if column is None or not self._is_index_comparison(column[0], op, value):
+                # not indexed, select the ids in the db file
+                ids = [row.id for row in self.get_db().select(selection, include_data=False)]
+                return np.isin(index['ids'], ids)
+
+            values, present = column
+            mask &= present
+            if op is not None:
+                mask &= _OPS[op](values, str(value) if values.dtype.kind == 'U' else value)
+
+        return mask
+
+    @staticmethod
+    def _is_index_comparison(values, op, value):
+        """whether the comparison `op value` can be evaluated on the index `values`"""
+        if op is None:
+            return True
+
+        return op in _OPS and (values.dtype.kind == 'U' or isinstance(value, numbers.Real))
+
+    def count(self, selection=None):
+        """number of rows matching the ase db `selection`"""
+        return int(np.count_nonzero(self._get_index_mask(selection)))
+
+    def get_ids(self, selection=None):
+        """ids of the rows matching the ase db `selection`"""
+        return self.get_index()['ids'][self._get_index_mask(selection)]
+
+    def get_property(self, key, selection=None):
+        """values of the numeric key-value pair `key` of the rows matching the ase db `selection`"""
+        properties = self.get_index()['properties']
+        if key not in properties:
+            raise KeyError(f'`{key}` is not a numeric property of the structures, available are {sorted(properties)}')
+
+        return properties[key][self._get_index_mask(selection)]
+
+    def iter_structures(self, selection=None, batch_size=100, columns=None):
+        """
+        Yield the rows matching the ase db `selection` in lists of at most
+        `batch_size` tuples `(Atoms, properties)`.
+
+        The rows are read from the db cursor as the batches are consumed and
+        only the columns needed for the structures and `properties` are read,
+        so memory does not grow with the size of the db. The shards of a chain
+        are read one after the other, and `id` in `selection` refers to the
+        ids of the whole chain, as for `count` and `get_ids`.
+
+        :param columns: keys of the key-value pairs to put in `properties`, all of them by default
+        """
+        from aiida_ce.parallel import chunked
+
+        select_columns = list(_STRUCTURE_COLUMNS)
+        if columns is None or columns:
+            select_columns.append('key_value_pairs')
+
+        shards = self.get_shards()
+        if selection is None or len(shards) == 1:
+            # pylint: disable=protected-access
+            rows = itertools.chain.from_iterable(
+                shard._get_shard_db().select(selection, include_data=False, columns=select_columns)
+                for shard in shards)
+        else:
+            # the selection is evaluated on the chain, the rows of a shard are numbered from 1
+            ids = self.get_ids(selection)
+
+            def iter_shard_rows(shard):
+                # pylint: disable=protected-access
+                offset = shard.get_attribute('id_offset', 0)
+                shard_ids = set((ids[ids > offset] - offset).tolist())
+                if not shard_ids:
+                    return
+                for row in shard._get_shard_db().select(include_data=False, columns=select_columns):
+                    if row.id in shard_ids:
+                        yield row
+
+            rows = itertools.chain.from_iterable(iter_shard_rows(shard) for shard in shards)
+
+        for batch in chunked(rows, batch_size):
+            yield [(row.toatoms(), self._get_row_properties(row, columns)) for row in batch]
+
+    @staticmethod
+    def _get_row_properties(row, columns=None):
+        """key-value pairs `columns` of a row, None if the row has no such key"""
+        if columns is None:
+            return dict(row.key_value_pairs)
+
+        return {key: row.get(key) for key in columns}
 
     def set_from_db_file(self, file):
         """set StructureDbData from a db file"""
@@ -38,16 +674,69 @@ class StructureDbData(orm.ArrayData):
             raise ValueError(
                 f'path `{file}` does not correspond to an existing file')
 
+        self._delete_index()
         self.put_object_from_file(file, key)
         self.set_attribute('filename', key)
+        self.set_attribute('db_hash', _get_file_hash(file))
+
+    def _set_from_rows(self, rows, batch_size=10000):
+        """set StructureDbData from `rows` written to a new db file"""
+        with tempfile.TemporaryDirectory() as dirpath:
+            db_file = os.path.join(dirpath, 'structures.db')
+            _write_db_file(db_file, rows, batch_size)
+            self.set_from_db_file(db_file)
+
+    def set_from_query(self, query, properties=(), batch_size=10000):
+        """
+        Set StructureDbData from the results of a `QueryBuilder`, whose rows
+        are a `StructureData` followed by the projected values of `properties`,
+        e.g. an attribute of an output node of a calculation of the structure.
+        The uuid of the structure is stored as the `structure_uuid` key.
+
+        The results are read in batches of `batch_size` and written in one
+        transaction per batch.
+
+        :param query: `QueryBuilder` projecting a `StructureData` and one value per property
+        :param properties: keys of the key-value pairs of the projected values
+        """
+        def iter_rows():
+            for structure, *values in query.iterall(batch_size=batch_size):
+                if len(values) != len(properties):
+                    raise ValueError(f'the query projects {len(values)} values for the properties {properties}')
+                key_value_pairs = dict(zip(properties, values))
+                key_value_pairs['structure_uuid'] = structure.uuid
+                yield structure.get_ase(), key_value_pairs
+
+        self._set_from_rows(iter_rows(), batch_size)
+
+    def set_from_files(self, files, index=':', file_format=None, properties=None, batch_size=10000):
+        """
+        Set StructureDbData from the frames of extxyz or trajectory files,
+        read one by one with `ase.io.iread` and written in one transaction per
+        batch of `batch_size` frames. Results of the calculator of a frame
+        are stored in the ase db columns (e.g. `energy`).
+
+        :param files: path or list of paths of the files
+        :param index: frames to read from every file, all by default
+        :param file_format: ase format of the files, guessed from the name by default
+        :param properties: entries of `atoms.info` to store as key-value pairs,
+            all those which can be stored by default
+        """
+        from ase.io import iread
+
+        if isinstance(files, str):
+            files = [files]
+
+        def iter_rows():
+            for file in files:
+                for atoms in iread(file, index=index, format=file_format):
+                    yield atoms, _get_key_value_pairs(atoms.info, properties)
+
+        self._set_from_rows(iter_rows(), batch_size)
 
     @property
     def status(self):
         """check whether the structures or the properties are set"""
-        db = self.get_db()
-
-        res = {'structures': False, 'properties': []}
-        if db.count() != 0:
-            res['structures'] = True
+        index = self.get_index()
 
-        return res
+        return {'structures': len(index['ids']) != 0, 'properties': sorted(index['properties'])}
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental evaluation of a cluster expansion on a fixed supercell.
+"""
+from typing import List, Sequence, Tuple, Union
+
+import numpy as np
+from ase import Atoms
+from ase.data import atomic_numbers
+from icet import ClusterExpansion
+
+
+class LocalEnergyEvaluator:
+    """
+    Energy changes of site flips and swaps on a supercell.
+
+    The orbits every site takes part in are set up once for the supercell
+    (by the mchammer `ClusterExpansionCalculator`), the change of a move is
+    then obtained from the local cluster vectors of the moved sites only.
+    Local contributions of the current configuration are cached until a move
+    is applied. The batch methods `get_flip_changes` and `get_swap_changes`
+    evaluate every distinct move once and contract all the local cluster
+    vectors with the parameters in a single matrix product, the local cluster
+    vectors themselves are still computed move by move by mchammer.
+
+    :param cluster_expansion: icet cluster expansion, preferably pruned
+    :param structure: supercell with the current occupations
+    :param scaling: factor applied to the per-site cluster expansion value,
+        the number of sites by default, i.e. changes of the total property
+    """
+    def __init__(self, cluster_expansion: ClusterExpansion, structure: Atoms, scaling: float = None):
+        from mchammer.calculators import ClusterExpansionCalculator
+
+        self._calculator = ClusterExpansionCalculator(structure, cluster_expansion, scaling=scaling)
+        self._parameters = np.asarray(self._calculator.cluster_expansion.parameters)
+        self._scaling = len(structure) if scaling is None else scaling
+        self._occupations = np.array(structure.numbers)
+        self._local_contributions = {}
+
+    @property
+    def occupations(self) -> np.ndarray:
+        """atomic numbers of the current configuration"""
+        return self._occupations.copy()
+
+    @staticmethod
+    def _get_number(species: Union[int, str]) -> int:
+        """atomic number of a species given by its number or chemical symbol"""
+        if isinstance(species, str):
+            return atomic_numbers[species]
+
+        return int(species)
+
+    def _get_local_cluster_vector(self, occupations, index, exclude_indices=()):
+        """cluster vector of the clusters containing `index` but none of `exclude_indices`"""
+        return np.asarray(
+            self._calculator.cpp_calc.get_local_cluster_vector(occupations, index, list(exclude_indices)))
+
+    def _get_local_contribution(self, occupations, index, exclude_indices=()):
+        """contribution of the clusters containing `index` but none of `exclude_indices`"""
+        return np.dot(self._get_local_cluster_vector(occupations, index, exclude_indices), self._parameters)
+
+    def _get_current_contribution(self, index):
+        """local contribution of `index` in the current configuration, cached"""
+        if index not in self._local_contributions:
+            self._local_contributions[index] = self._get_local_contribution(self._occupations, index)
+
+        return self._local_contributions[index]
+
+    def get_total(self) -> float:
+        """property value of the current configuration"""
+        return self._calculator.calculate_total(occupations=self._occupations)
+
+    def get_flip_change(self, site: int, species: Union[int, str]) -> float:
+        """change of the property when the species on `site` is replaced by `species`"""
+        number = self._get_number(species)
+        if self._occupations[site] == number:
+            return 0.
+
+        occupations = self._occupations.copy()
+        occupations[site] = number
+        change = self._get_local_contribution(occupations, site) - self._get_current_contribution(site)
+
+        return change * self._scaling
+
+    def get_swap_change(self, site_a: int, site_b: int) -> float:
+        """change of the property when the species on `site_a` and `site_b` are exchanged"""
+        if self._occupations[site_a] == self._occupations[site_b]:
+            return 0.
+
+        before = self._get_current_contribution(site_a) + self._get_local_contribution(
+            self._occupations, site_b, [site_a])
+
+        occupations = self._occupations.copy()
+        occupations[[site_a, site_b]] = occupations[[site_b, site_a]]
+        after = self._get_local_contribution(occupations, site_a) + self._get_local_contribution(
+            occupations, site_b, [site_a])
+
+        return (after - before) * self._scaling
+
+    def get_flip_changes(self, sites: Sequence[int], species: Sequence[Union[int, str]]) -> np.ndarray:
+        """changes of the property for many flips of the current configuration"""
+        moves = [(int(site), self._get_number(specie)) for site, specie in zip(sites, species)]
+        distinct = sorted({move for move in moves if self._occupations[move[0]] != move[1]})
+        if not distinct:
+            return np.zeros(len(moves))
+
+        local_cvs = []
+        for site, number in distinct:
+            occupations = self._occupations.copy()
+            occupations[site] = number
+            local_cvs.append(self._get_local_cluster_vector(occupations, site))
+
+        after = np.array(local_cvs) @ self._parameters
+        before = np.array([self._get_current_contribution(site) for site, _ in distinct])
+        changes = dict(zip(distinct, (after - before) * self._scaling))
+
+        return np.array([changes.get(move, 0.) for move in moves])
+
+    def get_swap_changes(self, pairs: List[Tuple[int, int]]) -> np.ndarray:
+        """changes of the property for many swaps of the current configuration"""
+        moves = [tuple(sorted((int(site_a), int(site_b)))) for site_a, site_b in pairs]
+        distinct = sorted({move for move in moves if self._occupations[move[0]] != self._occupations[move[1]]})
+        if not distinct:
+            return np.zeros(len(moves))
+
+        # per swap: site_b in the current configuration, then site_a and
+        # site_b in the swapped one, the clusters of site_b excluding site_a
+        local_cvs = []
+        for site_a, site_b in distinct:
+            occupations = self._occupations.copy()
+            occupations[[site_a, site_b]] = occupations[[site_b, site_a]]
+            local_cvs.extend([
+                self._get_local_cluster_vector(self._occupations, site_b, [site_a]),
+                self._get_local_cluster_vector(occupations, site_a),
+                self._get_local_cluster_vector(occupations, site_b, [site_a]),
+            ])
+
+        contributions = (np.array(local_cvs) @ self._parameters).reshape(len(distinct), 3)
+        before = np.array([self._get_current_contribution(site_a) for site_a, _ in distinct]) + contributions[:, 0]
+        after = contributions[:, 1] + contributions[:, 2]
+        changes = dict(zip(distinct, (after - before) * self._scaling))
+
+        return np.array([changes.get(move, 0.) for move in moves])
+
+    def apply_flip(self, site: int, species: Union[int, str]):
+        """replace the species on `site` in the current configuration"""
+        self._occupations[site] = self._get_number(species)
+        self._local_contributions.clear()
+
+    def apply_swap(self, site_a: int, site_b: int):
+        """exchange the species on `site_a` and `site_b` in the current configuration"""
+        self._occupations[[site_a, site_b]] = self._occupations[[site_b, site_a]]
+        self._local_contributions.clear()
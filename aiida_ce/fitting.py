@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Cross validation of many fit methods and hyperparameters on the same fit
+matrix, and of the folds of a single fit, spread over a pool of worker
+processes, and warm-started retraining.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import itertools
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from aiida_ce.parallel import _WORKER_STATE, get_n_workers
+
+
+def get_fit_candidates(grids):
+    """
+    Expand hyperparameter grids into the list of fit candidates.
+
+    Every grid is a dict with the `fit_method` and its keyword arguments, a
+    list of values is a grid axis and every combination is a candidate::
+
+        get_fit_candidates([{'fit_method': 'lasso', 'alpha': [1e-4, 1e-3]}, {'fit_method': 'ardr'}])
+
+    :return: list of dicts with the `fit_method` and the keyword arguments
+    """
+    candidates = []
+    for grid in grids:
+        if 'fit_method' not in grid:
+            raise ValueError(f'the grid `{grid}` has no `fit_method`')
+
+        keys = sorted(key for key in grid if key != 'fit_method')
+        axes = [grid[key] if isinstance(grid[key], (list, tuple)) else [grid[key]] for key in keys]
+        for values in itertools.product(*axes):
+            candidates.append(dict(zip(keys, values), fit_method=grid['fit_method']))
+
+    return candidates
+
+
+def validate(fit_matrix, target, candidate):
+    """
+    cross validate a fit candidate (see `get_fit_candidates`) with its folds
+    fitted in this process, see `cross_validate`
+
+    :return: dict of the scores of `cross_validate` and the `error` message,
+        only the NaN `rmse_validation` and `rmse_train` with the message if the fit failed
+    """
+    try:
+        scores = cross_validate(fit_matrix, target, n_workers=1, **candidate)
+    except Exception as exception:  # pylint: disable=broad-except
+        return {'rmse_validation': np.nan, 'rmse_train': np.nan, 'error': str(exception)}
+
+    scores['error'] = None
+    return scores
+
+
+def _init_fit_worker(fit_matrix_path, target):
+    """pool initializer, map the shared fit matrix once per worker"""
+    _WORKER_STATE['fit_data'] = (np.load(fit_matrix_path, mmap_mode='r'), target)
+
+
+def _worker_validate(candidate):
+    """task of a worker, cross validation of a fit candidate"""
+    return validate(*_WORKER_STATE['fit_data'], candidate)
+
+
+def validate_candidates(fit_matrix, target, candidates, n_workers=None):
+    """
+    Cross validate all `candidates` on the same fit data, in a process pool
+    with more than one worker. The fit matrix is mapped by every worker from
+    a shared file, see `cross_validate`.
+
+    :return: list of the scores of `validate` in the order of `candidates`
+    """
+    n_workers = min(get_n_workers(n_workers), max(len(candidates), 1))
+    if n_workers == 1:
+        return [validate(fit_matrix, target, candidate) for candidate in candidates]
+
+    with _shared_array(fit_matrix) as fit_matrix_path:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_fit_worker,
+                                 initargs=(fit_matrix_path, np.asarray(target))) as executor:
+            return list(executor.map(_worker_validate, candidates))
+
+
+def _get_npy_path(array):
+    """return the path of the .npy file of which `array` is the whole memory map, or None"""
+    filename = getattr(array, 'filename', None)
+    if not isinstance(array, np.memmap) or filename is None or not str(filename).endswith('.npy'):
+        return None
+
+    # a view of the same shape, dtype and C order as the file is the whole file
+    mapped = np.load(filename, mmap_mode='r')
+    if mapped.shape != array.shape or mapped.dtype != array.dtype or not array.flags.c_contiguous:
+        return None
+
+    return filename
+
+
+@contextlib.contextmanager
+def _shared_array(array):
+    """
+    yield the path of a .npy file of `array` which workers map read-only with
+    `np.load(path, mmap_mode='r')`: the file `array` is the whole memory map
+    of (e.g. the fit matrix in the repository), or else a copy in `/dev/shm`
+    if available so that all processes share the same memory pages.
+    """
+    path = _get_npy_path(array)
+    if path is not None:
+        yield path
+        return
+
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    with tempfile.TemporaryDirectory(dir=directory) as dirpath:
+        path = os.path.join(dirpath, 'array.npy')
+        np.save(path, np.ascontiguousarray(array))
+        yield path
+
+
+# keyword arguments of `CrossValidationEstimator` passed to the splitter of each validation method
+_SPLIT_KEYS = {'k-fold': ('shuffle',), 'shuffle-split': ('test_size', 'train_size')}
+
+
+def split_kwargs(validation_method, kwargs):
+    """
+    split the keyword arguments of `CrossValidationEstimator` into those of
+    the splitter of `validation_method` and those of the fit method, as it does
+
+    :return: the splitter and the fit keyword arguments
+    """
+    if validation_method not in _SPLIT_KEYS:
+        raise ValueError(f'unknown validation method `{validation_method}`')
+
+    splitter_kwargs = {key: value for key, value in kwargs.items() if key in _SPLIT_KEYS[validation_method]}
+    fit_kwargs = {key: value for key, value in kwargs.items() if key not in splitter_kwargs}
+
+    return splitter_kwargs, fit_kwargs
+
+
+def get_splits(n_rows, validation_method='k-fold', n_splits=10, seed=42, **kwargs):
+    """
+    return the list of `(train_indices, validation_indices)` of the folds, the
+    same splits as the ones of `CrossValidationEstimator` with these parameters.
+
+    :param kwargs: keyword arguments of the splitter, see `split_kwargs`
+    """
+    from sklearn.model_selection import KFold, ShuffleSplit
+
+    if validation_method == 'k-fold':
+        splitter = KFold(n_splits=n_splits, random_state=seed, **dict({'shuffle': True}, **kwargs))
+    elif validation_method == 'shuffle-split':
+        splitter = ShuffleSplit(n_splits=n_splits, random_state=seed, **kwargs)
+    else:
+        raise ValueError(f'unknown validation method `{validation_method}`')
+
+    return list(splitter.split(np.zeros(n_rows)))
+
+
+def _fit_fold(fit_matrix, target, fold, fit_kwargs):
+    """fit the training rows of `fold` and return the train and validation RMSE and the time taken"""
+    from icet.fitting import fit
+
+    train_indices, validation_indices = fold
+    start = time.perf_counter()
+    parameters = fit(fit_matrix[train_indices], target[train_indices], **fit_kwargs)['parameters']
+
+    def get_rmse(indices):
+        return np.sqrt(np.mean((fit_matrix[indices] @ parameters - target[indices])**2))
+
+    return get_rmse(train_indices), get_rmse(validation_indices), time.perf_counter() - start
+
+
+def _init_fold_worker(fit_matrix_path, target, fit_kwargs):
+    """pool initializer, map the shared fit matrix once per worker"""
+    _WORKER_STATE['fold_data'] = (np.load(fit_matrix_path, mmap_mode='r'), target, fit_kwargs)
+
+
+def _worker_fit_fold(fold):
+    """task of a worker, fit of a fold"""
+    fit_matrix, target, fit_kwargs = _WORKER_STATE['fold_data']
+    return _fit_fold(fit_matrix, target, fold, fit_kwargs)
+
+
+def cross_validate(fit_matrix,
+                   target,
+                   fit_method='least-squares',
+                   n_workers=None,
+                   validation_method='k-fold',
+                   n_splits=10,
+                   seed=42,
+                   **kwargs):
+    """
+    Cross validate a fit method with its folds fitted in a process pool.
+
+    The fit matrix, possibly a memory map, is mapped read-only from a file by
+    all the workers instead of being sent with every fold. The folds are those of
+    `CrossValidationEstimator` with the same parameters and the results are
+    in the fold order, whatever the worker they ran on.
+
+    :param kwargs: keyword arguments of the splitter and of the fit method (e.g. `alpha`),
+        told apart as by `CrossValidationEstimator`, see `split_kwargs`
+    :return: dict of the arrays `rmse_train_splits`, `rmse_validation_splits`,
+        `fold_times` (seconds) and of the overall `rmse_train` and `rmse_validation`
+    """
+    splitter_kwargs, fit_kwargs = split_kwargs(validation_method, kwargs)
+    folds = get_splits(len(target), validation_method=validation_method, n_splits=n_splits, seed=seed,
+                       **splitter_kwargs)
+    fit_kwargs['fit_method'] = fit_method
+    n_workers = min(get_n_workers(n_workers), len(folds))
+
+    if n_workers == 1:
+        results = [_fit_fold(fit_matrix, target, fold, fit_kwargs) for fold in folds]
+    else:
+        with _shared_array(fit_matrix) as fit_matrix_path:
+            with ProcessPoolExecutor(max_workers=n_workers,
+                                     initializer=_init_fold_worker,
+                                     initargs=(fit_matrix_path, np.asarray(target), fit_kwargs)) as executor:
+                results = list(executor.map(_worker_fit_fold, folds))
+
+    rmse_train, rmse_validation, fold_times = (np.array(values, dtype=float) for values in zip(*results))
+
+    return {
+        'rmse_train_splits': rmse_train,
+        'rmse_validation_splits': rmse_validation,
+        'fold_times': fold_times,
+        'rmse_train': np.sqrt(np.mean(rmse_train**2)),
+        'rmse_validation': np.sqrt(np.mean(rmse_validation**2)),
+    }
+
+
+def fit_warm_start(fit_matrix, target, parameters, alpha=None, max_iter=10000, tol=1e-4):
+    """
+    Lasso fit of the standardized fit matrix started from `parameters`, e.g.
+    the ECIs of the previous cluster expansion when a few rows were added, so
+    that coordinate descent converges in a few iterations.
+
+    The columns and the target are scaled by their standard deviation (1 if
+    constant) as with the `standardize` option of `icet.fitting.fit`, so the
+    same `alpha` gives the same parameters as a cold lasso fit with icet.
+
+    :param alpha: lasso regularization, 1e-5 by default
+    :return: dict of the `parameters`, the `alpha` and the `n_iterations` of the solver
+    """
+    from sklearn.linear_model import Lasso
+
+    alpha = 1e-5 if alpha is None else alpha
+    scale = np.std(fit_matrix, axis=0)
+    scale[scale == 0] = 1.0
+    target_scale = np.std(target) or 1.0
+
+    model = Lasso(alpha=alpha, fit_intercept=False, warm_start=True, max_iter=max_iter, tol=tol)
+    model.coef_ = np.asarray(parameters, dtype=float) * scale / target_scale
+    model.fit(fit_matrix / scale, np.asarray(target) / target_scale)
+
+    return {
+        'parameters': model.coef_ * target_scale / scale,
+        'alpha': alpha,
+        'n_iterations': int(model.n_iter_),
+    }
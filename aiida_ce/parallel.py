@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to spread icet computations over a pool of worker processes.
+
+icet cluster spaces are C++ backed objects which can not be pickled. With
+the `fork` start method the workers inherit the cluster space of the parent
+process, otherwise every worker receives the serialized cluster space once at
+start up and deserializes it, which redoes the symmetry analysis.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import contextlib
+import itertools
+import multiprocessing
+import os
+import uuid
+
+import numpy as np
+
+# state of a worker process, set up by the pool initializers
+_WORKER_STATE = {}
+
+
+def get_n_workers(n_workers=None):
+    """return the number of worker processes to use, all cores by default"""
+    if n_workers is None:
+        return os.cpu_count() or 1
+
+    if n_workers < 1:
+        raise ValueError(f'n_workers `{n_workers}` must be a positive integer')
+
+    return n_workers
+
+
+def chunked(iterable, chunk_size):
+    """yield lists of at most `chunk_size` items, consuming `iterable` lazily"""
+    if chunk_size < 1:
+        raise ValueError(f'chunk_size `{chunk_size}` must be a positive integer')
+
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def imap_ordered(executor, func, iterable, max_pending):
+    """
+    like `executor.map` but keep at most `max_pending` tasks in flight, so
+    that `iterable` is only consumed as fast as the results are. Results are
+    yielded in the order of `iterable`.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+@contextlib.contextmanager
+def share_cluster_space(cluster_space, content=None):
+    """
+    Context returning the `(content, token)` arguments of
+    `_init_cluster_space_worker` for the pools created inside it.
+
+    With the `fork` start method the cluster space is put in `_WORKER_STATE`
+    under `token` before the workers are forked and nothing is serialized.
+    Otherwise `content` is the serialized `cluster_space`, or a function
+    returning it, called only if needed.
+    """
+    if multiprocessing.get_start_method() == 'fork':
+        token = f'cluster_space-{uuid.uuid4().hex}'
+        _WORKER_STATE[token] = cluster_space
+        try:
+            yield None, token
+        finally:
+            _WORKER_STATE.pop(token, None)
+        return
+
+    from aiida_ce.data.cluster import _cluster_space_to_bytes
+
+    if content is None:
+        content = _cluster_space_to_bytes(cluster_space)
+    elif callable(content):
+        content = content()
+
+    yield content, None
+
+
+def _init_cluster_space_worker(content, token=None):
+    """pool initializer, take the cluster space inherited from the parent
+    process under `token`, or deserialize it once per worker"""
+    from aiida_ce.data.cluster import _cluster_space_from_bytes
+
+    if token is not None and token in _WORKER_STATE:
+        _WORKER_STATE['cluster_space'] = _WORKER_STATE[token]
+    else:
+        _WORKER_STATE['cluster_space'] = _cluster_space_from_bytes(content)
+
+
+def _get_cluster_vectors(cluster_space, structures):
+    """return the cluster vectors of `structures` stacked in a 2-D array"""
+    return np.array([cluster_space.get_cluster_vector(structure) for structure in structures]).reshape(
+        len(structures), len(cluster_space))
+
+
+def _worker_cluster_vectors(structures):
+    """task of a worker, cluster vectors of a chunk of structures"""
+    return _get_cluster_vectors(_WORKER_STATE['cluster_space'], structures)
+
+
+def iter_cluster_vectors(cluster_space, structures, n_workers=None, chunk_size=100, content=None):
+    """
+    yield the cluster vectors of `structures` (an iterable of ase `Atoms`)
+    chunk by chunk as 2-D arrays, in the order of the input.
+
+    With more than one worker the chunks are computed in a process pool, in
+    which every worker holds its own copy of the cluster space. There are
+    never more workers than chunks, so a single chunk is always computed in
+    this process. `content` is the already serialized `cluster_space` or a
+    function returning it, see `share_cluster_space`.
+    """
+    n_workers = get_n_workers(n_workers)
+    chunks = chunked(structures, chunk_size)
+
+    # look ahead so that no worker is started (and no symmetry analysis is
+    # redone) for less work than a chunk
+    head = list(itertools.islice(chunks, n_workers))
+    n_workers = min(n_workers, len(head))
+    chunks = itertools.chain(head, chunks)
+
+    if n_workers <= 1:
+        for chunk in chunks:
+            yield _get_cluster_vectors(cluster_space, chunk)
+        return
+
+    with share_cluster_space(cluster_space, content) as initargs:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_cluster_space_worker,
+                                 initargs=initargs) as executor:
+            yield from imap_ordered(executor, _worker_cluster_vectors, chunks, max_pending=2 * n_workers)
+
+
+def compute_cluster_vectors(cluster_space, structures, n_workers=None, chunk_size=100):
+    """return the cluster vectors of `structures` as a single 2-D array,
+    see `iter_cluster_vectors`"""
+    blocks = list(iter_cluster_vectors(cluster_space, structures, n_workers=n_workers, chunk_size=chunk_size))
+    if not blocks:
+        return np.empty((0, len(cluster_space)))
+
+    return np.vstack(blocks)
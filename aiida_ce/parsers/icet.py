@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""icet tasks parsers"""
+import io
+import json
+import os
+
+import numpy as np
+from aiida import orm
+from aiida.common import exceptions
+from aiida.parsers.parser import Parser
+from aiida.plugins import DataFactory
+
+from aiida_ce import tasks
+
+ClusterExpansionData = DataFactory('cluster_expansion')
+
+
+class IcetFitDataParser(Parser):
+    """
+    Parser of the outputs of `IcetFitDataCalculation`, the files fit_matrix.npy
+    and target.npy of the retrieved temporary folder
+    """
+    def parse(self, **kwargs):
+        """
+        Parse outputs, store the fit matrix in the fit data without loading it.
+        """
+        from aiida_ce.workflows import _new_fit_data
+
+        dirpath = kwargs.get('retrieved_temporary_folder')
+        if dirpath is None:
+            return self.exit_codes.ERROR_MISSING_OUTPUT_FILES
+
+        path = os.path.join(dirpath, tasks.FIT_MATRIX_FILENAME)
+        target_path = os.path.join(dirpath, tasks.TARGET_FILENAME)
+        if not os.path.isfile(path) or not os.path.isfile(target_path):
+            return self.exit_codes.ERROR_MISSING_OUTPUT_FILES
+
+        try:
+            n_skipped = json.loads(self.retrieved.get_object_content(tasks.RESULTS_FILENAME)).get('n_skipped', 0)
+        except (OSError, IOError, exceptions.NotExistent):
+            return self.exit_codes.ERROR_MISSING_OUTPUT_FILES
+
+        inputs = self.node.inputs
+        if n_skipped:
+            self.logger.warning(f'skipped {n_skipped} structures without `{inputs.fit_data_key.value}`')
+        self.out('fit_data', _new_fit_data(path, np.load(target_path), inputs.fit_data_key.value,
+                                           inputs.selection.value, n_skipped))
+
+
+class IcetTrainParser(Parser):
+    """
+    Parser of the outputs of `IcetTrainCalculation`, the files results.npz
+    and results.json, and cluster_expansion.ce of the retrieved temporary folder
+    """
+    def parse(self, **kwargs):
+        """
+        Parse outputs, store results in database.
+        """
+        try:
+            info = json.loads(self.retrieved.get_object_content(tasks.RESULTS_FILENAME))
+            content = self.retrieved.get_object_content(tasks.RESULTS_ARRAYS_FILENAME, mode='rb')
+        except (OSError, IOError, exceptions.NotExistent):
+            return self.exit_codes.ERROR_MISSING_OUTPUT_FILES
+
+        with np.load(io.BytesIO(content)) as handle:
+            arrays = {name: handle[name] for name in handle.files}
+
+        results = orm.ArrayData()
+        for name, array in arrays.items():
+            results.set_array(name, array)
+
+        self.out('results', results)
+        self.out('info', orm.Dict(dict=info))
+
+        if info['selected_fit'] is None:
+            return None
+
+        path = os.path.join(kwargs.get('retrieved_temporary_folder') or '', tasks.CLUSTER_EXPANSION_FILENAME)
+        if not os.path.isfile(path):
+            return self.exit_codes.ERROR_MISSING_OUTPUT_FILES
+
+        cluster_expansion = ClusterExpansionData()
+        cluster_expansion.set_file(path, arrays['parameters'])
+        for name, array in arrays.items():
+            if name.startswith('validation_'):
+                cluster_expansion.set_array(name, array)
+        self.out('cluster_expansion', cluster_expansion)
+
+        return None
+
+
+class IcetSqsParser(Parser):
+    """
+    Parser of the outputs of `IcetSqsCalculation`,
+    the files results.json and sqs.xyz
+    """
+    def parse(self, **kwargs):
+        """
+        Parse outputs, store results in database.
+        """
+        from ase.io import read
+
+        try:
+            results = json.loads(self.retrieved.get_object_content(tasks.RESULTS_FILENAME))
+        except (OSError, IOError, exceptions.NotExistent):
+            return self.exit_codes.ERROR_MISSING_OUTPUT_FILES
+
+        self.out('objectives', tasks.objectives_to_array_data(results['objectives']))
+        if results['objectives']['selected'] is None:
+            return self.exit_codes.ERROR_NO_VALID_SUPERCELL
+
+        try:
+            content = self.retrieved.get_object_content(tasks.SQS_FILENAME)
+        except (OSError, IOError, exceptions.NotExistent):
+            return self.exit_codes.ERROR_MISSING_OUTPUT_FILES
+
+        sqs = read(io.StringIO(content), format='extxyz')
+        self.out('output_structure', orm.StructureData(ase=sqs))
+        self.out('output_cluster_vector', orm.List(list=results['cluster_vector']))
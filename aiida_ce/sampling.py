@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo sampling of a cluster expansion with mchammer, run in chunks of
+trial steps so that the state can be saved and the sampling resumed between
+chunks, and ladders of ensembles sampled in parallel with replica exchange.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import random
+
+import numpy as np
+from ase import Atoms
+from ase.data import atomic_numbers
+from ase.units import kB
+from icet import ClusterExpansion
+
+from aiida_ce.parallel import _WORKER_STATE, get_n_workers
+
+ENSEMBLES = ('canonical', 'semi_grand_canonical')
+
+
+def get_random_state():
+    """return the state of the random number generators used by mchammer as a JSON serializable list"""
+    version, internal_state, gauss = random.getstate()
+    np_state = np.random.get_state()
+
+    return [[version, list(internal_state), gauss], [np_state[0], np_state[1].tolist()] + list(np_state[2:])]
+
+
+def set_random_state(state):
+    """restore the random number generators from a state returned by `get_random_state`"""
+    (version, internal_state, gauss), np_state = state
+    random.setstate((version, tuple(internal_state), gauss))
+    np.random.set_state((np_state[0], np.array(np_state[1], dtype=np.uint32)) + tuple(np_state[2:]))
+
+
+def get_calculator(cluster_expansion: ClusterExpansion, structure: Atoms):
+    """return the mchammer calculator of `cluster_expansion` on the supercell `structure`"""
+    from mchammer.calculators import ClusterExpansionCalculator
+
+    return ClusterExpansionCalculator(structure, cluster_expansion)
+
+
+def get_ensemble(ensemble, calculator, structure, temperature, chemical_potentials=None, random_seed=None,
+                 observation_interval=None, trajectory_interval=None):
+    """return a mchammer ensemble of type `ensemble`, one of `ENSEMBLES`"""
+    from mchammer.ensembles import CanonicalEnsemble, SemiGrandCanonicalEnsemble
+
+    kwargs = dict(structure=structure,
+                  calculator=calculator,
+                  temperature=temperature,
+                  random_seed=random_seed,
+                  ensemble_data_write_interval=observation_interval,
+                  trajectory_write_interval=trajectory_interval)
+
+    if ensemble == 'canonical':
+        mc_ensemble = CanonicalEnsemble(**kwargs)
+    elif ensemble == 'semi_grand_canonical':
+        if chemical_potentials is None:
+            raise ValueError('the semi-grand canonical ensemble requires `chemical_potentials`')
+        mc_ensemble = SemiGrandCanonicalEnsemble(chemical_potentials=chemical_potentials, **kwargs)
+    else:
+        raise ValueError(f'unknown ensemble `{ensemble}`, valid ensembles are {ENSEMBLES}')
+
+    # mchammer only seeds `random`, sublattices are however picked with `numpy.random`
+    if random_seed is not None:
+        np.random.seed(random_seed)
+
+    return mc_ensemble
+
+
+def run_chunk(ensemble, n_steps, first_step=0, random_state=None):
+    """
+    Run `n_steps` trial steps of `ensemble`, resuming from `random_state`.
+
+    The observations are returned as arrays instead of being kept in the
+    data container. `first_step` is the number of trial steps run before this
+    chunk. The step counter of the ensemble is set to it, as mchammer does
+    when restarting from a data container, so that observations and snapshots
+    land on the same trial steps as in a single run of all the chunks. An
+    observation of `first_step` itself is part of the previous chunk and
+    therefore skipped.
+
+    :return: dict of 1-D arrays of the observables with NaN where not observed,
+        the `mctrial` steps, the 2-D `occupations` snapshots and their
+        `trajectory_mctrial` steps.
+    """
+    if random_state is not None:
+        set_random_state(random_state)
+
+    if first_step:
+        ensemble._step = first_step  # pylint: disable=protected-access
+
+    ensemble.run(n_steps)
+    data_container = ensemble.data_container
+
+    data = data_container.data
+    if first_step and not data.empty:
+        data = data[data['mctrial'] > first_step]
+    if data.empty:
+        return {'mctrial': np.empty(0, dtype=int)}
+
+    arrays = {column: data[column].to_numpy(dtype=float) for column in data.columns if column != 'mctrial'}
+    arrays['mctrial'] = data['mctrial'].to_numpy(dtype=int)
+
+    if 'occupations' in data_container.observables:
+        mctrials, snapshots = data_container.get('mctrial', 'trajectory', start=first_step + 1 if first_step else 0)
+        arrays['trajectory_mctrial'] = np.asarray(mctrials, dtype=int)
+        arrays['occupations'] = np.array([snapshot.numbers for snapshot in snapshots], dtype=int)
+
+    return arrays
+
+
+def get_ladder(temperatures, chemical_potentials=None):
+    """
+    return the list of `(temperature, chemical_potentials)` points of a
+    ladder, a single temperature or a single set of chemical potentials is
+    shared by all the points.
+    """
+    if chemical_potentials is None:
+        chemical_potentials = [None]
+
+    n_points = max(len(temperatures), len(chemical_potentials))
+    if not n_points or {len(temperatures), len(chemical_potentials)} - {1, n_points}:
+        raise ValueError('`temperatures` and `chemical_potentials` must have the same length or a single element')
+
+    if len(temperatures) == 1:
+        temperatures = n_points * list(temperatures)
+    if len(chemical_potentials) == 1:
+        chemical_potentials = n_points * list(chemical_potentials)
+
+    return list(zip(temperatures, chemical_potentials))
+
+
+def _get_reduced_energy(energy, numbers, temperature, chemical_potentials=None):
+    """energy of a configuration in the ensemble of a ladder point, `(E - sum_s mu_s N_s) / kT`"""
+    if chemical_potentials:
+        energy -= sum(potential * np.count_nonzero(numbers == atomic_numbers[symbol])
+                      for symbol, potential in chemical_potentials.items())
+
+    return energy / (kB * temperature)
+
+
+def _setup_ladder_state(state, content, structure):
+    """set up the cluster expansion calculator of the supercell in `state`"""
+    from aiida_ce.data.cluster import _cluster_expansion_from_bytes
+
+    state['structure'] = structure
+    state['calculator'] = get_calculator(_cluster_expansion_from_bytes(content), structure)
+
+
+def _init_ladder_worker(content, structure):
+    """pool initializer, set up the calculator once per worker"""
+    _setup_ladder_state(_WORKER_STATE, content, structure)
+
+
+def _run_replica(state, task):
+    """run a segment of trial steps of one ladder point"""
+    structure = state['structure'].copy()
+    structure.numbers = task['occupations']
+
+    ensemble = get_ensemble(task['ensemble'],
+                            calculator=state['calculator'],
+                            structure=structure,
+                            temperature=task['temperature'],
+                            chemical_potentials=task['chemical_potentials'],
+                            random_seed=task['random_seed'],
+                            observation_interval=task['observation_interval'],
+                            trajectory_interval=task['n_steps'])
+    arrays = run_chunk(ensemble, task['n_steps'], first_step=task['first_step'], random_state=task['random_state'])
+    for name in ('occupations', 'trajectory_mctrial'):
+        arrays.pop(name, None)
+
+    occupations = np.array(ensemble.structure.numbers)
+    return {
+        'occupations': occupations,
+        'energy': state['calculator'].calculate_total(occupations=occupations),
+        'random_state': get_random_state(),
+        'observations': arrays,
+    }
+
+
+def _worker_run_replica(task):
+    """task of a worker, segment of one ladder point"""
+    return _run_replica(_WORKER_STATE, task)
+
+
+@contextlib.contextmanager
+def _ladder_map(content, structure, n_workers, calculator=None):
+    """yield a function running a list of segment tasks, in a process pool with more than one worker"""
+    if n_workers == 1:
+        state = {'structure': structure, 'calculator': calculator}
+        if calculator is None:
+            _setup_ladder_state(state, content, structure)
+        yield lambda tasks: [_run_replica(state, task) for task in tasks]
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_ladder_worker,
+                             initargs=(content, structure)) as executor:
+        yield lambda tasks: list(executor.map(_worker_run_replica, tasks))
+
+
+def _exchange_replicas(ladder, replicas, parity, rng):
+    """
+    attempt to exchange the configurations of the neighbouring points
+    `(k, k + 1)` with `k % 2 == parity` with the Metropolis criterion.
+
+    :return: the list of `(k, accepted)` of the attempts
+    """
+    attempts = []
+    for index in range(parity, len(ladder) - 1, 2):
+        low, high = replicas[index], replicas[index + 1]
+        delta = sum(
+            _get_reduced_energy(new['energy'], new['occupations'], *ladder[point]) -
+            _get_reduced_energy(old['energy'], old['occupations'], *ladder[point])
+            for point, old, new in ((index, low, high), (index + 1, high, low)))
+
+        accepted = delta <= 0 or rng.random() < np.exp(-delta)
+        if accepted:
+            for key in ('occupations', 'energy'):
+                low[key], high[key] = high[key], low[key]
+        attempts.append((index, accepted))
+
+    return attempts
+
+
+def get_ladder_state(structure, ladder):
+    """
+    return the state of the replicas of `ladder` before the first segment,
+    all with the occupations of the supercell `structure`, see `run_ladder_segment`
+    """
+    n_pairs = max(len(ladder) - 1, 0)
+
+    return {
+        'step': 0,
+        'segment': 0,
+        'occupations': np.tile(np.array(structure.numbers), (len(ladder), 1)),
+        'random_states': [None] * len(ladder),
+        'n_attempts': np.zeros(n_pairs, dtype=int),
+        'n_accepted': np.zeros(n_pairs, dtype=int),
+    }
+
+
+def _run_segment(run_tasks, ladder, state, n_steps, ensemble, exchange, observation_interval, seed):
+    """
+    run a segment of `n_steps` trial steps of every point from `state` with
+    `run_tasks`, then attempt the exchanges of the replicas if `exchange`
+
+    :return: the state after the segment and the observations of every point
+    """
+    tasks = [{
+        'ensemble': ensemble,
+        'temperature': temperature,
+        'chemical_potentials': chemical_potentials,
+        'occupations': occupations,
+        'random_state': random_state,
+        'random_seed': seed + index,
+        'n_steps': n_steps,
+        'first_step': state['step'],
+        'observation_interval': observation_interval,
+    } for index, ((temperature, chemical_potentials), occupations, random_state) in enumerate(
+        zip(ladder, state['occupations'], state['random_states']))]
+
+    replicas = run_tasks(tasks)
+    observations = [replica.pop('observations') for replica in replicas]
+
+    n_attempts, n_accepted = state['n_attempts'].copy(), state['n_accepted'].copy()
+    if exchange:
+        # one generator per segment, the exchanges do not depend on how the segments are run
+        rng = np.random.default_rng([seed, state['segment']])
+        for index, accepted in _exchange_replicas(ladder, replicas, state['segment'] % 2, rng):
+            n_attempts[index] += 1
+            n_accepted[index] += accepted
+
+    new_state = {
+        'step': state['step'] + n_steps,
+        'segment': state['segment'] + 1,
+        'occupations': np.array([replica['occupations'] for replica in replicas]),
+        'random_states': [replica['random_state'] for replica in replicas],
+        'n_attempts': n_attempts,
+        'n_accepted': n_accepted,
+    }
+
+    return new_state, observations
+
+
+def run_ladder_segment(content,
+                       structure,
+                       ladder,
+                       state,
+                       n_steps,
+                       ensemble='canonical',
+                       exchange=False,
+                       observation_interval=None,
+                       random_seed=0,
+                       n_workers=None,
+                       calculator=None):
+    """
+    Run a single segment of `n_steps` trial steps of every point of `ladder`
+    from `state` and then, with `exchange`, attempt the exchanges of the
+    replicas, so that the state can be saved between the segments of a ladder.
+
+    Running all the segments gives the same sampling as `run_ladder` with the
+    same `random_seed` and `exchange_interval` segments.
+
+    :param content: the serialized icet cluster expansion, not needed in this process with `calculator`
+    :param state: the state of `get_ladder_state` or returned for the previous segment
+    :param calculator: the calculator of the supercell, reused when run in this process
+    :param n_workers: number of worker processes, at most one per point, 1 to run in this process
+    :return: tuple of the state after the segment, the dict of the `step` and
+        `segment` counts, the 2-D `occupations` and the `random_states` of the
+        points and the `n_attempts` and `n_accepted` exchanges of every pair,
+        and the list of the observations of every point, see `run_chunk`
+    """
+    n_workers = min(get_n_workers(n_workers), len(ladder))
+    with _ladder_map(content, structure, n_workers, calculator=calculator) as run_tasks:
+        return _run_segment(run_tasks, ladder, state, n_steps, ensemble, exchange, observation_interval, random_seed)
+
+
+def run_ladder(content,
+               structure,
+               ladder,
+               n_steps,
+               ensemble='canonical',
+               n_equilibration_steps=0,
+               exchange_interval=None,
+               observation_interval=None,
+               random_seed=None,
+               n_workers=None):
+    """
+    Sample one ensemble per point of `ladder` in parallel, optionally with
+    replica exchange between neighbouring points.
+
+    The points are run in segments of `exchange_interval` trial steps, one
+    task per point and segment. Every worker process sets up the calculator of
+    the supercell once and keeps it for all the tasks it runs. Between the
+    segments the configurations of neighbouring points are exchanged with the
+    Metropolis criterion, alternating between even and odd pairs.
+
+    :param content: the serialized icet cluster expansion
+    :param structure: the supercell with the initial occupations, shared by all points
+    :param ladder: list of `(temperature, chemical_potentials)`, see `get_ladder`
+    :param n_steps: number of trial steps of every point
+    :param n_equilibration_steps: number of trial steps not taken into account in the averages
+    :param exchange_interval: number of trial steps between exchanges, no exchange if None
+    :param n_workers: number of worker processes, at most one per point, 1 to run in this process
+    :return: tuple of the dict of 1-D arrays of averages and fluctuations of
+        the observables of every point, and the list of the final occupations
+    """
+    if n_steps < 1:
+        raise ValueError(f'n_steps `{n_steps}` must be a positive integer')
+
+    n_workers = min(get_n_workers(n_workers), len(ladder))
+    segment_size = exchange_interval or n_steps
+    seed = random.randrange(2**31) if random_seed is None else random_seed
+
+    state = get_ladder_state(structure, ladder)
+    observations = [[] for _ in ladder]
+    with _ladder_map(content, structure, n_workers) as run_tasks:
+        while state['step'] < n_steps:
+            length = min(segment_size, n_steps - state['step'])
+            exchange = bool(exchange_interval) and state['step'] + length < n_steps
+            state, segment = _run_segment(run_tasks, ladder, state, length, ensemble, exchange, observation_interval,
+                                          seed)
+            for chunks, chunk in zip(observations, segment):
+                chunks.append(chunk)
+
+    return get_ladder_averages(ladder, observations, state, n_equilibration_steps), list(state['occupations'])
+
+
+def get_ladder_averages(ladder, observations, state, n_equilibration_steps=0):
+    """
+    return the dict of 1-D arrays of the averages and fluctuations of the
+    observables of every point of `ladder` and of the `exchange_acceptance`
+    of every pair of neighbouring points
+
+    :param observations: list of the observations of every segment (see `run_chunk`) of every point
+    :param state: the state of the ladder after the last segment, see `run_ladder_segment`
+    """
+    averages = _get_averages(ladder, observations, n_equilibration_steps)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        averages['exchange_acceptance'] = state['n_accepted'] / state['n_attempts']
+
+    return averages
+
+
+def _get_averages(ladder, observations, n_equilibration_steps=0):
+    """averages and standard deviations of the observables of every point of the ladder"""
+    temperatures = np.array([temperature for temperature, _ in ladder], dtype=float)
+    arrays = {'temperatures': temperatures, 'n_observations': np.zeros(len(ladder), dtype=int)}
+
+    symbols = sorted({symbol for _, potentials in ladder for symbol in (potentials or {})})
+    for symbol in symbols:
+        arrays[f'mu_{symbol}'] = np.array([(potentials or {}).get(symbol, np.nan) for _, potentials in ladder])
+
+    for index, chunks in enumerate(observations):
+        mctrial = np.concatenate([chunk['mctrial'] for chunk in chunks])
+        production = mctrial >= n_equilibration_steps
+        arrays['n_observations'][index] = np.count_nonzero(production)
+
+        names = sorted({name for chunk in chunks for name in chunk} - {'mctrial'})
+        for name in names:
+            values = np.concatenate([chunk.get(name, np.full(len(chunk['mctrial']), np.nan))
+                                     for chunk in chunks])[production]
+            for suffix, value in (('mean', _nan_reduce(np.nanmean, values)),
+                                  ('std', _nan_reduce(np.nanstd, values))):
+                arrays.setdefault(f'{name}_{suffix}', np.full(len(ladder), np.nan))[index] = value
+
+    if 'potential_std' in arrays:
+        arrays['heat_capacity'] = arrays['potential_std']**2 / (kB * temperatures**2)
+
+    return arrays
+
+
+def _nan_reduce(func, values):
+    """apply the NaN ignoring reduction `func`, NaN if there are no values"""
+    if not np.any(~np.isnan(values)):
+        return np.nan
+
+    return func(values)
@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""
+CPU-heavy icet tasks of the workflows, run either in the workflow process or
+outside of the daemon as local calculation jobs::
+
+    python -m aiida_ce.tasks train --max-concurrent-tasks 2
+
+A task reads its inputs from and writes its outputs to the working directory.
+The cluster space is given by its parameters and built by the task, so that
+its symmetry analysis does not run in the daemon either.
+
+`--max-concurrent-tasks` is a machine-global lock, not a scheduler feature:
+every task started on the machine takes a flock on one of the slot lock files
+(see `task_slot`), shared by all jobs, users and AiiDA profiles using the same
+slot directory, and the others poll until a slot is free. A waiting task is
+already a running job for the scheduler and AiiDA, using its allocation and
+wallclock time; limit the jobs with the scheduler, or the number of jobs of a
+computer (`verdi computer configure`), when possible.
+"""
+import argparse
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+# input and output files of the tasks in the working directory
+PARAMETERS_FILENAME = 'parameters.json'
+FIT_MATRIX_FILENAME = 'fit_matrix.npy'
+TARGET_FILENAME = 'target.npy'
+CLUSTER_SPACE_FILENAME = 'cluster_space.json'
+CLUSTER_EXPANSION_FILENAME = 'cluster_expansion.ce'
+STRUCTURES_FILENAME = 'structures.db'
+SUPERCELLS_FILENAME = 'supercells.xyz'
+RESULTS_FILENAME = 'results.json'
+RESULTS_ARRAYS_FILENAME = 'results.npz'
+SQS_FILENAME = 'sqs.xyz'
+
+# number of rows of a fit matrix copied at once
+_COPY_ROWS = 10000
+
+# directory of the lock files of the task slots
+SLOTS_DIR_ENV = 'AIIDA_CE_SLOTS_DIR'
+
+
+def _to_json(value):
+    """convert numpy values in `value` to json serializable ones"""
+    if isinstance(value, dict):
+        return {str(key): _to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+
+    return value
+
+
+@contextlib.contextmanager
+def task_slot(max_concurrent_tasks=1, directory=None, poll_interval=1.):
+    """
+    Context holding one of the `max_concurrent_tasks` slots of the machine, an
+    flock on a lock file of the slot, polling every `poll_interval` seconds
+    until one is free.
+
+    This is a lock global to the machine, shared by every process using the
+    same `directory`, whatever job, user or AiiDA profile it belongs to.
+    """
+    directory = directory or os.environ.get(SLOTS_DIR_ENV) or os.path.join(tempfile.gettempdir(), 'aiida-ce-slots')
+    os.makedirs(directory, exist_ok=True)
+
+    while True:
+        for slot in range(max(int(max_concurrent_tasks), 1)):
+            handle = open(os.path.join(directory, f'slot-{slot}.lock'), 'w')  # pylint: disable=consider-using-with
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                handle.close()
+                continue
+
+            try:
+                yield slot
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+                handle.close()
+            return
+
+        time.sleep(poll_interval)
+
+
+def build_cluster_space(parameters):
+    """return the icet cluster space of the parameters of `ClusterSpaceData.get_build_parameters`"""
+    from ase import Atoms
+    from icet import ClusterSpace
+
+    structure = Atoms(**parameters['structure'])
+
+    return ClusterSpace(structure, parameters['cutoffs'], parameters['chemical_symbols'], parameters['symprec'],
+                        parameters['position_tolerance'])
+
+
+def get_target_selection(selection, key):
+    """return the ase db `selection` restricted to the structures which have the target property `key`"""
+    return f'{selection},{key}' if selection else key
+
+
+def write_fit_matrix(path, cluster_space, structures, total, n_workers=None, head=None, head_columns=None,
+                     progress=None):
+    """
+    Write the fit matrix in `cluster_space` of the `total` `structures` row by
+    row in the .npy memory map `path`, after the rows of the fit matrix `head`
+    (restricted to `head_columns` if given) if given. The structures are
+    dropped as soon as their cluster vectors are written.
+
+    :param progress: function called with the number of rows computed and `total`
+    """
+    from aiida_ce.parallel import iter_cluster_vectors
+
+    offset = 0 if head is None else len(head)
+    fit_matrix = np.lib.format.open_memmap(path, mode='w+', dtype=float, shape=(offset + total, len(cluster_space)))
+    if head is not None:
+        for start in range(0, offset, _COPY_ROWS):
+            rows = head[start:start + _COPY_ROWS]
+            fit_matrix[start:start + _COPY_ROWS] = rows if head_columns is None else rows[:, head_columns]
+
+    done = 0
+    for cluster_vectors in iter_cluster_vectors(cluster_space, structures, n_workers=n_workers):
+        if done + len(cluster_vectors) > total:
+            raise ValueError(f'more than the {total} structures of the selection')
+        fit_matrix[offset + done:offset + done + len(cluster_vectors)] = cluster_vectors
+        done += len(cluster_vectors)
+        if progress is not None:
+            progress(done, total)
+
+    if done != total:
+        raise ValueError(f'{done} structures instead of the {total} of the selection')
+
+    fit_matrix.flush()
+    del fit_matrix
+
+
+def train(fit_matrix, target, fit_kwargs=None, fit_candidates=None, column_sets=None, n_workers=None):
+    """
+    Train a cluster expansion on the fit data, selecting first the columns
+    (nested cutoffs) and the fit method with the lowest validation RMSE.
+
+    :param fit_kwargs: the `fit_method` and its keyword arguments, unless `fit_candidates` are given
+    :param fit_candidates: fit candidates of `aiida_ce.fitting.get_fit_candidates` to select from
+    :param column_sets: list of the columns of each cutoffs candidate to select from
+    :return: dict of the arrays and dict of the json serializable results, with the
+        `selected_fit` (the keyword arguments) None if no candidate could be validated.
+        The validation arrays of the selected fit are its scores of the selection.
+    """
+    from icet import CrossValidationEstimator
+    from aiida_ce.fitting import cross_validate, validate, validate_candidates
+
+    fit_kwargs = dict(fit_kwargs or {'fit_method': 'lasso'})
+    arrays, results = {}, {}
+    validation = None
+
+    if column_sets is not None:
+        scores = [validate(fit_matrix[:, columns], target, fit_kwargs) for columns in column_sets]
+        arrays['columns_rmse_validation'] = np.array([score['rmse_validation'] for score in scores], dtype=float)
+        if np.all(np.isnan(arrays['columns_rmse_validation'])):
+            results.update({'selected_columns': None, 'selected_fit': None})
+            return arrays, results
+
+        best = int(np.nanargmin(arrays['columns_rmse_validation']))
+        results['selected_columns'] = best
+        fit_matrix = fit_matrix[:, column_sets[best]]
+        validation = scores[best]
+
+    if fit_candidates is not None:
+        scores = validate_candidates(fit_matrix, target, fit_candidates, n_workers=n_workers)
+        arrays['fit_rmse_validation'] = np.array([score['rmse_validation'] for score in scores], dtype=float)
+        arrays['fit_rmse_train'] = np.array([score['rmse_train'] for score in scores], dtype=float)
+        results['fit_errors'] = [score['error'] for score in scores]
+        if np.all(np.isnan(arrays['fit_rmse_validation'])):
+            results['selected_fit'] = None
+            return arrays, results
+
+        results['selected_fit_index'] = int(np.nanargmin(arrays['fit_rmse_validation']))
+        fit_kwargs = fit_candidates[results['selected_fit_index']]
+        validation = scores[results['selected_fit_index']]
+
+    results['selected_fit'] = fit_kwargs
+
+    if validation is None:
+        validation = cross_validate(fit_matrix, target, n_workers=n_workers, **fit_kwargs)
+    for key in ('rmse_train_splits', 'rmse_validation_splits', 'fold_times'):
+        arrays[f'validation_{key}'] = validation[key]
+
+    # icet standardizes the fit matrix in place, `fit_matrix` may be a read-only memory map
+    kwargs = dict(fit_kwargs)
+    opt = CrossValidationEstimator(fit_data=(np.array(fit_matrix), target), fit_method=kwargs.pop('fit_method'),
+                                   **kwargs)
+    opt.train()
+    arrays['parameters'] = np.asarray(opt.parameters, dtype=float)
+
+    metadata = opt.summary
+    metadata.update({key: validation[key] for key in ('rmse_train', 'rmse_validation')})
+    results['metadata'] = _to_json(metadata)
+
+    return arrays, results
+
+
+def train_cluster_expansion(cluster_space, fit_matrix, target, cutoffs_candidates=None, **kwargs):
+    """
+    Train a cluster expansion in the icet `cluster_space` with `train`,
+    selecting its cutoffs among the nested `cutoffs_candidates` if given.
+
+    The columns of the candidates are read from the orbits of `cluster_space`
+    (see `get_cutoffs_columns`), only the cluster space of the selected
+    candidate is built, once, for the cluster expansion.
+
+    :param kwargs: keyword arguments of `train`
+    :return: the arrays and the results of `train`, with the `column_sets` and
+        the `selected_cutoffs` of the candidates, and the icet cluster expansion,
+        None if no fit could be selected
+    """
+    from aiida_ce.data.cluster import build_nested_cluster_space, get_cutoffs_columns, new_cluster_expansion
+
+    column_sets = None
+    if cutoffs_candidates is not None:
+        column_sets = [get_cutoffs_columns(cluster_space, cutoffs).tolist() for cutoffs in cutoffs_candidates]
+
+    arrays, results = train(fit_matrix, target, column_sets=column_sets, **kwargs)
+    results['column_sets'] = column_sets
+    if results['selected_fit'] is None:
+        return arrays, results, None
+
+    if column_sets is not None:
+        results['selected_cutoffs'] = list(cutoffs_candidates[results['selected_columns']])
+        cluster_space = build_nested_cluster_space(cluster_space, results['selected_cutoffs'])
+
+    return arrays, results, new_cluster_expansion(cluster_space, arrays['parameters'], results['metadata'])
+
+
+def anneal(cluster_space, supercell, target_concentrations, optimality_weight=1., tol=1e-5, **kwargs):
+    """
+    Generate a special quasirandom structure in `supercell` by simulated annealing.
+
+    :param kwargs: keyword arguments of `generate_sqs_from_supercells`, e.g. `n_steps`
+    :return: dict of the ase `Atoms` `structure` of the SQS, its `cluster_vector`
+        and `objective`, all None with the `error` message if the annealing failed
+    """
+    from icet.tools.structure_generation import _get_sqs_cluster_vector, generate_sqs_from_supercells
+    from mchammer.calculators.target_vector_calculator import compare_cluster_vectors
+
+    try:
+        structure = generate_sqs_from_supercells(cluster_space=cluster_space,
+                                                 supercells=[supercell],
+                                                 target_concentrations=target_concentrations,
+                                                 optimality_weight=optimality_weight,
+                                                 tol=tol,
+                                                 **kwargs)
+    except Exception as exception:  # pylint: disable=broad-except
+        return {'structure': None, 'cluster_vector': None, 'objective': None, 'error': str(exception)}
+
+    cluster_vector = cluster_space.get_cluster_vector(structure)
+    objective = compare_cluster_vectors(cluster_vector,
+                                        _get_sqs_cluster_vector(cluster_space, target_concentrations),
+                                        cluster_space.orbit_data,
+                                        optimality_weight=optimality_weight,
+                                        tol=tol)
+
+    return {'structure': structure, 'cluster_vector': cluster_vector, 'objective': float(objective), 'error': None}
+
+
+def _init_sqs_worker(content, token, kwargs):
+    """pool initializer, set up the cluster space and keep the annealing parameters once per worker"""
+    from aiida_ce.parallel import _WORKER_STATE, _init_cluster_space_worker
+
+    _init_cluster_space_worker(content, token)
+    _WORKER_STATE['sqs_kwargs'] = kwargs
+
+
+def _worker_anneal(supercell):
+    """task of a worker, annealing in a supercell"""
+    from aiida_ce.parallel import _WORKER_STATE
+
+    return anneal(_WORKER_STATE['cluster_space'], supercell, **_WORKER_STATE['sqs_kwargs'])
+
+
+def sqs(cluster_space, supercells, target_concentrations, n_workers=None, content=None, **kwargs):
+    """
+    Anneal each of `supercells` independently, in a process pool with more
+    than one worker, and return the SQS with the lowest objective.
+
+    :param content: the already serialized `cluster_space`, or a function returning it, if available
+    :param kwargs: keyword arguments of `anneal`
+    :return: the ase `Atoms` of the best SQS (None if every annealing failed),
+        its cluster vector and the json serializable table of the `objectives`,
+        `n_atoms`, `cells` and `errors` of the supercells and of the `selected` one
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from aiida_ce.parallel import get_n_workers, share_cluster_space
+
+    kwargs = dict(kwargs, target_concentrations=target_concentrations)
+    n_workers = min(get_n_workers(n_workers), max(len(supercells), 1))
+    if n_workers == 1:
+        results = [anneal(cluster_space, supercell, **kwargs) for supercell in supercells]
+    else:
+        with share_cluster_space(cluster_space, content) as initargs:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_sqs_worker,
+                                     initargs=(*initargs, kwargs)) as executor:
+                results = list(executor.map(_worker_anneal, supercells))
+
+    objectives = np.array([np.nan if result['objective'] is None else result['objective'] for result in results])
+    table = {
+        'objectives': objectives,
+        'n_atoms': [len(supercell) for supercell in supercells],
+        'cells': [supercell.cell[:] for supercell in supercells],
+        'errors': [result['error'] for result in results],
+        'selected': None,
+    }
+    if np.all(np.isnan(objectives)):
+        return None, None, _to_json(table)
+
+    best = int(np.nanargmin(objectives))
+    table['selected'] = best
+
+    return results[best]['structure'], results[best]['cluster_vector'], _to_json(table)
+
+
+def objectives_to_array_data(table):
+    """return an unstored `ArrayData` of the objective table of `sqs`"""
+    from aiida import orm
+
+    objectives = orm.ArrayData()
+    objectives.set_array('objectives', np.array([np.nan if value is None else value for value in table['objectives']]))
+    objectives.set_array('n_atoms', np.array(table['n_atoms'], dtype=int))
+    objectives.set_array('cells', np.array(table['cells'], dtype=float).reshape(-1, 3, 3))
+    objectives.set_attribute('errors', table['errors'])
+    objectives.set_attribute('selected', table['selected'])
+
+    return objectives
+
+
+def _read_cluster_space():
+    """build the cluster space of the parameters in the working directory"""
+    with open(CLUSTER_SPACE_FILENAME, encoding='utf8') as handle:
+        return build_cluster_space(json.load(handle))
+
+
+def _run_fit_data(parameters):
+    """
+    write the fit matrix and target vector `fit_data_key` of the structures of
+    the `selection` of the db file of the working directory, skipping those
+    without the target property
+    """
+    from ase.db import connect
+
+    key = parameters['fit_data_key']
+    selection = parameters.get('selection') or None
+    target_selection = get_target_selection(selection, key)
+    db = connect(STRUCTURES_FILENAME)
+    targets = []
+
+    def iter_structures():
+        columns = ['id', 'numbers', 'positions', 'cell', 'pbc', 'key_value_pairs']
+        for row in db.select(target_selection, include_data=False, columns=columns):
+            targets.append(row.get(key))
+            yield row.toatoms()
+
+    write_fit_matrix(FIT_MATRIX_FILENAME, _read_cluster_space(), iter_structures(), db.count(target_selection),
+                     n_workers=parameters.get('n_workers'))
+    np.save(TARGET_FILENAME, np.array(targets, dtype=float))
+    with open(RESULTS_FILENAME, 'w', encoding='utf8') as handle:
+        json.dump({'n_structures': len(targets), 'n_skipped': db.count(selection) - len(targets)}, handle)
+
+
+def _run_train(parameters):
+    """
+    run `train_cluster_expansion` on the cluster space and the fit data of the
+    working directory and write its results and the cluster expansion
+    """
+    fit_matrix = np.load(FIT_MATRIX_FILENAME, mmap_mode='r')
+    arrays, results, cluster_expansion = train_cluster_expansion(_read_cluster_space(), fit_matrix,
+                                                                 np.load(TARGET_FILENAME), **parameters)
+
+    if cluster_expansion is not None:
+        cluster_expansion.write(CLUSTER_EXPANSION_FILENAME)
+    np.savez(RESULTS_ARRAYS_FILENAME, **arrays)
+    with open(RESULTS_FILENAME, 'w', encoding='utf8') as handle:
+        json.dump(_to_json(results), handle)
+
+
+def _run_sqs(parameters):
+    """run `sqs` on the cluster space and supercells of the working directory and write the best SQS"""
+    from ase.io import read, write
+
+    structure, cluster_vector, table = sqs(_read_cluster_space(), read(SUPERCELLS_FILENAME, index=':'), **parameters)
+
+    if structure is not None:
+        write(SQS_FILENAME, structure, format='extxyz')
+    with open(RESULTS_FILENAME, 'w', encoding='utf8') as handle:
+        json.dump({'cluster_vector': _to_json(cluster_vector), 'objectives': table}, handle)
+
+
+TASKS = {'fit_data': _run_fit_data, 'train': _run_train, 'sqs': _run_sqs}
+
+
+def main(argv=None):
+    """command line entry point, run a task in the working directory"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('task', choices=sorted(TASKS))
+    parser.add_argument('--max-concurrent-tasks', type=int, default=1,
+                        help='number of tasks running at the same time on this machine, a machine-global lock')
+    args = parser.parse_args(argv)
+
+    with open(PARAMETERS_FILENAME, encoding='utf8') as handle:
+        parameters = json.load(handle)
+
+    with task_slot(args.max_concurrent_tasks):
+        TASKS[args.task](parameters)
+
+
+if __name__ == '__main__':
+    main()
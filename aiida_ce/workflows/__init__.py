@@ -1,10 +1,21 @@
 # -*- coding: utf-8 -*-
 """init"""
+import os
+import tempfile
+
 from aiida import orm
+from aiida.common.hashing import make_hash
 from aiida.plugins import DataFactory
 from aiida.engine import WorkChain, calcfunction
 
+from aiida_ce.data.cluster import get_cluster_space_hash
+
 ClusterSpaceData = DataFactory('cluster_space')
+StructureDbData = DataFactory('structure_db')
+ClusterExpansionData = DataFactory('cluster_expansion')
+
+# extra of the fit data nodes with the hash of the inputs they were computed from
+FIT_DATA_HASH_EXTRA = 'fit_data_hash'
 
 
 @calcfunction
@@ -23,3 +34,255 @@ def _create_cluster_space(primitive_structure: orm.StructureData,
                 chemical_symbols=chemical_symbols)
 
     return cs_data
+
+
+def _find_cluster_space(primitive_structure: orm.StructureData,
+                        cutoffs: orm.List,
+                        chemical_symbols: orm.List):
+    """
+    return a stored cluster space identical to the one `_create_cluster_space`
+    would create from the same inputs, or None if there is none yet.
+
+    The lookup is done on the canonical content hash, so the order of atoms
+    in the primitive structure and numerical noise are not relevant.
+    """
+    content_hash = get_cluster_space_hash(primitive_structure.get_ase(),
+                                          cutoffs=cutoffs.get_list(),
+                                          chemical_symbols=chemical_symbols.get_list())
+
+    return ClusterSpaceData.find_by_content_hash(content_hash)
+
+
+@calcfunction
+def _create_nested_cluster_space(cluster_space: ClusterSpaceData, cutoffs: orm.List) -> ClusterSpaceData:
+    """calculation function to create the cluster space of the smaller
+    `cutoffs` nested in `cluster_space`, without building it"""
+    return cluster_space.get_nested_cluster_space(cutoffs.get_list())
+
+
+def get_fit_data_hash(cluster_space: ClusterSpaceData, structure_db: StructureDbData, selection: orm.Str,
+                      fit_data_key: orm.Str) -> str:
+    """return the hash identifying the fit data of the `selection` of `structure_db` in `cluster_space`"""
+    return make_hash([cluster_space.get_content_hash(), structure_db.uuid, selection.value, fit_data_key.value])
+
+
+def _report_progress(done, total, previous=0, steps=10):
+    """
+    report `done` of `total` cluster vectors as the status of the running
+    process and of its caller, and in its log every `1 / steps` of the total.
+
+    :return: the number of steps reported so far
+    """
+    from aiida.engine import Process
+
+    process = Process.current()
+    if process is None:
+        return previous
+
+    message = f'computed {done} of {total} cluster vectors'
+    for node in (process.node, process.node.caller):
+        if node is not None:
+            node.set_process_status(message)
+
+    reached = steps * done // max(total, 1)
+    if reached > previous:
+        process.report(message)
+
+    return reached
+
+
+def _write_fit_matrix(path, cs, structure_db, selection, key, n_workers=None, head=None, head_columns=None):
+    """
+    write the fit matrix in `cs` of the `selection` of structures in
+    `structure_db` in the .npy memory map `path` with `tasks.write_fit_matrix`,
+    reporting the progress. The structures without the property `key` are
+    skipped and their number reported.
+
+    :return: the target vector `key` of the structures and the number of skipped structures
+    """
+    import numpy as np
+    from aiida.engine import Process
+    from aiida_ce.tasks import get_target_selection, write_fit_matrix
+
+    target_selection = get_target_selection(selection, key)
+    total = structure_db.count(target_selection)
+    n_skipped = structure_db.count(selection or None) - total
+    process = Process.current()
+    if n_skipped and process is not None:
+        process.report(f'skipped {n_skipped} structures without `{key}`')
+
+    targets = []
+    reported = 0
+
+    def iter_structures():
+        for batch in structure_db.iter_structures(selection=target_selection, columns=[key]):
+            for structure, properties in batch:
+                targets.append(properties[key])
+                yield structure
+
+    def progress(done, total):
+        nonlocal reported
+        reported = _report_progress(done, total, reported)
+
+    write_fit_matrix(path,
+                     cs,
+                     iter_structures(),
+                     total,
+                     n_workers=n_workers,
+                     head=head,
+                     head_columns=head_columns,
+                     progress=progress)
+
+    return np.array(targets, dtype=float), n_skipped
+
+
+def _set_array_file(array_data, name, path):
+    """set the array `name` of an unstored `array_data` from the .npy file `path`, without loading it"""
+    import numpy as np
+
+    shape = np.load(path, mmap_mode='r').shape
+    array_data.put_object_from_file(path, f'{name}.npy', mode='wb', encoding=None)
+    array_data.set_attribute(f'{array_data.array_prefix}{name}', list(shape))
+
+
+def get_fit_arrays(fit_data: orm.ArrayData):
+    """
+    return the fit matrix of `fit_data`, memory mapped read-only from the
+    repository instead of loaded, and its target vector
+    """
+    import numpy as np
+
+    return np.load(_get_object_path(fit_data, 'fit_matrix.npy'), mmap_mode='r'), fit_data.get_array('target')
+
+
+def _get_object_path(node, key):
+    """
+    return the absolute path of the object `key` of the repository of `node`,
+    or raise if the repository does not keep it as a file on disk
+    """
+    with node.open(key, mode='rb') as handle:
+        path = getattr(handle, 'name', None)
+
+    if not isinstance(path, str) or not os.path.isabs(path) or not os.path.isfile(path):
+        raise ValueError(f'the object `{key}` of {node} is not a file on disk and can not be memory mapped')
+
+    return path
+
+
+def _new_fit_data(fit_matrix_path, target, key, selection, n_skipped=0):
+    """return the unstored fit data with the fit matrix of the file `fit_matrix_path`,
+    and the number of structures of the selection skipped without target property"""
+    fit_data = orm.ArrayData()
+    _set_array_file(fit_data, 'fit_matrix', fit_matrix_path)
+    fit_data.set_array('target', target)
+    fit_data.set_attribute('fit_data_key', key)
+    fit_data.set_attribute('selection', selection)
+    fit_data.set_attribute('n_skipped', n_skipped)
+
+    return fit_data
+
+
+@calcfunction
+def _create_fit_data(cluster_space: ClusterSpaceData,
+                     structure_db: StructureDbData,
+                     selection: orm.Str,
+                     fit_data_key: orm.Str,
+                     n_workers: orm.Int = None) -> orm.ArrayData:
+    """calculation function to compute the fit matrix (cluster vectors) and the
+    target vector of the `selection` of structures in `structure_db`, the
+    cluster vectors being computed in a pool of `n_workers` processes and
+    streamed to the repository"""
+    key = fit_data_key.value
+    with tempfile.TemporaryDirectory() as dirpath:
+        path = os.path.join(dirpath, 'fit_matrix.npy')
+        target, n_skipped = _write_fit_matrix(path,
+                                              cluster_space.get_noumenon(),
+                                              structure_db,
+                                              selection.value,
+                                              key,
+                                              n_workers=n_workers.value if n_workers is not None else None)
+
+        return _new_fit_data(path, target, key, selection.value, n_skipped)
+
+
+@calcfunction
+def _extend_fit_data(cluster_space: ClusterSpaceData,
+                     fit_data: orm.ArrayData,
+                     structure_db: StructureDbData,
+                     selection: orm.Str,
+                     n_workers: orm.Int = None,
+                     columns: orm.List = None) -> orm.ArrayData:
+    """calculation function to append the rows of the `selection` of new
+    structures in `structure_db` to the fit data in `cluster_space`, only the
+    cluster vectors of the new structures being computed. The `columns` of
+    the fit data are kept if given, for fit data computed in a cluster space
+    with larger cutoffs."""
+    import numpy as np
+
+    key = fit_data.get_attribute('fit_data_key')
+    fit_matrix, target = get_fit_arrays(fit_data)
+    head_columns = np.array(columns.get_list(), dtype=int) if columns is not None else None
+    with tempfile.TemporaryDirectory() as dirpath:
+        path = os.path.join(dirpath, 'fit_matrix.npy')
+        new_target, n_skipped = _write_fit_matrix(path,
+                                                  cluster_space.get_noumenon(),
+                                                  structure_db,
+                                                  selection.value,
+                                                  key,
+                                                  n_workers=n_workers.value if n_workers is not None else None,
+                                                  head=fit_matrix,
+                                                  head_columns=head_columns)
+
+        extended = _new_fit_data(path, np.concatenate([target, new_target]), key, selection.value, n_skipped)
+        extended.set_attribute('n_new_rows', len(new_target))
+
+        return extended
+
+
+@calcfunction
+def _warm_start_train(cluster_expansion: ClusterExpansionData,
+                      fit_data: orm.ArrayData,
+                      alpha: orm.Float = None) -> ClusterExpansionData:
+    """calculation function to train a cluster expansion on `fit_data` with
+    lasso, starting from the parameters of `cluster_expansion`"""
+    import numpy as np
+    from aiida_ce.fitting import fit_warm_start
+
+    fit_matrix, target = get_fit_arrays(fit_data)
+    previous = cluster_expansion.get_noumenon()
+
+    if alpha is not None:
+        alpha = alpha.value
+    else:
+        alpha = previous.metadata.get('alpha_optimal', previous.metadata.get('alpha'))
+
+    result = fit_warm_start(fit_matrix, target, cluster_expansion.get_parameters(), alpha=alpha)
+    parameters = result['parameters']
+
+    metadata = {
+        'fit_method': 'lasso',
+        'warm_start': True,
+        'alpha': result['alpha'],
+        'n_iterations': result['n_iterations'],
+        'n_structures': len(target),
+        'n_new_structures': fit_data.get_attribute('n_new_rows', None),
+        'rmse_train': float(np.sqrt(np.mean((fit_matrix @ parameters - target)**2))),
+    }
+
+    # the cluster space of the previous expansion is shared, not analysed again
+    cluster_space = previous._cluster_space  # pylint: disable=protected-access
+    ce_data = ClusterExpansionData()
+    ce_data.set(cluster_space=cluster_space, parameters=parameters, metadata=metadata)
+    ce_data.set_attribute('predecessor_uuid', cluster_expansion.uuid)
+
+    return ce_data
+
+
+def _find_fit_data(fit_data_hash: str):
+    """return the stored fit data with the given `get_fit_data_hash`, or None"""
+    query = orm.QueryBuilder()
+    query.append(orm.ArrayData, tag='fit_data', filters={f'extras.{FIT_DATA_HASH_EXTRA}': fit_data_hash})
+    query.order_by({'fit_data': {'ctime': 'asc'}})
+    result = query.first()
+
+    return result[0] if result else None
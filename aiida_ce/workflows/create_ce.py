@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
 """ce create"""
-from icet import StructureContainer, CrossValidationEstimator
+import numpy as np
 from aiida import orm
-from aiida.engine import WorkChain, run_get_node
-from aiida.plugins import DataFactory
+from aiida.engine import ToContext, WorkChain, if_, run_get_node
+from aiida.plugins import CalculationFactory, DataFactory
 
-from . import _create_cluster_space
+from aiida_ce.fitting import get_fit_candidates
+from aiida_ce.tasks import train_cluster_expansion
+from . import (FIT_DATA_HASH_EXTRA, _create_cluster_space, _create_fit_data, _create_nested_cluster_space,
+               _find_cluster_space, _find_fit_data, get_fit_arrays, get_fit_data_hash)
 
 StructureDbData = DataFactory('structure_db')
 ClusterExpansionData = DataFactory('cluster_expansion')
 ClusterSpaceData = DataFactory('cluster_space')
+IcetFitDataCalculation = CalculationFactory('icet.fit_data')
+IcetTrainCalculation = CalculationFactory('icet.train')
 
 
 class ConstructClusterExpansion(WorkChain):
@@ -22,20 +27,66 @@ class ConstructClusterExpansion(WorkChain):
         spec.expose_inputs(_create_cluster_space, namespace='cluster_space')
         spec.input('structure_db', valid_type=StructureDbData,
                    help='reference data contain structures and their properties.')
+        spec.input('selection', valid_type=orm.Str, default=lambda: orm.Str('natoms<=8'),
+                   help='ase db selection of the structures used for training, all of them if empty.')
         spec.input('fit_data_key', valid_type=orm.Str, default=lambda: orm.Str('mixing_energy'),
                    help='The key of target properties for all structures.')
         spec.input('fit_method', valid_type=orm.Str, default=lambda: orm.Str('lasso'),
                    help='method to be used for training.')
+        spec.input('fit_methods', valid_type=orm.List, required=False,
+                   help='Grids of fit methods and their hyperparameters to select from by cross validation, '
+                        'e.g. `[{"fit_method": "lasso", "alpha": [1e-4, 1e-3]}, {"fit_method": "ardr"}]`, '
+                        'a list of values being a grid axis. Overrides `fit_method`.')
+        spec.input('code', valid_type=orm.Code, required=False,
+                   help='python interpreter with aiida-ce installed, to compute the fit data and train in local '
+                        '`IcetFitDataCalculation` and `IcetTrainCalculation` instead of in the daemon worker '
+                        'running this workflow.')
         spec.input('options', valid_type=orm.Dict, required=False,
-                   help='Optional `options` to use.')
+                   help='Optional `options` of the calculation jobs, e.g. `max_concurrent_tasks`.')
+        spec.input('n_workers', valid_type=orm.Int, required=False,
+                   help='number of worker processes computing the cluster vectors and cross validating the fit '
+                        'candidates. Without `code` the pools run in the daemon worker, so it is 1 by default, '
+                        'otherwise all cores.')
+        spec.input('cutoffs_candidates', valid_type=orm.List, required=False,
+                   help='List of cutoffs nested in `cluster_space.cutoffs` to select from by cross validation. '
+                        'The cluster vectors are computed once with `cluster_space.cutoffs`.')
         spec.outline(
             cls.setup,
             cls.create_cluster_space,
-            cls.train,
-            # cls.result,
+            cls.find_fit_data,
+            if_(cls.should_create_fit_data)(
+                if_(cls.should_run_calculation)(
+                    cls.run_fit_data_calculation,
+                    cls.inspect_fit_data_calculation,
+                ).else_(
+                    cls.create_fit_data,
+                ),
+            ),
+            cls.prepare_training,
+            if_(cls.should_run_calculation)(
+                cls.run_train_calculation,
+                cls.inspect_train_calculation,
+            ).else_(
+                cls.train,
+            ),
+            cls.results,
         )
         spec.output('cluster_expansion', valid_type=ClusterExpansionData,
             help='The output cluster expansion.')
+        spec.output('fit_data', valid_type=orm.ArrayData,
+            help='The fit matrix and target vector the cluster expansion is trained on.')
+        spec.output('cluster_space', valid_type=ClusterSpaceData, required=False,
+            help='The cluster space of the selected `cutoffs_candidates`, the one of the cluster expansion.')
+        spec.output('cutoffs_scores', valid_type=orm.ArrayData, required=False,
+            help='The cross validation scores of each of the `cutoffs_candidates`.')
+        spec.output('fit_scores', valid_type=orm.ArrayData, required=False,
+            help='The cross validation scores of each candidate of the `fit_methods` grids.')
+        spec.exit_code(300, 'ERROR_NO_VALID_FIT',
+            message='None of the fit methods candidates could be cross validated.')
+        spec.exit_code(301, 'ERROR_TRAIN_CALCULATION_FAILED',
+            message='The training calculation job failed.')
+        spec.exit_code(302, 'ERROR_FIT_DATA_CALCULATION_FAILED',
+            message='The fit data calculation job failed.')
 
     def setup(self):
         """setup the ctx parameters"""
@@ -43,30 +94,210 @@ class ConstructClusterExpansion(WorkChain):
         self.ctx.fit_method = self.inputs.fit_method.value
 
     def create_cluster_space(self):
-        """create cluster space with icet and store it as a cluster space data type"""
-        self.ctx.cluster_space, _ = run_get_node(_create_cluster_space,
-                              **self.exposed_inputs(_create_cluster_space, namespace='cluster_space'))
+        """create cluster space with icet and store it as a cluster space data type,
+        or reuse an identical cluster space which is already stored"""
+        inputs = self.exposed_inputs(_create_cluster_space, namespace='cluster_space')
+        cluster_space = _find_cluster_space(inputs['primitive_structure'], inputs['cutoffs'],
+                                            inputs['chemical_symbols'])
+        if cluster_space is not None:
+            self.report(f'reusing the identical cluster space <{cluster_space.pk}>')
+            self.ctx.cluster_space = cluster_space
+            return
+
+        self.ctx.cluster_space, _ = run_get_node(_create_cluster_space, **inputs)
+
+    def _get_fit_data_inputs(self):
+        """return the inputs the fit data are computed from"""
+        return {
+            'cluster_space': self.ctx.cluster_space,
+            'structure_db': self.inputs.structure_db,
+            'selection': self.inputs.selection,
+            'fit_data_key': self.inputs.fit_data_key,
+        }
+
+    def _set_fit_data(self, fit_data):
+        """set the fit data the cluster expansion is trained on"""
+        self.ctx.fit_data = fit_data
+        self.out('fit_data', fit_data)
+
+    def find_fit_data(self):
+        """reuse the fit data computed for the same cluster space and structures"""
+        self.ctx.fit_data_hash = get_fit_data_hash(**self._get_fit_data_inputs())
+        fit_data = _find_fit_data(self.ctx.fit_data_hash)
+        if fit_data is not None:
+            self.report(f'reusing the fit data <{fit_data.pk}>')
+            self._set_fit_data(fit_data)
+
+    def should_create_fit_data(self):
+        """whether the fit data have to be computed"""
+        return 'fit_data' not in self.ctx
+
+    def run_fit_data_calculation(self):
+        """submit the computation of the fit data as a local calculation job"""
+        inputs = self._get_fit_data_inputs()
+        inputs.update({
+            'code': self.inputs.code,
+            'metadata': {
+                'options': self.inputs.options.get_dict() if 'options' in self.inputs else {},
+            },
+        })
+        if 'n_workers' in self.inputs:
+            inputs['parameters'] = orm.Dict(dict={'n_workers': self.inputs.n_workers.value})
+        running = self.submit(IcetFitDataCalculation, **inputs)
+        self.report(f'launching IcetFitDataCalculation<{running.pk}>')
+
+        return ToContext(fit_data_calculation=running)
+
+    def inspect_fit_data_calculation(self):
+        """take the fit data computed by the calculation job"""
+        calculation = self.ctx.fit_data_calculation
+        if not calculation.is_finished_ok:
+            self.report(f'IcetFitDataCalculation<{calculation.pk}> failed with exit status {calculation.exit_status}')
+            return self.exit_codes.ERROR_FIT_DATA_CALCULATION_FAILED
+
+        fit_data = calculation.outputs.fit_data
+        fit_data.set_extra(FIT_DATA_HASH_EXTRA, self.ctx.fit_data_hash)
+        self._set_fit_data(fit_data)
+
+    def create_fit_data(self):
+        """compute the fit matrix and target vector of the selected structures in this process,
+        the cluster vectors in a process pool only if `n_workers` is given"""
+        inputs = self._get_fit_data_inputs()
+        inputs['n_workers'] = self.inputs.n_workers if 'n_workers' in self.inputs else orm.Int(1)
+        fit_data, _ = run_get_node(_create_fit_data, **inputs)
+        fit_data.set_extra(FIT_DATA_HASH_EXTRA, self.ctx.fit_data_hash)
+        self._set_fit_data(fit_data)
+
+    def prepare_training(self):
+        """set the parameters of the training, the columns of the cutoffs
+        candidates are read from the cluster space by the training itself"""
+        parameters = {'fit_kwargs': {'fit_method': self.ctx.fit_method}}
+        if 'fit_methods' in self.inputs:
+            parameters['fit_candidates'] = get_fit_candidates(self.inputs.fit_methods.get_list())
+        if 'n_workers' in self.inputs:
+            parameters['n_workers'] = self.inputs.n_workers.value
+
+        if 'cutoffs_candidates' in self.inputs:
+            parameters['cutoffs_candidates'] = self.inputs.cutoffs_candidates.get_list()
+
+        self.ctx.train_parameters = parameters
+
+    def should_run_calculation(self):
+        """whether the fit data and training run as calculation jobs, outside of the daemon"""
+        return 'code' in self.inputs
+
+    def run_train_calculation(self):
+        """submit the training as a local calculation job"""
+        inputs = {
+            'code': self.inputs.code,
+            'cluster_space': self.ctx.cluster_space,
+            'fit_data': self.ctx.fit_data,
+            'parameters': orm.Dict(dict=self.ctx.train_parameters),
+            'metadata': {
+                'options': self.inputs.options.get_dict() if 'options' in self.inputs else {},
+            },
+        }
+        running = self.submit(IcetTrainCalculation, **inputs)
+        self.report(f'launching IcetTrainCalculation<{running.pk}>')
+
+        return ToContext(train_calculation=running)
+
+    def inspect_train_calculation(self):
+        """take the results of the training calculation job"""
+        calculation = self.ctx.train_calculation
+        if not calculation.is_finished_ok:
+            self.report(f'IcetTrainCalculation<{calculation.pk}> failed with exit status {calculation.exit_status}')
+            return self.exit_codes.ERROR_TRAIN_CALCULATION_FAILED
+
+        results = calculation.outputs.results
+        arrays = {name: results.get_array(name) for name in results.get_arraynames()}
+        self.ctx.training = arrays, calculation.outputs.info.get_dict()
+        if 'cluster_expansion' in calculation.outputs:
+            self.ctx.cluster_expansion = calculation.outputs.cluster_expansion
 
     def train(self):
-        """train and store cluster expansion data type"""
-        cs = self.ctx.cluster_space.get_noumenon()
-
-        db = self.inputs.structure_db.get_db()
-        structures = db.select('natoms<=8')
-        sc = StructureContainer(cluster_space=cs)
-        for row in structures:
-            sc.add_structure(structure=row.toatoms(),
-                            user_tag=row.tag,
-                            properties={self.ctx.fit_data_key: row.mixing_energy})
-
-        opt = CrossValidationEstimator(fit_data=sc.get_fit_data(key=self.ctx.fit_data_key),
-                                fit_method=self.ctx.fit_method)
-        opt.validate()
-        opt.train()
+        """train the cluster expansion in this process, cross validating in a
+        process pool only if `n_workers` is given"""
+        parameters = dict(self.ctx.train_parameters)
+        parameters.setdefault('n_workers', 1)
+        arrays, info, cluster_expansion = train_cluster_expansion(self.ctx.cluster_space.get_noumenon(),
+                                                                  *get_fit_arrays(self.ctx.fit_data), **parameters)
+        self.ctx.training = arrays, info
+        if cluster_expansion is None:
+            return
 
         ce_data = ClusterExpansionData()
-        ce_data.set(cluster_space=cs,
-                    parameters=opt.parameters,
-                    metadata=opt.summary)
+        ce_data.set_from_cluster_expansion(cluster_expansion)
+        for key in ('rmse_train_splits', 'rmse_validation_splits', 'fold_times'):
+            ce_data.set_array(f'validation_{key}', arrays[f'validation_{key}'])
+        self.ctx.cluster_expansion = ce_data.store()
+
+    def results(self):
+        """report the selections and output the cluster expansion data type"""
+        arrays, info = self.ctx.training
+
+        if 'cutoffs_candidates' in self.inputs:
+            self._set_cutoffs_scores(arrays, info)
+        if 'fit_methods' in self.inputs:
+            self._set_fit_scores(arrays, info)
+        if 'cluster_expansion' not in self.ctx:
+            return self.exit_codes.ERROR_NO_VALID_FIT
+
+        fold_times = arrays['validation_fold_times']
+        self.report(f'validation RMSE {info["metadata"]["rmse_validation"]}, '
+                    f'{len(fold_times)} folds in {fold_times.sum():.2f} s')
+
+        self.out('cluster_expansion', self.ctx.cluster_expansion)
+
+    def _set_cutoffs_scores(self, arrays, info):
+        """report the validation RMSE of the cutoffs candidates, output the
+        scores and the cluster space of the selected cutoffs"""
+        cutoffs_candidates = self.inputs.cutoffs_candidates.get_list()
+        rmse_validation = arrays['columns_rmse_validation']
+        for cutoffs, rmse in zip(cutoffs_candidates, rmse_validation):
+            self.report(f'cutoffs {cutoffs}: validation RMSE {rmse}')
+
+        best = info['selected_columns']
+        if best is None:
+            return
+
+        cutoffs = cutoffs_candidates[best]
+        self.report(f'selected cutoffs {cutoffs}')
+
+        scores = orm.ArrayData()
+        scores.set_array('rmse_validation', rmse_validation)
+        scores.set_array('selected', np.array([best]))
+        self.out('cutoffs_scores', scores.store())
+
+        cluster_space = self.ctx.cluster_space
+        if list(cutoffs) != list(cluster_space.get_attribute('cutoffs')):
+            cluster_space, _ = run_get_node(_create_nested_cluster_space,
+                                            cluster_space=cluster_space,
+                                            cutoffs=orm.List(list=list(cutoffs)))
+        self.out('cluster_space', cluster_space)
+
+    def _set_fit_scores(self, arrays, info):
+        """report the validation RMSE of the candidates of the `fit_methods`
+        grids and output the scores if one of them could be validated"""
+        candidates = self.ctx.train_parameters['fit_candidates']
+        if 'fit_rmse_validation' not in arrays:
+            return
+
+        for candidate, rmse, error in zip(candidates, arrays['fit_rmse_validation'], info['fit_errors']):
+            if error is not None:
+                self.report(f'{candidate} failed: {error}')
+            else:
+                self.report(f'{candidate}: validation RMSE {rmse}')
+
+        if info['selected_fit'] is None:
+            return
+
+        best = info['selected_fit_index']
+        self.report(f'selected {candidates[best]}')
 
-        self.out('cluster_expansion', ce_data.store())
+        table = orm.ArrayData()
+        table.set_array('rmse_validation', arrays['fit_rmse_validation'])
+        table.set_array('rmse_train', arrays['fit_rmse_train'])
+        table.set_array('selected', np.array([best]))
+        table.set_attribute('candidates', candidates)
+        self.out('fit_scores', table.store())
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""workflow to sample a cluster expansion with Monte Carlo"""
+from aiida import orm
+from aiida.engine import WorkChain, while_
+from aiida.plugins import DataFactory
+
+from aiida_ce.data.cache import LRUCache
+from aiida_ce.sampling import (ENSEMBLES, get_calculator, get_ensemble, get_ladder, get_ladder_averages,
+                                get_ladder_state, get_random_state, run_chunk, run_ladder_segment)
+
+ClusterExpansionData = DataFactory('cluster_expansion')
+
+# setting up the calculator (local orbit lists of every site) is the expensive
+# part of an ensemble, it is reused between the chunks run by this process
+_CALCULATOR_CACHE = LRUCache(maxsize=4)
+
+
+def _get_calculator(cluster_expansion: ClusterExpansionData, supercell: orm.StructureData):
+    """return the cached mchammer calculator of a cluster expansion on a supercell"""
+    key = (cluster_expansion.uuid, supercell.uuid)
+    calculator = _CALCULATOR_CACHE.get(key)
+    if calculator is None:
+        calculator = get_calculator(cluster_expansion.get_noumenon(pruned=True), supercell.get_ase())
+        _CALCULATOR_CACHE.put(key, calculator)
+
+    return calculator
+
+
+class IcetMonteCarloWorkChain(WorkChain):
+    """
+    WorkChain to sample a cluster expansion on a supercell with a mchammer ensemble.
+
+    The trial steps are run in chunks of `chunk_size`, every chunk being a
+    step of the workchain. Observations and snapshots of a chunk are stored
+    as an `ArrayData` output right away, and the state needed to continue
+    (occupations, step and random number generator) is kept on it, so that
+    a workchain whose daemon worker died is resumed from its last chunk.
+    """
+    @classmethod
+    def define(cls, spec):
+        """Define the process spec"""
+        # yapf: disable
+        super().define(spec)
+        spec.input('cluster_expansion', valid_type=ClusterExpansionData,
+                   help='The cluster expansion to sample.')
+        spec.input('supercell', valid_type=orm.StructureData,
+                   help='The supercell with the initial occupations.')
+        spec.input('ensemble', valid_type=orm.Str, default=lambda: orm.Str('canonical'),
+                   help=f'The ensemble to sample, one of {ENSEMBLES}.')
+        spec.input('temperature', valid_type=orm.Float,
+                   help='temperature of the ensemble in Kelvin')
+        spec.input('chemical_potentials', valid_type=orm.Dict, required=False,
+                   help='chemical potential of each species, for the semi-grand canonical ensemble')
+        spec.input('n_steps', valid_type=orm.Int,
+                   help='total number of Monte Carlo trial steps')
+        spec.input('chunk_size', valid_type=orm.Int, default=lambda: orm.Int(100000),
+                   help='number of trial steps in a chunk, the state is checkpointed after every chunk')
+        spec.input('observation_interval', valid_type=orm.Int, required=False,
+                   help='interval of trial steps between observations, the number of sites by default')
+        spec.input('trajectory_interval', valid_type=orm.Int, required=False,
+                   help='interval of trial steps between snapshots, the number of sites by default')
+        spec.input('random_seed', valid_type=orm.Int, default=lambda: orm.Int(1234),
+                   help='seed for the random number generator used in the Monte Carlo simulation')
+        spec.outline(
+            cls.setup,
+            while_(cls.should_run_chunk)(
+                cls.run_chunk,
+            ),
+            cls.results,
+        )
+        spec.output_namespace('chunks', valid_type=orm.ArrayData, dynamic=True,
+                   help='observables and snapshots of every chunk of trial steps.')
+        spec.output('final_structure', valid_type=orm.StructureData,
+                   help='The configuration at the end of the sampling.')
+        spec.exit_code(300, 'ERROR_INVALID_ENSEMBLE',
+                   message='The ensemble is unknown or its parameters are missing.')
+
+    def setup(self):
+        """setup the ctx parameters"""
+        self.ctx.ensemble = self.inputs.ensemble.value
+        if self.ctx.ensemble not in ENSEMBLES:
+            self.report(f'unknown ensemble `{self.ctx.ensemble}`')
+            return self.exit_codes.ERROR_INVALID_ENSEMBLE
+
+        if self.ctx.ensemble == 'semi_grand_canonical' and 'chemical_potentials' not in self.inputs:
+            self.report('the semi-grand canonical ensemble requires `chemical_potentials`')
+            return self.exit_codes.ERROR_INVALID_ENSEMBLE
+
+        self.ctx.step = 0
+        self.ctx.chunk_index = 0
+        self.ctx.last_chunk = None
+
+    def should_run_chunk(self):
+        """whether there are trial steps left"""
+        return self.ctx.step < self.inputs.n_steps.value
+
+    def _get_optional_inputs(self):
+        """return the optional ensemble parameters which are given as keyword arguments"""
+        kwargs = {}
+        if 'chemical_potentials' in self.inputs:
+            kwargs['chemical_potentials'] = self.inputs.chemical_potentials.get_dict()
+        if 'observation_interval' in self.inputs:
+            kwargs['observation_interval'] = self.inputs.observation_interval.value
+        if 'trajectory_interval' in self.inputs:
+            kwargs['trajectory_interval'] = self.inputs.trajectory_interval.value
+
+        return kwargs
+
+    def run_chunk(self):
+        """run a chunk of trial steps from the state of the previous chunk"""
+        structure = self.inputs.supercell.get_ase()
+        random_state = None
+        if self.ctx.last_chunk is not None:
+            structure.numbers = self.ctx.last_chunk.get_array('last_occupations')
+            random_state = self.ctx.last_chunk.get_attribute('random_state')
+
+        ensemble = get_ensemble(self.ctx.ensemble,
+                                calculator=_get_calculator(self.inputs.cluster_expansion, self.inputs.supercell),
+                                structure=structure,
+                                temperature=self.inputs.temperature.value,
+                                random_seed=self.inputs.random_seed.value,
+                                **self._get_optional_inputs())
+
+        n_steps = min(self.inputs.chunk_size.value, self.inputs.n_steps.value - self.ctx.step)
+        arrays = run_chunk(ensemble, n_steps, first_step=self.ctx.step, random_state=random_state)
+
+        chunk = orm.ArrayData()
+        for name, array in arrays.items():
+            chunk.set_array(name, array)
+        chunk.set_array('last_occupations', ensemble.structure.numbers)
+        chunk.set_attribute('random_state', get_random_state())
+        chunk.set_attribute('first_step', self.ctx.step)
+        chunk.set_attribute('n_steps', n_steps)
+
+        self.out(f'chunks.chunk_{self.ctx.chunk_index:05d}', chunk.store())
+
+        self.ctx.last_chunk = chunk
+        self.ctx.step += n_steps
+        self.ctx.chunk_index += 1
+        self.report(f'ran {self.ctx.step} of {self.inputs.n_steps.value} trial steps')
+
+    def results(self):
+        """output the final configuration"""
+        structure = self.inputs.supercell.get_ase()
+        if self.ctx.last_chunk is not None:
+            structure.numbers = self.ctx.last_chunk.get_array('last_occupations')
+
+        self.out('final_structure', orm.StructureData(ase=structure).store())
+
+
+def _get_segment_state(segment: orm.ArrayData):
+    """return the state of the ladder kept on the output of a segment, see `run_ladder_segment`"""
+    state = {name: segment.get_array(name) for name in ('occupations', 'n_attempts', 'n_accepted')}
+    state.update({name: segment.get_attribute(name) for name in ('step', 'segment', 'random_states')})
+
+    return state
+
+
+def _get_segment_observations(segment: orm.ArrayData, n_points: int):
+    """return the list of the observations of every point of the output of a segment"""
+    observations = [{} for _ in range(n_points)]
+    for name in segment.get_arraynames():
+        if name.startswith('point_'):
+            index, observable = name[len('point_'):].split('_', 1)
+            observations[int(index)][observable] = segment.get_array(name)
+
+    return observations
+
+
+class IcetParallelTemperingWorkChain(WorkChain):
+    """
+    WorkChain to sample a cluster expansion on a supercell at a ladder of
+    temperatures (or chemical potentials), one ensemble per point.
+
+    With `exchange_interval` the configurations of neighbouring points are
+    exchanged (replica exchange) between segments of trial steps. Every
+    segment of all the points is a step of the workchain, optionally run in
+    a pool of worker processes, and its observations and the state of the
+    replicas are stored as an `ArrayData` output right away, so that the
+    sampling is resumed from the last segment. The averages and fluctuations
+    of the observables of all the points are collected into one `ArrayData` table.
+    """
+    @classmethod
+    def define(cls, spec):
+        """Define the process spec"""
+        # yapf: disable
+        super().define(spec)
+        spec.input('cluster_expansion', valid_type=ClusterExpansionData,
+                   help='The cluster expansion to sample.')
+        spec.input('supercell', valid_type=orm.StructureData,
+                   help='The supercell with the initial occupations of every point.')
+        spec.input('ensemble', valid_type=orm.Str, default=lambda: orm.Str('canonical'),
+                   help=f'The ensemble to sample, one of {ENSEMBLES}.')
+        spec.input('temperatures', valid_type=orm.List,
+                   help='temperatures of the ladder in Kelvin, a single one for a ladder of chemical potentials')
+        spec.input('chemical_potentials', valid_type=orm.List, required=False,
+                   help='chemical potentials of each species (dicts) of the ladder, for the semi-grand canonical '
+                   'ensemble, a single one for a ladder of temperatures')
+        spec.input('n_steps', valid_type=orm.Int,
+                   help='number of Monte Carlo trial steps of every point')
+        spec.input('n_equilibration_steps', valid_type=orm.Int, default=lambda: orm.Int(0),
+                   help='number of trial steps left out of the averages')
+        spec.input('exchange_interval', valid_type=orm.Int, required=False,
+                   help='interval of trial steps between replica exchanges, no exchange if not given')
+        spec.input('observation_interval', valid_type=orm.Int, required=False,
+                   help='interval of trial steps between observations, the number of sites by default')
+        spec.input('random_seed', valid_type=orm.Int, default=lambda: orm.Int(1234),
+                   help='seed for the random number generators, point `i` is seeded with `random_seed + i`')
+        spec.input('n_workers', valid_type=orm.Int, default=lambda: orm.Int(1),
+                   help='number of worker processes (at most one per point), 1 to run the points in this process')
+        spec.outline(
+            cls.setup,
+            while_(cls.should_run_segment)(
+                cls.run_segment,
+            ),
+            cls.results,
+        )
+        spec.output_namespace('segments', valid_type=orm.ArrayData, dynamic=True,
+                   help='observables of every point (`point_<index>_<name>` arrays) and state of the replicas '
+                   'after every segment of trial steps.')
+        spec.output('averages', valid_type=orm.ArrayData,
+                   help='averages and standard deviations of the observables of every point.')
+        spec.output_namespace('final_structures', valid_type=orm.StructureData, dynamic=True,
+                   help='The configuration of every point at the end of the sampling.')
+        spec.exit_code(300, 'ERROR_INVALID_ENSEMBLE',
+                   message='The ensemble is unknown or its parameters are missing.')
+        spec.exit_code(301, 'ERROR_INVALID_LADDER',
+                   message='The temperatures and chemical potentials do not make a ladder.')
+        spec.exit_code(302, 'ERROR_INVALID_N_STEPS',
+                   message='The number of trial steps is not positive.')
+
+    def setup(self):
+        """setup the ctx parameters"""
+        self.ctx.ensemble = self.inputs.ensemble.value
+        if self.ctx.ensemble not in ENSEMBLES:
+            self.report(f'unknown ensemble `{self.ctx.ensemble}`')
+            return self.exit_codes.ERROR_INVALID_ENSEMBLE
+
+        chemical_potentials = None
+        if 'chemical_potentials' in self.inputs:
+            chemical_potentials = self.inputs.chemical_potentials.get_list()
+        elif self.ctx.ensemble == 'semi_grand_canonical':
+            self.report('the semi-grand canonical ensemble requires `chemical_potentials`')
+            return self.exit_codes.ERROR_INVALID_ENSEMBLE
+
+        try:
+            self.ctx.ladder = get_ladder(self.inputs.temperatures.get_list(), chemical_potentials)
+        except ValueError as exception:
+            self.report(str(exception))
+            return self.exit_codes.ERROR_INVALID_LADDER
+
+        if self.inputs.n_steps.value < 1:
+            return self.exit_codes.ERROR_INVALID_N_STEPS
+
+        self.ctx.segments = []
+
+    def should_run_segment(self):
+        """whether there are trial steps left"""
+        return not self.ctx.segments or self.ctx.segments[-1].get_attribute('step') < self.inputs.n_steps.value
+
+    def run_segment(self):
+        """run a segment of trial steps of every point from the state of the previous segment"""
+        cluster_expansion = self.inputs.cluster_expansion
+        supercell = self.inputs.supercell
+        n_steps = self.inputs.n_steps.value
+        exchange_interval = self.inputs.exchange_interval.value if 'exchange_interval' in self.inputs else None
+
+        if self.ctx.segments:
+            state = _get_segment_state(self.ctx.segments[-1])
+        else:
+            state = get_ladder_state(supercell.get_ase(), self.ctx.ladder)
+        length = min(exchange_interval or n_steps, n_steps - state['step'])
+
+        observation_interval = None
+        if 'observation_interval' in self.inputs:
+            observation_interval = self.inputs.observation_interval.value
+
+        # the calculator of this process is reused between the segments
+        n_workers = self.inputs.n_workers.value
+        content, calculator = None, None
+        if n_workers == 1:
+            calculator = _get_calculator(cluster_expansion, supercell)
+        else:
+            content = cluster_expansion._get_content()  # pylint: disable=protected-access
+
+        state, observations = run_ladder_segment(
+            content,
+            supercell.get_ase(),
+            self.ctx.ladder,
+            state,
+            length,
+            ensemble=self.ctx.ensemble,
+            exchange=bool(exchange_interval) and state['step'] + length < n_steps,
+            observation_interval=observation_interval,
+            random_seed=self.inputs.random_seed.value,
+            n_workers=n_workers,
+            calculator=calculator)
+
+        segment = orm.ArrayData()
+        for index, arrays in enumerate(observations):
+            for name, array in arrays.items():
+                segment.set_array(f'point_{index:03d}_{name}', array)
+        for name in ('occupations', 'n_attempts', 'n_accepted'):
+            segment.set_array(name, state[name])
+        for name in ('step', 'segment', 'random_states'):
+            segment.set_attribute(name, state[name])
+
+        self.out(f'segments.segment_{len(self.ctx.segments):05d}', segment.store())
+        self.ctx.segments.append(segment)
+        self.report(f'ran {state["step"]} of {n_steps} trial steps of every point')
+
+    def results(self):
+        """output the averages of all the segments and the final configurations"""
+        ladder = self.ctx.ladder
+        observations = [[] for _ in ladder]
+        for segment in self.ctx.segments:
+            for chunks, chunk in zip(observations, _get_segment_observations(segment, len(ladder))):
+                chunks.append(chunk)
+
+        state = _get_segment_state(self.ctx.segments[-1])
+        averages = get_ladder_averages(ladder, observations, state, self.inputs.n_equilibration_steps.value)
+
+        table = orm.ArrayData()
+        for name, array in averages.items():
+            table.set_array(name, array)
+        self.out('averages', table.store())
+
+        for index, numbers in enumerate(state['occupations']):
+            structure = self.inputs.supercell.get_ase()
+            structure.numbers = numbers
+            self.out(f'final_structures.point_{index:03d}', orm.StructureData(ase=structure).store())
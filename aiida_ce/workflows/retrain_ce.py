@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""ce retrain"""
+from aiida import orm
+from aiida.common.links import LinkType
+from aiida.engine import WorkChain, run_get_node
+from aiida.plugins import DataFactory
+
+from . import _extend_fit_data, _warm_start_train
+
+StructureDbData = DataFactory('structure_db')
+ClusterExpansionData = DataFactory('cluster_expansion')
+ClusterSpaceData = DataFactory('cluster_space')
+
+
+def _find_previous_fit_data(cluster_expansion):
+    """return the `fit_data` output of the workflow which returned `cluster_expansion`, or None"""
+    for link in cluster_expansion.get_incoming(link_type=LinkType.RETURN).all():
+        outputs = link.node.get_outgoing(link_type=LinkType.RETURN, link_label_filter='fit_data').all()
+        if outputs:
+            return outputs[0].node
+
+    return None
+
+
+def _get_fit_data_columns(fit_data, cluster_space):
+    """
+    return the columns of `fit_data` which make up the fit matrix of the
+    (nested) `cluster_space`, None if `fit_data` was not computed in a
+    cluster space in which it is nested
+    """
+    creator = fit_data.creator
+    link = creator.get_incoming(link_label_filter='cluster_space').first() if creator is not None else None
+    if link is None:
+        return None
+
+    try:
+        columns = link.node.get_cutoffs_columns(cluster_space.get_attribute('cutoffs'))
+    except ValueError:
+        return None
+
+    return columns.tolist()
+
+
+class RetrainClusterExpansion(WorkChain):
+    """WorkChain to retrain a cluster expansion with new structures, computing
+    the cluster vectors of the new structures only and starting the fit from
+    the previous parameters"""
+    @classmethod
+    def define(cls, spec):
+        """Define the process spec"""
+        # yapf: disable
+        super().define(spec)
+        spec.input('cluster_expansion', valid_type=ClusterExpansionData,
+                   help='The cluster expansion to retrain.')
+        spec.input('fit_data', valid_type=orm.ArrayData, required=False,
+                   help='The fit data `cluster_expansion` was trained on, by default the `fit_data` output '
+                        'of the workflow which returned it.')
+        spec.input('structure_db', valid_type=StructureDbData,
+                   help='reference data containing the new structures and their properties.')
+        spec.input('selection', valid_type=orm.Str,
+                   help='ase db selection of the new structures, which must not be part of the fit data.')
+        spec.input('alpha', valid_type=orm.Float, required=False,
+                   help='lasso regularization, by default the one of `cluster_expansion`.')
+        spec.input('n_workers', valid_type=orm.Int, default=lambda: orm.Int(1),
+                   help='number of worker processes computing the cluster vectors. The pool runs in the daemon '
+                        'worker, so it is 1 by default.')
+        spec.outline(
+            cls.setup,
+            cls.extend_fit_data,
+            cls.train,
+        )
+        spec.output('cluster_expansion', valid_type=ClusterExpansionData,
+            help='The retrained cluster expansion, with `cluster_expansion` as predecessor.')
+        spec.output('fit_data', valid_type=orm.ArrayData,
+            help='The previous fit data, restricted to the columns of the cluster expansion, with the rows '
+                 'of the new structures appended.')
+        spec.exit_code(300, 'ERROR_NO_FIT_DATA',
+            message='The fit data of the cluster expansion are neither given nor found.')
+        spec.exit_code(301, 'ERROR_INCOMPATIBLE_FIT_DATA',
+            message='The fit data do not have a column per parameter of the cluster expansion.')
+        spec.exit_code(302, 'ERROR_EMPTY_SELECTION',
+            message='The selection of the new structures is empty, it would select the whole db again.')
+        spec.exit_code(303, 'ERROR_UNSUPPORTED_FIT_METHOD',
+            message='The cluster expansion was not fitted with lasso, the only warm-started fit method.')
+
+    def setup(self):
+        """find the previous fit data and check them against the cluster expansion, and
+        set the cluster space of the cluster expansion, used by all the steps of the cycle"""
+        cluster_expansion = self.inputs.cluster_expansion
+        if not self.inputs.selection.value.strip():
+            return self.exit_codes.ERROR_EMPTY_SELECTION
+
+        fit_method = cluster_expansion.get_noumenon().metadata.get('fit_method')
+        if fit_method != 'lasso':
+            self.report(f'the cluster expansion was fitted with `{fit_method}`')
+            return self.exit_codes.ERROR_UNSUPPORTED_FIT_METHOD
+
+        if 'fit_data' in self.inputs:
+            fit_data = self.inputs.fit_data
+        else:
+            fit_data = _find_previous_fit_data(cluster_expansion)
+            if fit_data is None:
+                return self.exit_codes.ERROR_NO_FIT_DATA
+            self.report(f'using the fit data <{fit_data.pk}>')
+
+        self.ctx.cluster_space = cluster_expansion.get_cluster_space_data()
+
+        n_columns = fit_data.get_shape('fit_matrix')[1]
+        n_parameters = len(cluster_expansion.get_parameters())
+        if n_columns != n_parameters:
+            # fit data of a cluster expansion selected from cutoffs candidates
+            columns = _get_fit_data_columns(fit_data, self.ctx.cluster_space)
+            if columns is None or len(columns) != n_parameters:
+                self.report(f'{n_columns} columns for {n_parameters} parameters')
+                return self.exit_codes.ERROR_INCOMPATIBLE_FIT_DATA
+            self.ctx.columns = orm.List(list=columns).store()
+
+        self.ctx.fit_data = fit_data
+
+    def extend_fit_data(self):
+        """append the cluster vectors and targets of the new structures to the fit data"""
+        inputs = {
+            'cluster_space': self.ctx.cluster_space,
+            'fit_data': self.ctx.fit_data,
+            'structure_db': self.inputs.structure_db,
+            'selection': self.inputs.selection,
+            'n_workers': self.inputs.n_workers,
+        }
+        if 'columns' in self.ctx:
+            inputs['columns'] = self.ctx.columns
+
+        fit_data, _ = run_get_node(_extend_fit_data, **inputs)
+        self.report(f'added {fit_data.get_attribute("n_new_rows")} structures')
+
+        self.ctx.fit_data = fit_data
+        self.out('fit_data', fit_data)
+
+    def train(self):
+        """train the cluster expansion starting from the previous parameters"""
+        inputs = {'cluster_expansion': self.inputs.cluster_expansion, 'fit_data': self.ctx.fit_data}
+        if 'alpha' in self.inputs:
+            inputs['alpha'] = self.inputs.alpha
+
+        ce_data, _ = run_get_node(_warm_start_train, **inputs)
+        metadata = ce_data.get_noumenon().metadata
+        self.report(f'train RMSE {metadata["rmse_train"]} after {metadata["n_iterations"]} iterations')
+
+        self.out('cluster_expansion', ce_data)
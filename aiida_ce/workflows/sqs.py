@@ -1,13 +1,24 @@
 # -*- coding: utf-8 -*-
 """workflow to get a sqs"""
 from aiida import orm
-from aiida.engine import WorkChain, run_get_node
-from aiida.plugins import DataFactory
-from icet.tools.structure_generation import generate_sqs_from_supercells
+from aiida.engine import ToContext, WorkChain, calcfunction, if_, run_get_node
+from aiida.plugins import CalculationFactory, DataFactory
 
-from . import _create_cluster_space
+from aiida_ce.tasks import objectives_to_array_data, sqs
+from . import _create_cluster_space, _find_cluster_space
 
 ClusterSpaceData = DataFactory('cluster_space')
+IcetSqsCalculation = CalculationFactory('icet.sqs')
+
+
+@calcfunction
+def _enumerate_supercells(primitive_structure: orm.StructureData, supercell_size: orm.Int) -> dict:
+    """calculation function to enumerate with icet the supercells of
+    `supercell_size` primitive cells, one output for each supercell"""
+    from icet.tools import enumerate_supercells
+
+    supercells = enumerate_supercells(primitive_structure.get_ase(), [supercell_size.value])
+    return {f'supercell_{index:04d}': orm.StructureData(ase=supercell) for index, supercell in enumerate(supercells)}
 
 
 class IcetMcsqsWorkChain(WorkChain):
@@ -18,8 +29,15 @@ class IcetMcsqsWorkChain(WorkChain):
         # yapf: disable
         super().define(spec)
         spec.expose_inputs(_create_cluster_space, namespace='cluster_space')
-        spec.input('supercell',valid_type=orm.StructureData,
+        spec.input('supercell',valid_type=orm.StructureData, required=False,
                     help='The supercell which optimal structure will be search.')
+        spec.input_namespace('supercells', valid_type=orm.StructureData, dynamic=True, required=False,
+                    help='Several supercells annealed independently, the best SQS of all of them is the output.')
+        spec.input('supercell_size', valid_type=orm.Int, required=False,
+                    help='Anneal all the supercells of this number of primitive cells, enumerated by icet.')
+        spec.input('n_workers', valid_type=orm.Int, required=False,
+                    help='number of worker processes annealing the supercells concurrently. Without `code` the '
+                         'pool runs in the daemon worker, so it is 1 by default, otherwise all cores.')
         spec.input('target_concentrations', valid_type=orm.Dict,
                     help='concentration of each species in the target structure, per sublattice')
         spec.input('temperature_start', valid_type=orm.Float, default=lambda: orm.Float(5.),
@@ -34,15 +52,35 @@ class IcetMcsqsWorkChain(WorkChain):
                     help='seed for the random number generator used in the Monte Carlo simulation')
         spec.input('tolerant', valid_type=orm.Float, default=lambda: orm.Float(1e-5),
                     help='Numerical tolerance')
+        spec.input('code', valid_type=orm.Code, required=False,
+                   help='python interpreter with aiida-ce installed, to anneal in a local `IcetSqsCalculation` '
+                        'instead of in the daemon worker running this workflow.')
+        spec.input('options', valid_type=orm.Dict, required=False,
+                   help='Optional `options` of the `IcetSqsCalculation`, e.g. `max_concurrent_tasks`.')
         spec.outline(
             cls.setup,
             cls.create_cluster_space,
-            cls.run_sqs,
+            if_(cls.should_run_calculation)(
+                cls.run_sqs_calculation,
+                cls.inspect_sqs_calculation,
+            ).else_(
+                cls.run_sqs,
+            ),
         )
         spec.output('output_structure', valid_type=orm.StructureData,
                     help='The output special quasirandom structure (SQS).')
         spec.output('output_cluster_vector', valid_type=orm.List,
                     help='The output cluster vector of the output SQS.')
+        spec.output('objectives', valid_type=orm.ArrayData,
+                    help='The objective, number of atoms and cell of the SQS of each supercell, '
+                         'with the index of the `selected` one and the `errors` as attributes.')
+        spec.exit_code(300, 'ERROR_SQS_CALCULATION_FAILED',
+                    message='The SQS calculation job failed.')
+        spec.exit_code(301, 'ERROR_INVALID_SUPERCELLS',
+                    message='Exactly one of `supercell`, `supercells` and `supercell_size` must be given, '
+                            'for at least one supercell.')
+        spec.exit_code(302, 'ERROR_NO_VALID_SUPERCELL',
+                    message='The annealing failed in every supercell.')
 
     def setup(self):
         """setup the parameters for actual run"""
@@ -54,32 +92,125 @@ class IcetMcsqsWorkChain(WorkChain):
         self.ctx.random_seed = self.inputs.random_seed.value
         self.ctx.target_concentrations = self.inputs.target_concentrations.get_dict()
 
+        given = [key for key in ('supercell', 'supercells', 'supercell_size') if self.inputs.get(key)]
+        if len(given) != 1:
+            return self.exit_codes.ERROR_INVALID_SUPERCELLS
+
+        self.ctx.supercells = self._get_supercells()
+        if not self.ctx.supercells:
+            return self.exit_codes.ERROR_INVALID_SUPERCELLS
+
+    def _get_supercells(self):
+        """return the supercells to anneal as `StructureData` labelled in their order,
+        the ones of `supercell_size` enumerated once by `_enumerate_supercells`"""
+        if 'supercell' in self.inputs:
+            return {'supercell_0000': self.inputs.supercell}
+
+        if self.inputs.get('supercells'):
+            supercells = self.inputs.supercells
+            return {f'supercell_{index:04d}': supercells[label] for index, label in enumerate(sorted(supercells))}
+
+        supercells, _ = run_get_node(_enumerate_supercells,
+                                     primitive_structure=self.inputs.cluster_space.primitive_structure,
+                                     supercell_size=self.inputs.supercell_size)
+        return dict(supercells)
+
     def create_cluster_space(self):
-        """create cluster space with icet and store it as a cluster space data type"""
-        self.ctx.cluster_space, _ = run_get_node(_create_cluster_space,
-                              **self.exposed_inputs(_create_cluster_space, namespace='cluster_space'))
+        """create cluster space with icet and store it as a cluster space data type,
+        or reuse an identical cluster space which is already stored"""
+        inputs = self.exposed_inputs(_create_cluster_space, namespace='cluster_space')
+        cluster_space = _find_cluster_space(inputs['primitive_structure'], inputs['cutoffs'],
+                                            inputs['chemical_symbols'])
+        if cluster_space is not None:
+            self.report(f'reusing the identical cluster space <{cluster_space.pk}>')
+            self.ctx.cluster_space = cluster_space
+            return
+
+        self.ctx.cluster_space, _ = run_get_node(_create_cluster_space, **inputs)
+
+    def _get_sqs_parameters(self):
+        """return the keyword arguments of `aiida_ce.tasks.sqs`"""
+        return {
+            'target_concentrations': self.ctx.target_concentrations,
+            'n_steps': self.ctx.n_steps,
+            'T_start': self.ctx.T_start,
+            'T_stop': self.ctx.T_stop,
+            'optimality_weight': self.ctx.optimality_weight,
+            'random_seed': self.ctx.random_seed,
+            'tol': self.ctx.tol,
+            'n_workers': self.inputs.n_workers.value if 'n_workers' in self.inputs else None,
+        }
 
+    def _get_supercells_ase(self):
+        """return the ase supercells to anneal, in the order of their labels"""
+        return [self.ctx.supercells[label].get_ase() for label in sorted(self.ctx.supercells)]
 
+    def should_run_calculation(self):
+        """whether the annealing runs as a calculation job, outside of the daemon"""
+        return 'code' in self.inputs
+
+    def run_sqs_calculation(self):
+        """submit the annealing as a local calculation job"""
+        inputs = {
+            'code': self.inputs.code,
+            'cluster_space': self.ctx.cluster_space,
+            'supercells': self.ctx.supercells,
+            'parameters': orm.Dict(dict=self._get_sqs_parameters()),
+            'metadata': {
+                'options': self.inputs.options.get_dict() if 'options' in self.inputs else {},
+            },
+        }
+        running = self.submit(IcetSqsCalculation, **inputs)
+        self.report(f'launching IcetSqsCalculation<{running.pk}>')
+
+        return ToContext(sqs_calculation=running)
+
+    def inspect_sqs_calculation(self):
+        """output the SQS of the calculation job"""
+        calculation = self.ctx.sqs_calculation
+        if 'objectives' in calculation.outputs:
+            self._report_objectives(calculation.outputs.objectives)
+            self.out('objectives', calculation.outputs.objectives)
+
+        if calculation.exit_status == IcetSqsCalculation.exit_codes.ERROR_NO_VALID_SUPERCELL.status:
+            return self.exit_codes.ERROR_NO_VALID_SUPERCELL
+        if not calculation.is_finished_ok:
+            self.report(f'IcetSqsCalculation<{calculation.pk}> failed with exit status {calculation.exit_status}')
+            return self.exit_codes.ERROR_SQS_CALCULATION_FAILED
+
+        self.out('output_cluster_vector', calculation.outputs.output_cluster_vector)
+        self.out('output_structure', calculation.outputs.output_structure)
 
     def run_sqs(self):
-        """running and get sqs using icet"""
-        cs = self.ctx.cluster_space.get_noumenon()
-        the_supercell = self.inputs.supercell.get_ase()
-
-        sqs = generate_sqs_from_supercells(
-            cluster_space=cs,
-            supercells=[the_supercell],
-            n_steps=self.ctx.n_steps,
-            T_start=self.ctx.T_start,
-            T_stop=self.ctx.T_stop,
-            optimality_weight=self.ctx.optimality_weight,
-            random_seed=self.ctx.random_seed,
-            target_concentrations=self.ctx.target_concentrations,
-            tol=self.ctx.tol)
-
-        cluster_vecter = cs.get_cluster_vector(sqs).tolist()
+        """running and get sqs using icet in the daemon worker, annealing the
+        supercells in a process pool only if `n_workers` is given"""
+        parameters = self._get_sqs_parameters()
+        parameters['n_workers'] = parameters['n_workers'] or 1
+        structure, cluster_vector, table = sqs(self.ctx.cluster_space.get_noumenon(), self._get_supercells_ase(),
+                                               content=self.ctx.cluster_space.get_content,
+                                               **parameters)
+
+        objectives = objectives_to_array_data(table)
+        self._report_objectives(objectives)
+        self.out('objectives', objectives.store())
+        if structure is None:
+            return self.exit_codes.ERROR_NO_VALID_SUPERCELL
+
         self.out('output_cluster_vector',
-                 orm.List(list=cluster_vecter).store())
+                 orm.List(list=cluster_vector.tolist()).store())
 
-        output_structure = orm.StructureData(ase=sqs)
+        output_structure = orm.StructureData(ase=structure)
         self.out('output_structure', output_structure.store())
+
+    def _report_objectives(self, objectives):
+        """report the objective of the SQS of each supercell"""
+        errors = objectives.get_attribute('errors')
+        for index, (objective, n_atoms) in enumerate(zip(objectives.get_array('objectives'),
+                                                         objectives.get_array('n_atoms'))):
+            if errors[index] is not None:
+                self.report(f'supercell {index} ({n_atoms} atoms) failed: {errors[index]}')
+            else:
+                self.report(f'supercell {index} ({n_atoms} atoms): objective {objective}')
+
+        if objectives.get_attribute('selected') is not None:
+            self.report(f'selected supercell {objectives.get_attribute("selected")}')
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 """test calculations"""
 # pylint: disable=redefined-outer-name
+import json
+import os
+
+import numpy as np
 import pytest
 
 from aiida import orm
@@ -42,6 +46,43 @@ def generate_calc_job():
     return _generate_calc_job
 
 
+@pytest.fixture
+def run_icet_task(generate_calc_job, fixture_localhost, monkeypatch, tmp_path):
+    """
+    Fixture to prepare an icet calculation job in a folder, run its task there
+    as the job would and return a calculation node with the retrieved files,
+    to test the task and the parser together.
+    """
+    def _run_icet_task(folder, entry_point_name, inputs):
+        from aiida.common import LinkType
+        from aiida.plugins.entry_point import format_entry_point_string
+        from aiida_ce import tasks
+
+        calc_info = generate_calc_job(folder, entry_point_name, inputs)
+
+        monkeypatch.chdir(folder.abspath)
+        monkeypatch.setenv(tasks.SLOTS_DIR_ENV, str(tmp_path / 'slots'))
+        tasks.main(calc_info.codes_info[0].cmdline_params[2:])
+
+        entry_point = format_entry_point_string('aiida.calculations', entry_point_name)
+        node = orm.CalcJobNode(computer=fixture_localhost, process_type=entry_point)
+        for label, value in inputs.items():
+            if isinstance(value, orm.Data) and not isinstance(value, orm.Code):
+                node.add_incoming(value.store(), link_type=LinkType.INPUT_CALC, link_label=label)
+        node.store()
+
+        retrieved = orm.FolderData()
+        for filename in calc_info.retrieve_list:
+            if os.path.isfile(folder.get_abs_path(filename)):
+                retrieved.put_object_from_file(folder.get_abs_path(filename), filename)
+        retrieved.add_incoming(node, link_type=LinkType.CREATE, link_label='retrieved')
+        retrieved.store()
+
+        return node
+
+    return _run_icet_task
+
+
 # @pytest.fixture
 # def generate_singlefile():
 #     """gererate a SinglefileData from file"""
@@ -151,3 +192,119 @@ def test_atat_mcsqs_default(fixture_sandbox, generate_calc_job,
 
     mcsqs = calc_info['codes_info'][1]
     mcsqs['cmdline_parames'] = ['-rc', '-sd=1234', '-T=1', '-wd=0', '-wr=1']
+
+
+def test_icet_train_default(fixture_sandbox, generate_calc_job, fixture_code, generate_ase_structure):
+    """Test the training calculation writes the cluster space and the fit data and runs the task"""
+    import numpy as np
+    from aiida.plugins import DataFactory
+    from aiida_ce import tasks
+
+    cluster_space = DataFactory('cluster_space')()
+    cluster_space.set(ase=generate_ase_structure('Ag'), cutoffs=[5.0], chemical_symbols=[['Ag', 'Pd']])
+    fit_data = orm.ArrayData()
+    fit_data.set_array('fit_matrix', np.eye(3))
+    fit_data.set_array('target', np.arange(3.))
+
+    inputs = {
+        'code': fixture_code('icet.train'),
+        'cluster_space': cluster_space,
+        'fit_data': fit_data,
+        'parameters': orm.Dict(dict={'fit_kwargs': {'fit_method': 'lasso'}}),
+        'metadata': {
+            'options': {
+                'max_concurrent_tasks': 2
+            }
+        },
+    }
+
+    calc_info = generate_calc_job(fixture_sandbox, 'icet.train', inputs)
+
+    assert calc_info.codes_info[0].cmdline_params == [
+        '-m', 'aiida_ce.tasks', 'train', '--max-concurrent-tasks', '2'
+    ]
+    assert sorted(calc_info.retrieve_list) == sorted([tasks.RESULTS_FILENAME, tasks.RESULTS_ARRAYS_FILENAME])
+    assert calc_info.retrieve_temporary_list == [tasks.CLUSTER_EXPANSION_FILENAME]
+
+    with fixture_sandbox.open(tasks.CLUSTER_SPACE_FILENAME) as handle:
+        assert json.load(handle) == cluster_space.get_build_parameters()
+    assert np.allclose(np.load(fixture_sandbox.get_abs_path(tasks.FIT_MATRIX_FILENAME)), np.eye(3))
+    assert np.allclose(np.load(fixture_sandbox.get_abs_path(tasks.TARGET_FILENAME)), np.arange(3.))
+
+    with fixture_sandbox.open(tasks.PARAMETERS_FILENAME) as handle:
+        assert handle.read() == '{"fit_kwargs": {"fit_method": "lasso"}}'
+
+
+@pytest.mark.usefixtures('clear_database_before_test')
+def test_icet_fit_data_run(fixture_sandbox, run_icet_task, fixture_code, structure_db, generate_ase_structure):
+    """Test the fit data task builds the cluster space and computes the cluster vectors of the copied db"""
+    from aiida.plugins import DataFactory, ParserFactory
+
+    cluster_space = DataFactory('cluster_space')()
+    cluster_space.set(ase=generate_ase_structure('Ag'), cutoffs=[5.0], chemical_symbols=[['Ag', 'Pd']])
+    inputs = {
+        'code': fixture_code('icet.fit_data'),
+        'cluster_space': cluster_space,
+        'structure_db': structure_db.store(),
+        'selection': orm.Str('natoms<=4'),
+        'fit_data_key': orm.Str('mixing_energy'),
+        'parameters': orm.Dict(dict={'n_workers': 1}),
+    }
+
+    node = run_icet_task(fixture_sandbox, 'icet.fit_data', inputs)
+    results, calcfunction = ParserFactory('icet.fit_data').parse_from_node(
+        node, store_provenance=False, retrieved_temporary_folder=fixture_sandbox.abspath)
+
+    assert calcfunction.is_finished_ok, calcfunction.exit_message
+    db = structure_db.get_db()
+    rows = list(db.select('natoms<=4,mixing_energy'))
+    cs = cluster_space.get_noumenon()
+    fit_data = results['fit_data']
+    assert np.allclose(fit_data.get_array('fit_matrix'), [cs.get_cluster_vector(row.toatoms()) for row in rows])
+    assert np.allclose(fit_data.get_array('target'), [row.mixing_energy for row in rows])
+    assert fit_data.get_attribute('selection') == 'natoms<=4'
+    assert fit_data.get_attribute('n_skipped') == db.count('natoms<=4') - len(rows)
+
+
+@pytest.mark.usefixtures('clear_database_before_test')
+@pytest.mark.parametrize('target_concentrations, exit_status', [
+    ({'Au': 0.5, 'Pd': 0.5}, 0),
+    ({'Au': 0.3, 'Pd': 0.7}, 301),
+])
+def test_icet_sqs_run(fixture_sandbox, run_icet_task, fixture_code, generate_ase_structure, target_concentrations,
+                      exit_status):
+    """Test the sqs task anneals the supercells and its outputs are parsed, or fails without a valid supercell"""
+    from aiida.plugins import CalculationFactory, DataFactory, ParserFactory
+
+    cluster_space = DataFactory('cluster_space')()
+    cluster_space.set(ase=generate_ase_structure('Au'), cutoffs=[5.0], chemical_symbols=[['Au', 'Pd']])
+    inputs = {
+        'code': fixture_code('icet.sqs'),
+        'cluster_space': cluster_space,
+        'supercells': {
+            'supercell_0000': orm.StructureData(ase=generate_ase_structure('Au').repeat((1, 2, 2))),
+            'supercell_0001': orm.StructureData(ase=generate_ase_structure('Au').repeat((1, 1, 2))),
+        },
+        'parameters': orm.Dict(dict={
+            'target_concentrations': target_concentrations,
+            'n_steps': 100,
+            'random_seed': 1234,
+            'n_workers': 1,
+        }),
+    }
+
+    node = run_icet_task(fixture_sandbox, 'icet.sqs', inputs)
+    results, calcfunction = ParserFactory('icet.sqs').parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.exit_status == exit_status
+    assert results['objectives'].get_array('n_atoms').tolist() == [4, 2]
+    if exit_status:
+        assert exit_status == CalculationFactory('icet.sqs').exit_codes.ERROR_NO_VALID_SUPERCELL.status
+        assert all(error is not None for error in results['objectives'].get_attribute('errors'))
+        assert 'output_structure' not in results
+        return
+
+    structure = results['output_structure'].get_ase()
+    assert structure.get_chemical_symbols().count('Pd') * 2 == len(structure)
+    cluster_vector = cluster_space.get_noumenon().get_cluster_vector(structure)
+    assert np.allclose(results['output_cluster_vector'].get_list(), cluster_vector)
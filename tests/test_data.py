@@ -35,6 +35,145 @@ class TestClusterSpaceData:
         data_loaded = orm.load_node(data_res.pk)
         assert data_loaded.print_overview() == data.print_overview()
 
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_cluster_space_cache(self, generate_ase_structure):
+        """test the cluster space is built once and invalidated by `set`"""
+        ClusterSpaceData.cache_clear()
+
+        data = ClusterSpaceData()
+        data.set(ase=generate_ase_structure(),
+                 cutoffs=[7.0, 4.5],
+                 chemical_symbols=[['Ag', 'Pd']])
+
+        cs = data.get_noumenon()
+        assert data.get_noumenon() is cs
+        assert ClusterSpaceData.cache_info().hits == 1
+        assert ClusterSpaceData.cache_info().misses == 1
+
+        data.set(cutoffs=[5.0], chemical_symbols=[['Ag', 'Pd']])
+        assert data.get_noumenon() is not cs
+        assert data.get_noumenon().cutoffs == [5.0]
+
+        # the cached cluster space follows the node once stored
+        cs = data.get_noumenon()
+        data.store()
+        assert data.get_noumenon() is cs
+        assert orm.load_node(data.pk).get_noumenon() is cs
+
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_store_without_cluster_space(self, generate_ase_structure):
+        """test storing a cluster space stores its parameters only and does not build it"""
+        ClusterSpaceData.cache_clear()
+
+        data = ClusterSpaceData()
+        data.set(ase=generate_ase_structure(),
+                 cutoffs=[7.0, 4.5],
+                 chemical_symbols=[['Ag', 'Pd']])
+        data.store()
+        assert data.list_object_names() == []
+        assert ClusterSpaceData.cache_info().currsize == 0
+
+        from icet import ClusterSpace
+
+        reference = ClusterSpace(generate_ase_structure(), [7.0, 4.5], [['Ag', 'Pd']])
+        assert orm.load_node(data.pk).get_noumenon().orbit_data == reference.orbit_data
+
+    def test_content_hash(self):
+        """test the content hash ignores the order of atoms and numerical noise"""
+        from ase.build import bulk
+        from aiida_ce.data.cluster import get_cluster_space_hash
+
+        prim = bulk('NaCl', 'rocksalt', a=5.64)
+        symbols = [['Na', 'K'], ['Cl', 'Br']]
+        content_hash = get_cluster_space_hash(prim, [6.0], symbols)
+
+        swapped = prim[[1, 0]]
+        swapped.positions += 1e-8
+        assert get_cluster_space_hash(swapped, [6.0], symbols[::-1]) == content_hash
+        assert get_cluster_space_hash(prim, [6.5], symbols) != content_hash
+
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_find_by_content_hash(self, generate_ase_structure):
+        """test a stored cluster space can be found by its content hash"""
+        data = ClusterSpaceData()
+        data.set(ase=generate_ase_structure(),
+                 cutoffs=[7.0, 4.5],
+                 chemical_symbols=[['Ag', 'Pd']])
+        content_hash = data.get_content_hash()
+        assert ClusterSpaceData.find_by_content_hash(content_hash) is None
+
+        data.store()
+        assert data.get_extra('cluster_space_hash') == content_hash
+        assert ClusterSpaceData.find_by_content_hash(content_hash).uuid == data.uuid
+
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_get_cluster_vectors(self, cluster_space, ase_db):
+        """test the cluster vectors computed in a process pool"""
+        structures = [row.toatoms() for row in ase_db.select('natoms<=4')]
+        data = ClusterSpaceData()
+        data.set_from_cluster_space(cluster_space)
+
+        array = data.get_cluster_vectors(structures, n_workers=2, chunk_size=7)
+        cluster_vectors = array.get_array('cluster_vectors')
+
+        assert cluster_vectors.shape == (len(structures), len(cluster_space))
+        for structure, cluster_vector in zip(structures, cluster_vectors):
+            assert np.allclose(cluster_vector, cluster_space.get_cluster_vector(structure))
+
+        serial = data.get_cluster_vectors([orm.StructureData(ase=s) for s in structures], n_workers=1)
+        assert np.allclose(serial.get_array('cluster_vectors'), cluster_vectors)
+
+    def test_cluster_vectors_single_chunk(self, cluster_space, ase_db, monkeypatch):
+        """test no process pool is started for a single chunk"""
+        from aiida_ce import parallel
+
+        def _no_pool(*args, **kwargs):
+            raise AssertionError('a process pool was started')
+
+        monkeypatch.setattr(parallel, 'ProcessPoolExecutor', _no_pool)
+        structures = [row.toatoms() for row in ase_db.select('natoms<=4')]
+
+        data = ClusterSpaceData()
+        data.set_from_cluster_space(cluster_space)
+        array = data.get_cluster_vectors(structures, chunk_size=len(structures))
+        assert array.get_array('cluster_vectors').shape == (len(structures), len(cluster_space))
+        worker_state = parallel._WORKER_STATE  # pylint: disable=protected-access
+        assert not [key for key in worker_state if key.startswith('cluster_space-')]
+
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_nested_cluster_space(self, cluster_space, ase_db):
+        """test the nested cluster space is a column subset of the larger one"""
+        from icet import ClusterSpace
+        from aiida_ce.data.cluster import build_nested_cluster_space
+
+        data = ClusterSpaceData()
+        data.set_from_cluster_space(cluster_space)
+        columns = data.get_cutoffs_columns([5.0])
+
+        # the nested cluster space node is not built until used
+        ClusterSpaceData.cache_clear()
+        nested = data.get_nested_cluster_space([5.0])
+        nested.store()
+        assert nested.get_attribute('cutoffs') == [5.0]
+        assert ClusterSpaceData.cache_info().currsize == 0
+        assert nested.get_noumenon().cutoffs == [5.0]
+        assert cluster_space.cutoffs != [5.0]
+
+        reference = ClusterSpace(cluster_space.primitive_structure, [5.0], cluster_space.chemical_symbols)
+        assert len(nested.get_noumenon()) == len(reference) == len(columns)
+
+        built = build_nested_cluster_space(cluster_space, [5.0])
+        assert built.cutoffs == [5.0]
+        assert build_nested_cluster_space(cluster_space, cluster_space.cutoffs) is cluster_space
+
+        structure = next(ase_db.select('natoms=8')).toatoms()
+        for nested_cs in (nested.get_noumenon(), built):
+            assert np.allclose(nested_cs.get_cluster_vector(structure),
+                               cluster_space.get_cluster_vector(structure)[columns])
+
+        with pytest.raises(ValueError):
+            data.get_cutoffs_columns([5.0, 5.0, 5.0])
+
 
 class TestClusterExpansionData:
     """tests of `ClusterExpansionData`"""
@@ -54,6 +193,27 @@ class TestClusterExpansionData:
         data_loaded = orm.load_node(data_res.pk)
         assert data_loaded.print_overview() == data.print_overview()
 
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_set_without_copy(self, cluster_space):
+        """test the cluster expansion is set on the cluster space itself and read back the same"""
+        parameters = np.arange(len(cluster_space), dtype=float)
+        data = ClusterExpansionData()
+        data.set(cluster_space, parameters, {'fit_method': 'lasso'})
+
+        ce = data.get_noumenon()
+        assert ce._cluster_space is cluster_space  # pylint: disable=protected-access
+        assert ce.metadata['fit_method'] == 'lasso'
+        assert 'icet_version' in ce.metadata
+
+        data.store()
+        ClusterExpansionData.cache_clear()
+        ce_loaded = orm.load_node(data.pk).get_noumenon()
+        assert np.allclose(ce_loaded.parameters, parameters)
+        assert ce_loaded.metadata['fit_method'] == 'lasso'
+
+        with pytest.raises(ValueError):
+            ClusterExpansionData().set(cluster_space, parameters[:-1])
+
     @pytest.mark.usefixtures('clear_database_before_test')
     def test_set_and_load_metadata(self, cluster_space, optimizer):
         """set and load metadata"""
@@ -67,6 +227,88 @@ class TestClusterExpansionData:
         data_loaded = orm.load_node(data_res.pk)
         assert data_loaded.print_overview() == data.print_overview()
 
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_cluster_expansion_cache(self, cluster_space):
+        """test the cluster expansion is read once and kept in the `loaded` context"""
+        from icet import ClusterExpansion
+
+        parameters = np.arange(len(cluster_space), dtype=float)
+        data = ClusterExpansionData()
+        data.set(cluster_space, parameters)
+        data.store()
+
+        # the stored file can be read by icet directly
+        with data.open(data.filename, mode='rb') as handle:
+            assert np.allclose(ClusterExpansion.read(handle.name).parameters, parameters)
+
+        ClusterExpansionData.cache_clear()
+        data_loaded = orm.load_node(data.pk)
+        ce = data_loaded.get_noumenon()
+        assert data_loaded.get_noumenon() is ce
+        assert ClusterExpansionData.cache_info().misses == 1
+        assert ClusterExpansionData.cache_info().hits == 1
+
+        with data_loaded.loaded() as ce_loaded:
+            ClusterExpansionData.cache_clear()
+            assert data_loaded.get_noumenon() is ce_loaded
+        assert ClusterExpansionData.cache_info().misses == 0
+
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_predict_many(self, cluster_space, optimizer, structure_db):
+        """test the batch prediction matches `ClusterExpansion.predict`"""
+        data = ClusterExpansionData()
+        data.set(cluster_space, optimizer.parameters)
+        data.store()
+        ce = data.get_noumenon()
+
+        structures = [row.toatoms() for row in structure_db.get_db().select('natoms<=4')]
+        predictions = data.predict_many(structure_db, n_workers=2, chunk_size=5, selection='natoms<=4')
+        assert np.allclose(predictions, [ce.predict(structure) for structure in structures])
+
+        array = data.predict_many(structures[:3], n_workers=1, as_array_data=True)
+        assert np.allclose(array.get_array('predictions'), predictions[:3])
+
+        # the cluster expansion loaded on the instance is used, not read again
+        with data.loaded():
+            ClusterExpansionData.cache_clear()
+            assert np.allclose(data.predict_many(structures, n_workers=2, chunk_size=5), predictions)
+        assert ClusterExpansionData.cache_info().misses == 0
+
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_sparse_parameters(self, cluster_space, structure_db):
+        """test the sparse parameters and the pruned evaluation"""
+        parameters = np.zeros(len(cluster_space))
+        parameters[[0, 1, 3]] = [1.0, -0.5, 0.25]
+
+        data = ClusterExpansionData()
+        data.set(cluster_space, parameters)
+        data.store()
+
+        assert data.get_attribute('n_nonzero_parameters') == 3
+        assert np.allclose(data.get_array('eci_indices'), [0, 1, 3])
+        assert np.allclose(data.get_parameters(), parameters)
+
+        pruned = data.get_noumenon(pruned=True)
+        assert len(pruned) < len(data.get_noumenon())
+
+        predictions = data.predict_many(structure_db, n_workers=1, selection='natoms<=4')
+        assert np.allclose(data.predict_many(structure_db, n_workers=2, selection='natoms<=4', pruned=True),
+                           predictions)
+
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_parameters_without_sparse_form(self, cluster_space):
+        """test the parameters of a node stored without their sparse form"""
+        parameters = np.linspace(-1., 1., len(cluster_space))
+
+        data = ClusterExpansionData()
+        data.set(cluster_space, parameters)
+        for name in ('n_parameters', 'n_nonzero_parameters'):
+            data.delete_attribute(name)
+        data.store(use_cache=False)
+
+        ClusterExpansionData.cache_clear()
+        assert np.allclose(orm.load_node(data.pk).get_parameters(), parameters)
+
 
 class TestStructureDbData:
     """test `StructureDbData`"""
@@ -83,7 +325,263 @@ class TestStructureDbData:
 
         sdb_loaded = orm.load_node(sdb_res.pk)
         assert sdb_loaded.status['structures']
-        # assert sdb_loaded.status['properties'] == ['mix_energies']
+        assert sdb_loaded.status['properties'] == ['concentration', 'lattice_parameter', 'mixing_energy']
+
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_columnar_index(self, structure_db, ase_db):
+        """test the columnar index extracted at store time matches the db file"""
+        assert not structure_db.has_index
+        structure_db.store()
+        assert structure_db.has_index
+        assert structure_db.get_attribute('index_species') == ['Pd', 'Ag']
+
+        sdb_loaded = orm.load_node(structure_db.pk)
+        for selection in [None, 'natoms<=8', 'Pd>2,natoms=4', 'tag=AgPd_0002', 'mixing_energy<-0.05']:
+            assert sdb_loaded.count(selection) == ase_db.count(selection)
+
+        rows = list(ase_db.select('natoms<=8'))
+        assert np.array_equal(sdb_loaded.get_ids('natoms<=8'), [row.id for row in rows])
+        assert np.allclose(sdb_loaded.get_property('mixing_energy', 'natoms<=8'), [row.mixing_energy for row in rows])
+
+        with pytest.raises(KeyError):
+            sdb_loaded.get_property('tag')
+
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_iter_structures(self, structure_db, ase_db):
+        """test the rows are yielded in batches with the requested properties"""
+        rows = list(ase_db.select('natoms<=4'))
+        batches = list(structure_db.iter_structures(selection='natoms<=4', batch_size=7, columns=['mixing_energy']))
+
+        assert [len(batch) for batch in batches[:-1]] == (len(batches) - 1) * [7]
+        items = [item for batch in batches for item in batch]
+        assert len(items) == len(rows)
+        for (structure, properties), row in zip(items, rows):
+            assert structure == row.toatoms()
+            assert properties == {'mixing_energy': row.mixing_energy}
+
+        _, properties = next(structure_db.iter_structures(selection='natoms=1'))[0]
+        assert set(properties) == {'tag', 'mixing_energy', 'concentration', 'lattice_parameter'}
+
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_get_db_file_cache(self, tmp_path, monkeypatch):
+        """test the db file is materialized once in the cache directory and evicted when too large"""
+        monkeypatch.setattr(StructureDbData, '_file_cache', None)
+        StructureDbData.set_file_cache(str(tmp_path / 'cache'))
+        db_file = os.path.join(TEST_DIR, 'reference_data.db')
+        sdb = StructureDbData(db_file).store()
+
+        with sdb.pin_db_file() as entry:
+            path = entry.path
+        assert os.path.dirname(path) == str(tmp_path / 'cache')
+        assert not os.access(path, os.W_OK)
+        assert orm.load_node(sdb.pk).get_db().count() == sdb.get_db().count()
+
+        cache = StructureDbData.get_file_cache()
+        assert cache.info().misses == 1
+        assert cache.info().hits == 2
+        assert cache.info().currsize == os.path.getsize(db_file)
+
+        def write(other_path):
+            with open(other_path, 'wb') as handle:
+                handle.write(b'content')
+
+        # a file in use is not evicted
+        cache.resize(os.path.getsize(db_file))
+        db = sdb.get_db()
+        cache.pin('other.db', write).release()
+        assert os.path.exists(path)
+        assert db.count() == sdb.count()
+
+        del db
+        cache.pin('another.db', write).release()
+        assert not os.path.exists(path)
+        # the lock file is removed with the evicted file
+        lock_files = {name for name in os.listdir(cache.directory) if name.startswith('.lock-')}
+        assert lock_files == {'.lock-other.db', '.lock-another.db'}
+
+        with cache.pin(os.path.basename(path), write) as entry:
+            assert os.path.isfile(entry.path)
+
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_get_db_read_only(self, tmp_path, monkeypatch):
+        """test the db of the cache can not be modified"""
+        from ase.build import bulk
+
+        monkeypatch.setattr(StructureDbData, '_file_cache', None)
+        StructureDbData.set_file_cache(str(tmp_path / 'cache'))
+        sdb = StructureDbData(os.path.join(TEST_DIR, 'reference_data.db')).store()
+
+        db = sdb.get_db()
+        n_rows = db.count()
+        with pytest.raises(PermissionError):
+            db.write(bulk('Ag'))
+        with pytest.raises(PermissionError):
+            db.delete([1])
+        assert sdb.get_db().count() == n_rows
+
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_extend_and_compact(self, ase_db, tmp_path):
+        """test an extended node stores only the new rows and reads merge the chain"""
+        from ase.db import connect
+
+        db_file = str(tmp_path / 'root.db')
+        root_db = connect(db_file)
+        for row in ase_db.select('natoms<=2'):
+            root_db.write(row)
+        root = StructureDbData(db_file).store()
+
+        new_rows = list(ase_db.select('natoms=3'))
+        extended = root.extend(new_rows)
+        extended.store()
+        assert extended.parent.uuid == root.uuid
+        assert extended._get_shard_db().count() == len(new_rows)  # pylint: disable=protected-access
+
+        selection = 'natoms<=3'
+        n_rows = ase_db.count(selection)
+        mixing_energies = [row.mixing_energy for row in ase_db.select(selection)]
+        assert orm.load_node(extended.pk).count() == n_rows
+        assert extended.get_db().count() == n_rows
+        assert np.allclose(extended.get_property('mixing_energy'), mixing_energies)
+        assert sum(len(batch) for batch in extended.iter_structures()) == n_rows
+
+        # the shard only stores the index of its own rows
+        assert len(extended.get_array('index_ids')) == len(new_rows)
+        assert extended.get_attribute('n_structures') == n_rows
+
+        # ids refer to the whole chain in every read
+        ids = extended.get_ids()
+        selection = f'id>{ids[1]},id<={ids[-2]}'
+        selected = [structure for batch in extended.iter_structures(selection) for structure, _ in batch]
+        assert len(selected) == extended.count(selection) == len(ids) - 3
+        assert all(structure == row.toatoms()
+                   for structure, row in zip(selected, extended.get_db().select(selection)))
+
+        compacted = extended.compact().store()
+        assert compacted.parent is None
+        assert np.array_equal(compacted.get_ids(), extended.get_ids())
+        assert np.allclose(compacted.get_property('mixing_energy'), mixing_energies)
+
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_set_from_files(self, ase_db, tmp_path):
+        """test the import of the frames of an extxyz file"""
+        from ase.io import write
+
+        structures = []
+        for row in ase_db.select('natoms<=3'):
+            atoms = row.toatoms()
+            atoms.info.update({'mixing_energy': row.mixing_energy, 'tag': row.tag, 'config': [1, 2, 3]})
+            structures.append(atoms)
+        xyz_file = str(tmp_path / 'structures.xyz')
+        write(xyz_file, structures, format='extxyz')
+
+        sdb = StructureDbData()
+        sdb.set_from_files(xyz_file, batch_size=4)
+        sdb.store()
+
+        assert sdb.count() == len(structures)
+        assert sdb.status['properties'] == ['mixing_energy']
+        assert np.allclose(sdb.get_property('mixing_energy'), [atoms.info['mixing_energy'] for atoms in structures])
+
+        with pytest.raises(ValueError):
+            StructureDbData().set_from_files(xyz_file, properties=['config'])
+
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_set_from_query(self, ase_db):
+        """test the import of the structures of a query with a property of a linked output node"""
+        from aiida.engine import calcfunction
+
+        @calcfunction
+        def get_mixing_energy(structure):
+            """return the mixing energy of the structure"""
+            row = ase_db.get(id=structure.get_extra('row_id'))
+            return orm.Float(row.mixing_energy)
+
+        rows = list(ase_db.select('natoms<=2'))
+        for row in rows:
+            structure = orm.StructureData(ase=row.toatoms()).store()
+            structure.set_extra('row_id', row.id)
+            get_mixing_energy(structure)
+
+        query = orm.QueryBuilder()
+        query.append(orm.StructureData, tag='structure', project='*')
+        query.append(orm.CalcFunctionNode, with_incoming='structure', tag='calculation')
+        query.append(orm.Float, with_incoming='calculation', project='attributes.value')
+        query.order_by({'structure': 'id'})
+
+        sdb = StructureDbData()
+        sdb.set_from_query(query, properties=['mixing_energy'])
+        sdb.store()
+
+        assert sdb.count() == len(rows)
+        assert np.allclose(sdb.get_property('mixing_energy'), [row.mixing_energy for row in rows])
+        assert len(set(sdb.get_index()['text']['structure_uuid'])) == len(rows)
+
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_deduplicate(self, ase_db, cluster_space, tmp_path):
+        """test symmetry equivalent copies get the same fingerprint and are removed"""
+        from ase.db import connect
+
+        cs_data = ClusterSpaceData()
+        cs_data.set_from_cluster_space(cluster_space)
+        cs_data.store()
+
+        rows = list(ase_db.select('natoms<=3'))
+        copies = []
+        for row in rows[-3:]:
+            atoms = row.toatoms()[::-1]
+            atoms.translate(cluster_space.primitive_structure.cell[0])
+            atoms.wrap()
+            copies.append((atoms, row.key_value_pairs))
+
+        db_file = str(tmp_path / 'copies.db')
+        db = connect(db_file)
+        for row in rows:
+            db.write(row)
+        for atoms, key_value_pairs in copies:
+            db.write(atoms, key_value_pairs=key_value_pairs)
+        sdb = StructureDbData(db_file).store()
+
+        deduplicated, mapping = sdb.deduplicate(cs_data, n_workers=1)
+        deduplicated.store()
+        assert deduplicated.count() == len(set(sdb.get_fingerprints(cs_data))) <= len(rows)
+
+        group_ids = mapping.get_array('group_ids')
+        assert np.array_equal(group_ids[-3:], [row.id for row in rows[-3:]])
+        assert len(set(deduplicated.get_index()['text']['fingerprint'])) == deduplicated.count()
+
+        # duplicates are skipped when extending
+        extended = deduplicated.extend([atoms for atoms, _ in copies] + [rows[0].toatoms()], cluster_space=cs_data)
+        assert extended.get_attribute('n_duplicates') == 4
+        assert extended.store().count() == deduplicated.count()
+
+    @pytest.mark.usefixtures('clear_database_before_test')
+    def test_extend_fingerprints(self, ase_db, cluster_space, tmp_path, monkeypatch):
+        """test the fingerprints of a shard are computed once and those of the new rows stored with them"""
+        from ase.db import connect
+
+        monkeypatch.setattr(StructureDbData, '_file_cache', None)
+        StructureDbData.set_file_cache(str(tmp_path / 'cache'))
+
+        cs_data = ClusterSpaceData()
+        cs_data.set_from_cluster_space(cluster_space)
+        cs_data.store()
+
+        rows = list(ase_db.select('natoms<=3'))
+        db_file = str(tmp_path / 'root.db')
+        db = connect(db_file)
+        for row in rows[:-2]:
+            db.write(row)
+        root = StructureDbData(db_file).store()
+
+        first = root.extend([row.toatoms() for row in rows[-2:]], cluster_space=cs_data).store()
+        second = first.extend([rows[0].toatoms()], cluster_space=cs_data)
+        assert second.get_attribute('n_duplicates') == 1
+
+        # the fingerprints of the root, stored without them, are only computed once
+        assert len(list((tmp_path / 'cache').glob('fingerprints-*'))) == 1
+        new_fingerprints = first.get_index()['text']['fingerprint'][-2:]
+        assert np.array_equal(first.get_fingerprints(cs_data),
+                              np.concatenate([root.get_fingerprints(cs_data), new_fingerprints]))
 
     # def test_store_load_default(self, ase_db):
     #     """test store and then load from stored
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""tests of the incremental energy evaluator"""
+import pytest
+import numpy as np
+from aiida.plugins import DataFactory
+
+ClusterExpansionData = DataFactory('cluster_expansion')
+
+
+@pytest.fixture
+def cluster_expansion_data(cluster_space, optimizer):
+    """return a stored Ag-Pd cluster expansion"""
+    data = ClusterExpansionData()
+    data.set(cluster_space, optimizer.parameters)
+
+    yield data.store()
+
+
+@pytest.mark.usefixtures('clear_database_before_test')
+def test_flip_and_swap_changes(cluster_expansion_data, generate_ase_structure):
+    """test the local changes match differences of full predictions"""
+    ce = cluster_expansion_data.get_noumenon()
+    supercell = generate_ase_structure('Ag').repeat(3)
+    supercell.symbols[[0, 4, 7, 13]] = 'Pd'
+
+    evaluator = cluster_expansion_data.get_local_evaluator(supercell)
+    total = ce.predict(supercell) * len(supercell)
+    assert np.isclose(evaluator.get_total(), total)
+
+    flipped = supercell.copy()
+    flipped.symbols[2] = 'Pd'
+    assert np.isclose(evaluator.get_flip_change(2, 'Pd'), ce.predict(flipped) * len(supercell) - total)
+
+    swapped = supercell.copy()
+    swapped.symbols[[0, 5]] = ['Ag', 'Pd']
+    changes = evaluator.get_swap_changes([(0, 5), (0, 4), (1, 2)])
+    assert np.allclose(changes, [ce.predict(swapped) * len(supercell) - total, 0., 0.])
+
+    # repeated and reversed moves are evaluated once, and match the single moves
+    pairs = [(0, 5), (5, 0), (1, 4), (0, 5), (2, 13)]
+    assert np.allclose(evaluator.get_swap_changes(pairs), [evaluator.get_swap_change(*pair) for pair in pairs])
+    sites, species = [2, 4, 2, 0, 4], ['Pd', 'Ag', 'Pd', 'Pd', 47]
+    assert np.allclose(evaluator.get_flip_changes(sites, species),
+                       [evaluator.get_flip_change(site, specie) for site, specie in zip(sites, species)])
+
+    evaluator.apply_swap(0, 5)
+    assert np.isclose(evaluator.get_total(), ce.predict(swapped) * len(supercell))
+    assert np.allclose(evaluator.get_flip_changes([2], ['Pd']),
+                       [evaluator.get_flip_change(2, 46)])
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""tests of the parallel cross validation of fit candidates"""
+import pytest
+import numpy as np
+
+from aiida_ce.fitting import cross_validate, fit_warm_start, get_fit_candidates, validate_candidates
+
+
+def test_get_fit_candidates():
+    """test the grids are expanded into every combination"""
+    candidates = get_fit_candidates([{
+        'fit_method': 'lasso',
+        'alpha': [1e-4, 1e-3],
+        'max_iter': 1000,
+    }, {
+        'fit_method': 'ardr',
+    }])
+
+    assert candidates == [
+        {'fit_method': 'lasso', 'alpha': 1e-4, 'max_iter': 1000},
+        {'fit_method': 'lasso', 'alpha': 1e-3, 'max_iter': 1000},
+        {'fit_method': 'ardr'},
+    ]
+
+    with pytest.raises(ValueError):
+        get_fit_candidates([{'alpha': 1e-4}])
+
+
+def test_validate_candidates(structure_container):
+    """test the candidates validated in a process pool match the serial ones"""
+    fit_matrix, target = structure_container.get_fit_data(key='mixing_energy')
+    candidates = get_fit_candidates([{'fit_method': 'lasso', 'alpha': [1e-4, 1e-3]}, {'fit_method': 'unknown'}])
+
+    scores = validate_candidates(fit_matrix, target, candidates, n_workers=2)
+    serial = validate_candidates(fit_matrix, target, candidates, n_workers=1)
+
+    assert np.allclose([score['rmse_validation'] for score in scores[:2]],
+                       [score['rmse_validation'] for score in serial[:2]])
+    assert np.isnan(scores[2]['rmse_validation'])
+    assert scores[2]['error'] is not None
+
+
+def test_cross_validate(structure_container):
+    """test the folds fitted in a process pool reproduce `CrossValidationEstimator`"""
+    from icet import CrossValidationEstimator
+
+    fit_data = structure_container.get_fit_data(key='mixing_energy')
+    opt = CrossValidationEstimator(fit_data=fit_data, fit_method='lasso', n_splits=5)
+    opt.validate()
+
+    validation = cross_validate(*fit_data, fit_method='lasso', n_splits=5, n_workers=2)
+    assert validation['fold_times'].shape == (5,)
+    assert np.isclose(validation['rmse_validation'], opt.rmse_validation)
+    assert np.allclose(cross_validate(*fit_data, fit_method='lasso', n_splits=5, n_workers=1)['rmse_validation_splits'],
+                       validation['rmse_validation_splits'])
+
+
+@pytest.mark.parametrize('fit_method', ['least-squares', 'lasso'])
+def test_cross_validate_splits(structure_container, fit_method):
+    """test the RMSE of every fold matches `CrossValidationEstimator` for the same splits"""
+    from icet import CrossValidationEstimator
+
+    fit_data = structure_container.get_fit_data(key='mixing_energy')
+    opt = CrossValidationEstimator(fit_data=fit_data, fit_method=fit_method, n_splits=5, seed=7)
+    opt.validate()
+
+    validation = cross_validate(*fit_data, fit_method=fit_method, n_splits=5, seed=7, n_workers=1)
+    assert np.allclose(validation['rmse_validation_splits'], opt.rmse_validation_splits)
+    assert np.allclose(validation['rmse_train_splits'], opt.rmse_train_splits)
+
+
+def test_cross_validate_split_kwargs(structure_container):
+    """test the splitter keyword arguments are told apart from the fit ones as by `CrossValidationEstimator`"""
+    from icet import CrossValidationEstimator
+    from aiida_ce.fitting import split_kwargs
+
+    assert split_kwargs('shuffle-split', {'test_size': 0.3, 'alpha': 1e-4}) == ({'test_size': 0.3}, {'alpha': 1e-4})
+    assert split_kwargs('k-fold', {'test_size': 0.3}) == ({}, {'test_size': 0.3})
+
+    fit_data = structure_container.get_fit_data(key='mixing_energy')
+    kwargs = {'validation_method': 'shuffle-split', 'n_splits': 4, 'test_size': 0.3, 'alpha': 1e-4}
+    opt = CrossValidationEstimator(fit_data=fit_data, fit_method='lasso', **kwargs)
+    opt.validate()
+
+    validation = cross_validate(*fit_data, fit_method='lasso', n_workers=1, **kwargs)
+    assert np.allclose(validation['rmse_validation_splits'], opt.rmse_validation_splits)
+
+
+@pytest.mark.parametrize('start', ['zeros', 'perturbed'])
+def test_fit_warm_start(structure_container, start):
+    """test the warm-started lasso fit gives the parameters of a cold lasso fit with icet"""
+    from icet.fitting import fit
+
+    fit_matrix, target = structure_container.get_fit_data(key='mixing_energy')
+    solver = {'alpha': 1e-4, 'max_iter': 100000, 'tol': 1e-10}
+    cold = fit(fit_matrix.copy(), target, fit_method='lasso', **solver)['parameters']
+
+    parameters = np.zeros_like(cold) if start == 'zeros' else 1.1 * cold
+    result = fit_warm_start(fit_matrix, target, parameters, **solver)
+    assert result['alpha'] == solver['alpha']
+    assert np.allclose(result['parameters'], cold, rtol=1e-4, atol=1e-6)
+
+
+def test_shared_array_memmap(structure_container, tmp_path):
+    """test a fit matrix memory mapped from a .npy file is shared without a copy"""
+    from aiida_ce.fitting import _shared_array
+
+    fit_matrix, target = structure_container.get_fit_data(key='mixing_energy')
+    path = str(tmp_path / 'fit_matrix.npy')
+    np.save(path, fit_matrix)
+    mapped = np.load(path, mmap_mode='r')
+
+    with _shared_array(mapped) as shared_path:
+        assert shared_path == path
+    with _shared_array(mapped[:10]) as shared_path:
+        assert shared_path != path
+        assert np.allclose(np.load(shared_path), fit_matrix[:10])
+
+    assert np.allclose(cross_validate(mapped, target, n_workers=2)['rmse_validation_splits'],
+                       cross_validate(fit_matrix, target, n_workers=1)['rmse_validation_splits'])
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""tests of the icet tasks run outside of the workflow process"""
+import json
+
+import numpy as np
+
+from aiida_ce import tasks
+
+
+def test_task_slot(tmp_path):
+    """test the tasks wait for one of the slots of the machine"""
+    with tasks.task_slot(2, directory=str(tmp_path)) as first:
+        with tasks.task_slot(2, directory=str(tmp_path)) as second:
+            assert {first, second} == {0, 1}
+
+        with tasks.task_slot(2, directory=str(tmp_path)) as third:
+            assert third == second
+
+
+def test_train(structure_container):
+    """test the columns and then the fit candidate are selected before training"""
+    fit_matrix, target = structure_container.get_fit_data(key='mixing_energy')
+    column_sets = [list(range(fit_matrix.shape[1])), [0, 1, 2]]
+    fit_candidates = [{'fit_method': 'least-squares'}, {'fit_method': 'unknown'}]
+
+    arrays, results = tasks.train(fit_matrix, target, column_sets=column_sets, fit_candidates=fit_candidates,
+                                  n_workers=1)
+
+    assert arrays['columns_rmse_validation'].shape == (2,)
+    assert results['selected_columns'] == int(np.argmin(arrays['columns_rmse_validation']))
+    assert results['selected_fit'] == {'fit_method': 'least-squares'}
+    assert results['fit_errors'][1] is not None
+    assert len(arrays['parameters']) == len(column_sets[results['selected_columns']])
+    assert arrays['validation_fold_times'].shape == (10,)
+    json.dumps(results)
+
+    # the cross validation of the selected candidate is not run again
+    rmse = np.sqrt(np.mean(arrays['validation_rmse_validation_splits']**2))
+    assert rmse == arrays['fit_rmse_validation'][results['selected_fit_index']]
+
+
+def test_train_read_only(structure_container, tmp_path):
+    """test the training of a read-only memory map, standardized by icet in place"""
+    fit_matrix, target = structure_container.get_fit_data(key='mixing_energy')
+    np.save(tmp_path / 'fit_matrix.npy', fit_matrix)
+    mapped = np.load(tmp_path / 'fit_matrix.npy', mmap_mode='r')
+
+    arrays, _ = tasks.train(mapped, target, fit_kwargs={'fit_method': 'lasso', 'standardize': True}, n_workers=1)
+
+    assert arrays['parameters'].shape == (fit_matrix.shape[1],)
+    assert np.array_equal(mapped, fit_matrix)
+
+
+def test_main_train(structure_container, tmp_path, monkeypatch):
+    """test the train task reads and writes its files in the working directory"""
+    fit_matrix, target = structure_container.get_fit_data(key='mixing_energy')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv(tasks.SLOTS_DIR_ENV, str(tmp_path / 'slots'))
+    np.save(tasks.FIT_MATRIX_FILENAME, fit_matrix)
+    np.save(tasks.TARGET_FILENAME, target)
+    with open(tasks.PARAMETERS_FILENAME, 'w', encoding='utf8') as handle:
+        json.dump({'fit_kwargs': {'fit_method': 'least-squares'}, 'n_workers': 1}, handle)
+
+    tasks.main(['train'])
+
+    with np.load(tasks.RESULTS_ARRAYS_FILENAME) as arrays:
+        assert arrays['parameters'].shape == (fit_matrix.shape[1],)
+    with open(tasks.RESULTS_FILENAME, encoding='utf8') as handle:
+        assert 'rmse_validation' in json.load(handle)['metadata']
+
+
+def test_sqs(cluster_space_aupd, generate_ase_structure):
+    """test the supercells annealed in a process pool give the same objectives as serially"""
+    from icet.tools import enumerate_supercells
+
+    supercells = list(enumerate_supercells(generate_ase_structure('Au'), [4]))
+    supercells.append(generate_ase_structure('Au').repeat((1, 1, 3)))
+    kwargs = {'target_concentrations': {'Au': 0.5, 'Pd': 0.5}, 'n_steps': 200, 'random_seed': 1234}
+
+    structure, cluster_vector, table = tasks.sqs(cluster_space_aupd, supercells, n_workers=2, **kwargs)
+    _, _, serial = tasks.sqs(cluster_space_aupd, supercells, n_workers=1, **kwargs)
+
+    objectives = np.array(table['objectives'], dtype=float)
+    assert np.allclose(objectives, np.array(serial['objectives'], dtype=float), equal_nan=True)
+    assert table['errors'][-1] is not None
+    assert table['selected'] == int(np.nanargmin(objectives))
+    assert len(structure) == table['n_atoms'][table['selected']]
+    assert np.allclose(cluster_vector, cluster_space_aupd.get_cluster_vector(structure))
+    json.dumps(table)
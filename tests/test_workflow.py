@@ -1,15 +1,24 @@
 # -*- coding: utf-8 -*-
 """tests of ce workflows"""
 # pylint: disable=redefined-outer-name
+import io
+
 import pytest
+import numpy as np
 from aiida.engine.launch import run_get_node
 from aiida import orm
 from aiida.plugins import WorkflowFactory, DataFactory
 
+from aiida_ce.sampling import get_ladder, run_ladder
+from aiida_ce.workflows import get_fit_arrays
+
 ClusterSpaceData = DataFactory('cluster_space')
 ClusterExpansionData = DataFactory('cluster_expansion')
 ConstructClusterExpansion = WorkflowFactory('construct_ce')
+RetrainClusterExpansion = WorkflowFactory('retrain_ce')
 IcetMcsqsWorkChain = WorkflowFactory('icet.mcsqs')
+IcetMonteCarloWorkChain = WorkflowFactory('icet.monte_carlo')
+IcetParallelTemperingWorkChain = WorkflowFactory('icet.parallel_tempering')
 
 # ConstructClusterExpansion
 
@@ -35,6 +44,191 @@ def test_construct_ce_default(structure_db, primitive_structure):
     assert isinstance(res['cluster_expansion'], ClusterExpansionData)
 
 
+@pytest.mark.usefixtures('clear_database_before_test')
+def test_construct_ce_cutoffs_candidates(structure_db, primitive_structure):
+    """test the cutoffs are selected among nested candidates"""
+    inputs = {
+        'cluster_space': {
+            'primitive_structure': primitive_structure,
+            'cutoffs': orm.List(list=[10.0, 6.0]),
+            'chemical_symbols': orm.List(list=['Ag', 'Pd']),
+        },
+        'structure_db': structure_db,
+        'cutoffs_candidates': orm.List(list=[[10.0, 6.0], [8.0], [6.0, 5.0]]),
+    }
+
+    res, node = run_get_node(ConstructClusterExpansion, **inputs)
+
+    assert node.is_finished_ok
+    assert res['cutoffs_scores'].get_array('rmse_validation').shape == (3,)
+
+    selected = int(res['cutoffs_scores'].get_array('selected')[0])
+    cluster_space = res['cluster_space']
+    assert cluster_space.get_attribute('cutoffs') == inputs['cutoffs_candidates'].get_list()[selected]
+    assert len(res['cluster_expansion'].get_noumenon()) == len(cluster_space.get_noumenon())
+
+
+@pytest.mark.usefixtures('clear_database_before_test')
+def test_construct_ce_reuse_fit_data(structure_db, primitive_structure):
+    """test the fit data are computed once for several fit methods"""
+    inputs = {
+        'cluster_space': {
+            'primitive_structure': primitive_structure,
+            'cutoffs': orm.List(list=[8.0, 6.0]),
+            'chemical_symbols': orm.List(list=['Ag', 'Pd']),
+        },
+        'structure_db': structure_db,
+        'selection': orm.Str('natoms<=6'),
+        'n_workers': orm.Int(2),
+    }
+
+    res_lasso, _ = run_get_node(ConstructClusterExpansion, fit_method=orm.Str('lasso'), **inputs)
+    res_ardr, node = run_get_node(ConstructClusterExpansion, fit_method=orm.Str('ardr'), **inputs)
+
+    assert node.is_finished_ok
+    fit_data = res_lasso['fit_data']
+    assert res_ardr['fit_data'].uuid == fit_data.uuid
+    assert len(fit_data.get_array('target')) == structure_db.count('natoms<=6')
+    assert fit_data.get_array('fit_matrix').shape[1] == len(res_ardr['cluster_expansion'].get_noumenon())
+
+    # the cluster vectors from the pool are in the order of the structures
+    cluster_space = res_ardr['cluster_expansion'].get_noumenon()._cluster_space  # pylint: disable=protected-access
+    structures = [row.toatoms() for row in structure_db.get_db().select('natoms<=6')]
+    assert np.allclose(fit_data.get_array('fit_matrix'),
+                       [cluster_space.get_cluster_vector(structure) for structure in structures])
+
+    # the fit matrix is read from the repository as a memory map
+    fit_matrix, _ = get_fit_arrays(fit_data)
+    assert isinstance(fit_matrix, np.memmap)
+
+
+def test_get_fit_arrays_without_path(monkeypatch):
+    """Test the fit matrix is not memory mapped if the repository object has no file path"""
+    fit_data = orm.ArrayData()
+    monkeypatch.setattr(fit_data, 'open', lambda key, mode='r': io.BytesIO(b''))
+
+    with pytest.raises(ValueError, match='can not be memory mapped'):
+        get_fit_arrays(fit_data)
+
+
+@pytest.mark.usefixtures('clear_database_before_test')
+def test_construct_ce_fit_methods(structure_db, primitive_structure):
+    """test the fit method is selected among the candidates of the grids"""
+    inputs = {
+        'cluster_space': {
+            'primitive_structure': primitive_structure,
+            'cutoffs': orm.List(list=[8.0, 6.0]),
+            'chemical_symbols': orm.List(list=['Ag', 'Pd']),
+        },
+        'structure_db': structure_db,
+        'fit_methods': orm.List(list=[{
+            'fit_method': 'lasso',
+            'alpha': [1e-5, 1e-4, 1e-3],
+        }, {
+            'fit_method': 'least-squares',
+        }]),
+        'n_workers': orm.Int(2),
+    }
+
+    res, node = run_get_node(ConstructClusterExpansion, **inputs)
+
+    assert node.is_finished_ok
+    fit_scores = res['fit_scores']
+    rmse_validation = fit_scores.get_array('rmse_validation')
+    assert rmse_validation.shape == (4,)
+    assert int(fit_scores.get_array('selected')[0]) == int(np.argmin(rmse_validation))
+    assert len(fit_scores.get_attribute('candidates')) == 4
+    assert res['cluster_expansion'].get_array('validation_fold_times').shape == (10,)
+
+
+@pytest.mark.usefixtures('clear_database_before_test')
+def test_retrain_ce(structure_db, primitive_structure):
+    """test the retraining computes the new rows only and starts from the previous parameters"""
+    inputs = {
+        'cluster_space': {
+            'primitive_structure': primitive_structure,
+            'cutoffs': orm.List(list=[8.0, 6.0]),
+            'chemical_symbols': orm.List(list=['Ag', 'Pd']),
+        },
+        'structure_db': structure_db,
+        'selection': orm.Str('natoms<=6'),
+        'fit_method': orm.Str('lasso'),
+    }
+    res, _ = run_get_node(ConstructClusterExpansion, **inputs)
+    previous = res['cluster_expansion']
+
+    retrained, node = run_get_node(RetrainClusterExpansion,
+                                   cluster_expansion=previous,
+                                   structure_db=structure_db,
+                                   selection=orm.Str('natoms=7'),
+                                   alpha=orm.Float(1e-5),
+                                   n_workers=orm.Int(1))
+
+    assert node.is_finished_ok
+    fit_data = retrained['fit_data']
+    n_new = structure_db.count('natoms=7')
+    assert fit_data.get_attribute('n_new_rows') == n_new
+    assert len(fit_data.get_array('target')) == len(res['fit_data'].get_array('target')) + n_new
+    assert np.allclose(fit_data.get_array('fit_matrix')[:-n_new], res['fit_data'].get_array('fit_matrix'))
+
+    ce_data = retrained['cluster_expansion']
+    assert ce_data.predecessor.uuid == previous.uuid
+    assert previous.uuid in [node.uuid for node in ce_data.creator.get_incoming().all_nodes()]
+    assert ce_data.get_noumenon().metadata['warm_start']
+
+
+@pytest.mark.usefixtures('clear_database_before_test')
+def test_retrain_ce_cutoffs_candidates(structure_db, primitive_structure):
+    """test the fit data of larger cutoffs are restricted to the columns of the selected cutoffs"""
+    inputs = {
+        'cluster_space': {
+            'primitive_structure': primitive_structure,
+            'cutoffs': orm.List(list=[8.0, 6.0]),
+            'chemical_symbols': orm.List(list=['Ag', 'Pd']),
+        },
+        'structure_db': structure_db,
+        'selection': orm.Str('natoms<=6'),
+        'fit_method': orm.Str('lasso'),
+        'cutoffs_candidates': orm.List(list=[[6.0], [8.0, 6.0]]),
+    }
+    res, _ = run_get_node(ConstructClusterExpansion, **inputs)
+    previous = res['cluster_expansion']
+
+    retrained, node = run_get_node(RetrainClusterExpansion,
+                                   cluster_expansion=previous,
+                                   structure_db=structure_db,
+                                   selection=orm.Str('natoms=7'),
+                                   n_workers=orm.Int(1))
+
+    assert node.is_finished_ok
+    n_parameters = len(previous.get_parameters())
+    assert retrained['fit_data'].get_shape('fit_matrix')[1] == n_parameters
+    assert len(retrained['cluster_expansion'].get_parameters()) == n_parameters
+
+
+@pytest.mark.usefixtures('clear_database_before_test')
+def test_retrain_ce_invalid_inputs(structure_db, primitive_structure):
+    """test a blank selection and a cluster expansion not fitted with lasso are rejected"""
+    inputs = {
+        'cluster_space': {
+            'primitive_structure': primitive_structure,
+            'cutoffs': orm.List(list=[8.0, 6.0]),
+            'chemical_symbols': orm.List(list=['Ag', 'Pd']),
+        },
+        'structure_db': structure_db,
+        'selection': orm.Str('natoms<=6'),
+        'fit_method': orm.Str('least-squares'),
+    }
+    res, _ = run_get_node(ConstructClusterExpansion, **inputs)
+
+    for selection, exit_code in (('', 'ERROR_EMPTY_SELECTION'), ('natoms=7', 'ERROR_UNSUPPORTED_FIT_METHOD')):
+        _, node = run_get_node(RetrainClusterExpansion,
+                               cluster_expansion=res['cluster_expansion'],
+                               structure_db=structure_db,
+                               selection=orm.Str(selection))
+        assert node.exit_status == RetrainClusterExpansion.exit_codes[exit_code].status
+
+
 @pytest.mark.usefixtrue('clear_database_before_test')
 def test_icet_sqs_default():
     """test default"""
@@ -62,3 +256,164 @@ def test_icet_sqs_default():
     assert node.is_finished_ok
     assert 'output_cluster_vector' in res
     assert 'output_structure' in res
+
+
+@pytest.mark.usefixtures('clear_database_before_test')
+def test_icet_sqs_supercell_size():
+    """test all the supercells of a size are annealed and the best SQS is the output"""
+    from ase.build import bulk
+
+    inputs = {
+        'cluster_space': {
+            'primitive_structure': orm.StructureData(ase=bulk('Au')),
+            'cutoffs': orm.List(list=[8.0, 4.0]),
+            'chemical_symbols': orm.List(list=[['Au', 'Pd']]),
+        },
+        'supercell_size': orm.Int(4),
+        'n_steps': orm.Int(500),
+        'n_workers': orm.Int(2),
+        'target_concentrations': orm.Dict(dict={
+            'Au': 0.5,
+            'Pd': 0.5
+        })
+    }
+
+    res, node = run_get_node(IcetMcsqsWorkChain, **inputs)
+
+    assert node.is_finished_ok
+    objectives = res['objectives']
+    assert len(objectives.get_array('objectives')) > 1
+    selected = objectives.get_attribute('selected')
+    assert selected == int(np.nanargmin(objectives.get_array('objectives')))
+    assert len(res['output_structure'].sites) == 4
+
+    enumerations = [called for called in node.called if called.process_label == '_enumerate_supercells']
+    assert len(enumerations) == 1
+    assert len(enumerations[0].get_outgoing().all()) == len(objectives.get_array('objectives'))
+
+    _, node = run_get_node(IcetMcsqsWorkChain, supercell=orm.StructureData(ase=bulk('Au').repeat(2)), **inputs)
+    assert node.exit_status == IcetMcsqsWorkChain.exit_codes.ERROR_INVALID_SUPERCELLS.status
+
+
+@pytest.mark.usefixtures('clear_database_before_test')
+def test_icet_monte_carlo_chunks(cluster_space, optimizer, generate_ase_structure):
+    """test the trial steps are run in chunks which continue each other"""
+    cluster_expansion = ClusterExpansionData()
+    cluster_expansion.set(cluster_space, optimizer.parameters)
+
+    supercell = generate_ase_structure('Ag').repeat(3)
+    supercell.symbols[[0, 4, 7, 13]] = 'Pd'
+
+    inputs = {
+        'cluster_expansion': cluster_expansion.store(),
+        'supercell': orm.StructureData(ase=supercell),
+        'temperature': orm.Float(600.0),
+        'n_steps': orm.Int(250),
+        'chunk_size': orm.Int(100),
+        'observation_interval': orm.Int(10),
+        'trajectory_interval': orm.Int(50),
+    }
+
+    res, node = run_get_node(IcetMonteCarloWorkChain, **inputs)
+
+    assert node.is_finished_ok
+    chunks = [res['chunks'][label] for label in sorted(res['chunks'])]
+    assert len(chunks) == 3
+    assert [chunk.get_attribute('n_steps') for chunk in chunks] == [100, 100, 50]
+
+    mctrial = np.concatenate([chunk.get_array('mctrial') for chunk in chunks])
+    assert np.array_equal(mctrial, np.arange(0, 251, 10))
+    assert len(np.concatenate([chunk.get_array('occupations') for chunk in chunks])) == 6
+
+    # the canonical ensemble keeps the composition
+    assert res['final_structure'].get_ase().get_chemical_symbols().count('Pd') == 4
+
+
+@pytest.mark.usefixtures('clear_database_before_test')
+def test_icet_monte_carlo_chunked_unchunked(cluster_space, optimizer, generate_ase_structure):
+    """test chunks not aligned with the observation interval give the observations of a single chunk"""
+    cluster_expansion = ClusterExpansionData()
+    cluster_expansion.set(cluster_space, optimizer.parameters)
+
+    supercell = generate_ase_structure('Ag').repeat(3)
+    supercell.symbols[[0, 4, 7, 13]] = 'Pd'
+
+    inputs = {
+        'cluster_expansion': cluster_expansion.store(),
+        'supercell': orm.StructureData(ase=supercell).store(),
+        'temperature': orm.Float(600.0),
+        'n_steps': orm.Int(250),
+        'observation_interval': orm.Int(20),
+        'trajectory_interval': orm.Int(40),
+    }
+
+    observations = []
+    for chunk_size in (250, 70):
+        res, node = run_get_node(IcetMonteCarloWorkChain, chunk_size=orm.Int(chunk_size), **inputs)
+        assert node.is_finished_ok
+
+        chunks = [res['chunks'][label] for label in sorted(res['chunks'])]
+        observations.append({
+            name: np.concatenate([chunk.get_array(name) for chunk in chunks])
+            for name in ('mctrial', 'potential', 'trajectory_mctrial', 'occupations')
+        })
+
+    unchunked, chunked = observations
+    assert np.array_equal(chunked['mctrial'], unchunked['mctrial'])
+    assert np.allclose(chunked['potential'], unchunked['potential'])
+    assert np.array_equal(chunked['trajectory_mctrial'], unchunked['trajectory_mctrial'])
+    assert np.array_equal(chunked['occupations'], unchunked['occupations'])
+
+
+@pytest.mark.usefixtures('clear_database_before_test')
+def test_icet_parallel_tempering(cluster_space, optimizer, generate_ase_structure):
+    """test the ladder is sampled in parallel with replica exchange"""
+    cluster_expansion = ClusterExpansionData()
+    cluster_expansion.set(cluster_space, optimizer.parameters)
+
+    supercell = generate_ase_structure('Ag').repeat(3)
+    supercell.symbols[[0, 4, 7, 13]] = 'Pd'
+
+    inputs = {
+        'cluster_expansion': cluster_expansion.store(),
+        'supercell': orm.StructureData(ase=supercell),
+        'temperatures': orm.List(list=[300.0, 600.0, 900.0]),
+        'n_steps': orm.Int(400),
+        'n_equilibration_steps': orm.Int(100),
+        'exchange_interval': orm.Int(100),
+        'observation_interval': orm.Int(10),
+        'n_workers': orm.Int(2),
+    }
+
+    res, node = run_get_node(IcetParallelTemperingWorkChain, **inputs)
+
+    assert node.is_finished_ok
+    averages = res['averages']
+    assert np.allclose(averages.get_array('temperatures'), [300.0, 600.0, 900.0])
+    assert averages.get_array('potential_mean').shape == (3,)
+    assert np.all(averages.get_array('heat_capacity') >= 0)
+    assert list(averages.get_array('n_observations')) == [31, 31, 31]
+    assert averages.get_array('exchange_acceptance').shape == (2,)
+    assert len(res['segments']) == 4
+
+    # the segments run as steps of the workchain sample the ladder as a single run
+    expected, _ = run_ladder(
+        cluster_expansion._get_content(),  # pylint: disable=protected-access
+        supercell,
+        get_ladder([300.0, 600.0, 900.0]),
+        400,
+        n_equilibration_steps=100,
+        exchange_interval=100,
+        observation_interval=10,
+        random_seed=1234,
+        n_workers=1)
+    assert np.allclose(averages.get_array('potential_mean'), expected['potential_mean'])
+    assert np.allclose(averages.get_array('exchange_acceptance'), expected['exchange_acceptance'], equal_nan=True)
+
+    assert len(res['final_structures']) == 3
+    for structure in res['final_structures'].values():
+        assert structure.get_ase().get_chemical_symbols().count('Pd') == 4
+
+    inputs['chemical_potentials'] = orm.List(list=[{'Ag': 0.0, 'Pd': 0.1}, {'Ag': 0.0, 'Pd': 0.2}])
+    _, node = run_get_node(IcetParallelTemperingWorkChain, **inputs)
+    assert node.exit_status == IcetParallelTemperingWorkChain.exit_codes.ERROR_INVALID_LADDER.status